@@ -0,0 +1,271 @@
+################################################################
+# Checkpoint files for InfNet/GenNet/PeaNet parameters.        #
+################################################################
+
+# basic python
+import os
+import json
+import struct
+import base64
+import importlib
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import numpy as np
+
+#
+# A checkpoint is a single file, laid out as:
+#
+#   CKPT_MAGIC (8 bytes)
+#   length of the JSON header, as a little-endian uint64
+#   the JSON header, padded with spaces to a multiple of CKPT_ALIGN bytes
+#   the raw bytes of each parameter array, each starting at a multiple of
+#   CKPT_ALIGN bytes from the end of the header
+#
+# The header records the format version, the kind of net ("InfNet", etc.), a
+# dict of "simple" values needed to rebuild the net (prior_sigma, params), and
+# for each array its group/layer/key, dtype, shape and offset. Loading maps
+# the file into memory (copy-on-write) and returns views into it, so nothing
+# is read or copied until it's used.
+#
+# Saves take a snapshot of the parameter values on the calling thread, and
+# then write the file on a background thread, first to a temp file and then
+# renaming it into place, so training can continue while the file is written
+# and a crash mid-save never leaves a partial checkpoint behind.
+#
+# Files that don't start with CKPT_MAGIC are treated as the old sequential
+# cPickle format, which load_*_from_file still reads.
+#
+
+try:
+    STRING_TYPES = (str, unicode)
+    NUMBER_TYPES = (bool, int, long, float)
+except NameError:
+    STRING_TYPES = (str,)
+    NUMBER_TYPES = (bool, int, float)
+
+CKPT_MAGIC = b'GMCKPT01'
+CKPT_VERSION = 1
+CKPT_ALIGN = 64
+
+# saves that may still be running, and exceptions raised by background
+# saves that haven't been re-raised yet, both keyed by file name
+_PENDING_SAVES = {}
+_SAVE_ERRORS = {}
+_PENDING_LOCK = threading.Lock()
+
+def _encode_value(val):
+    """
+    Encode val as something JSON can represent.
+    """
+    if (val is None) or isinstance(val, NUMBER_TYPES + STRING_TYPES):
+        return val
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, np.ndarray):
+        return {'__array__': val.tolist(), 'dtype': str(val.dtype)}
+    if isinstance(val, tuple):
+        return {'__tuple__': [_encode_value(v) for v in val]}
+    if isinstance(val, list):
+        return [_encode_value(v) for v in val]
+    if isinstance(val, dict):
+        if all([isinstance(k, STRING_TYPES) and (not k.startswith('__')) \
+                for k in val]):
+            return dict([(k, _encode_value(v)) for (k, v) in val.items()])
+        return {'__items__': [[_encode_value(k), _encode_value(v)] \
+                              for (k, v) in val.items()]}
+    mod_name = getattr(val, '__module__', None)
+    obj_name = getattr(val, '__name__', None)
+    if (not (mod_name is None)) and (not (obj_name is None)) and \
+            (obj_name != '<lambda>'):
+        # functions/classes (e.g. activation functions) are stored by name
+        return {'__object__': "{0:s}.{1:s}".format(mod_name, obj_name)}
+    # anything else gets pickled, like in the old format
+    return {'__pickle__': base64.b64encode(pickle.dumps(val, protocol=-1)).decode('ascii')}
+
+def _native_str(val):
+    """
+    Convert a string from JSON to the native str type (utf-8 bytes on py2).
+    """
+    if (str is bytes) and (not isinstance(val, bytes)):
+        return val.encode('utf-8')
+    return val
+
+def _decode_value(val):
+    """
+    Undo _encode_value().
+    """
+    if isinstance(val, list):
+        return [_decode_value(v) for v in val]
+    if isinstance(val, STRING_TYPES):
+        # JSON gives back unicode strings on python 2
+        return _native_str(val)
+    if not isinstance(val, dict):
+        return val
+    if '__array__' in val:
+        return np.asarray(val['__array__'], dtype=val['dtype'])
+    if '__tuple__' in val:
+        return tuple([_decode_value(v) for v in val['__tuple__']])
+    if '__items__' in val:
+        return dict([(_decode_value(k), _decode_value(v)) \
+                     for (k, v) in val['__items__']])
+    if '__object__' in val:
+        mod_name, obj_name = _native_str(val['__object__']).rsplit('.', 1)
+        return getattr(importlib.import_module(mod_name), obj_name)
+    if '__pickle__' in val:
+        return pickle.loads(base64.b64decode(val['__pickle__']))
+    return dict([(_native_str(k), _decode_value(v)) for (k, v) in val.items()])
+
+def _aligned(offset):
+    return ((offset + CKPT_ALIGN - 1) // CKPT_ALIGN) * CKPT_ALIGN
+
+def _write_checkpoint(f_name, header, arrays):
+    """
+    Write a checkpoint file, via a temp file that's renamed into place.
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    head_len = len(CKPT_MAGIC) + 8 + len(header_bytes)
+    header_bytes = header_bytes + (b' ' * (_aligned(head_len) - head_len))
+    tmp_name = "{0:s}.tmp{1:d}".format(f_name, os.getpid())
+    with open(tmp_name, 'wb') as f_handle:
+        f_handle.write(CKPT_MAGIC)
+        f_handle.write(struct.pack('<Q', len(header_bytes)))
+        f_handle.write(header_bytes)
+        pos = 0
+        for (info, ary) in zip(header['arrays'], arrays):
+            f_handle.write(b'\0' * (info['offset'] - pos))
+            f_handle.write(ary.tobytes())
+            pos = info['offset'] + ary.nbytes
+    if hasattr(os, 'replace'):
+        os.replace(tmp_name, f_name)
+    else:
+        # python 2 has no os.replace, and os.rename won't overwrite an
+        # existing file on Windows, so the old checkpoint goes first there
+        if (os.name == 'nt') and os.path.exists(f_name):
+            os.remove(f_name)
+        os.rename(tmp_name, f_name)
+    return
+
+def wait_for_saves(f_name=None):
+    """
+    Wait for the pending save to f_name to finish (or for all pending saves,
+    if f_name is None). If a background save failed, its exception is raised
+    here (once).
+    """
+    with _PENDING_LOCK:
+        if f_name is None:
+            threads = list(_PENDING_SAVES.values())
+        else:
+            threads = [_PENDING_SAVES.get(f_name)]
+    for t in threads:
+        if not (t is None):
+            t.join()
+    with _PENDING_LOCK:
+        if f_name is None:
+            names = sorted(_SAVE_ERRORS.keys())
+        else:
+            names = [f_name] if (f_name in _SAVE_ERRORS) else []
+        errors = [_SAVE_ERRORS.pop(name) for name in names]
+    if len(errors) > 0:
+        raise errors[0]
+    return
+
+def save_checkpoint(f_name, kind, meta, param_groups, async_save=True):
+    """
+    Save the parameters of a net to a checkpoint file.
+
+    Parameters:
+        f_name: file to write
+        kind: name of the net's class, checked when loading
+        meta: dict of "simple" values needed to rebuild the net
+        param_groups: dict mapping group names to lists of dicts of theano
+                      shared variables (e.g. InfNet.shared_param_dicts)
+        async_save: whether to write the file on a background thread
+    """
+    assert(not (f_name is None))
+    # snapshot the current values (a plain memcpy per array), so that the
+    # writer sees consistent values while training continues
+    header = {'format': 'gm-checkpoint', 'version': CKPT_VERSION, \
+              'kind': kind, 'meta': _encode_value(meta), 'arrays': [], \
+              'groups': {}}
+    arrays = []
+    offset = 0
+    for group in sorted(param_groups.keys()):
+        header['groups'][group] = len(param_groups[group])
+        for (layer, shared_dict) in enumerate(param_groups[group]):
+            for key in sorted(shared_dict.keys()):
+                ary = np.ascontiguousarray( \
+                        shared_dict[key].get_value(borrow=False))
+                header['arrays'].append({'group': group, 'layer': layer, \
+                        'key': key, 'dtype': str(ary.dtype), \
+                        'shape': list(ary.shape), 'offset': offset})
+                arrays.append(ary)
+                offset = _aligned(offset + ary.nbytes)
+    # wait for any earlier save to the same file, so they can't interleave
+    # (this also raises any error from that save)
+    wait_for_saves(f_name)
+    if not async_save:
+        _write_checkpoint(f_name, header, arrays)
+        return
+    def writer():
+        try:
+            _write_checkpoint(f_name, header, arrays)
+        except Exception as e:
+            # keep it for wait_for_saves, since it'd be lost on this thread
+            with _PENDING_LOCK:
+                _SAVE_ERRORS[f_name] = e
+        finally:
+            with _PENDING_LOCK:
+                if _PENDING_SAVES.get(f_name) is threading.current_thread():
+                    del _PENDING_SAVES[f_name]
+        return
+    t = threading.Thread(target=writer)
+    with _PENDING_LOCK:
+        _PENDING_SAVES[f_name] = t
+    t.start()
+    return
+
+def is_checkpoint(f_name):
+    """
+    Check whether f_name is a checkpoint (rather than an old pickle file).
+    """
+    wait_for_saves(f_name)
+    with open(f_name, 'rb') as f_handle:
+        magic = f_handle.read(len(CKPT_MAGIC))
+    return (magic == CKPT_MAGIC)
+
+def load_checkpoint(f_name, kind=None):
+    """
+    Load a checkpoint file. Returns [meta, param_groups], where param_groups
+    maps group names to lists of dicts of numpy arrays. The arrays are views
+    into a copy-on-write memory map of the file.
+    """
+    wait_for_saves(f_name)
+    with open(f_name, 'rb') as f_handle:
+        magic = f_handle.read(len(CKPT_MAGIC))
+        assert(magic == CKPT_MAGIC)
+        header_len = struct.unpack('<Q', f_handle.read(8))[0]
+        header = json.loads(f_handle.read(header_len).decode('utf-8'))
+    assert(header['version'] <= CKPT_VERSION)
+    if not (kind is None):
+        assert(header['kind'] == kind)
+    data_start = len(CKPT_MAGIC) + 8 + header_len
+    data_bytes = os.path.getsize(f_name) - data_start
+    if data_bytes > 0:
+        data = np.memmap(f_name, dtype=np.uint8, mode='c', offset=data_start)
+    else:
+        data = np.zeros((0,), dtype=np.uint8)
+    param_groups = {}
+    for group in header['groups']:
+        param_groups[str(group)] = [{} for i in range(header['groups'][group])]
+    for info in header['arrays']:
+        dtype = np.dtype(str(info['dtype']))
+        shape = tuple(info['shape'])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        ary = data[info['offset']:(info['offset'] + nbytes)]
+        ary = ary.view(dtype).reshape(shape)
+        param_groups[str(info['group'])][info['layer']][str(info['key'])] = ary
+    meta = _decode_value(header['meta'])
+    return [meta, param_groups]
@@ -0,0 +1,267 @@
+################################################################
+# On-disk cache for compiled theano functions.                 #
+################################################################
+
+# basic python
+import os
+import sys
+import time
+import hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# theano business
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import inputs as graph_inputs, ancestors
+
+#
+# Each of the models in this directory compiles a handful of theano functions
+# when it's constructed, and for models with many unrolled steps this can take
+# minutes. cached_function() is a drop-in replacement for theano.function()
+# which pickles each compiled (i.e. already optimized) function to disk, under
+# a key built from:
+#
+#   tag: the model class and function name, e.g. "OneStageModel.train_joint"
+#   key_info: the model's params dict (or anything else with a stable repr)
+#   the types/shapes of all shared variables in the graph (i.e. layer sizes)
+#   theano.config.floatX/device and the theano version
+#   a debugprint of the symbolic outputs, updates and givens
+#
+# A pickled function carries its own copies of the shared variables it was
+# compiled with, so on a cache hit these are swapped for the current model's
+# shared variables, using Function.copy(swap=...). Shared variables are
+# matched up by their position in the (deterministic) traversal order of the
+# graph, which is the same whenever the model is built with the same code.
+#
+# The cache is off unless a directory is given, either by set_cache_dir() or
+# through the environment variable GM_FUNCTION_CACHE.
+#
+# Functions that aren't needed for training (free-energy estimates, samplers,
+# etc.) are declared with lazy_function, so they're only compiled (or loaded
+# from the cache) if they get used, and then only once per model instance.
+#
+
+CACHE_DIR = os.environ.get('GM_FUNCTION_CACHE', None)
+CACHE_STATS = {'hits': 0, 'misses': 0, 'compile_time': 0.0, \
+               'load_time': 0.0, 'saved_time': 0.0}
+
+class lazy_function(object):
+    """
+    Compiled function that is only built when it's first used.
+
+    Put this in a model's class body, as in:
+
+        compute_fe_terms = lazy_function(_construct_compute_fe_terms, \
+                                         'compute_fe_terms')
+
+    The first time self.compute_fe_terms is looked up on an instance, the
+    build method (i.e. self._construct_compute_fe_terms()) is called and its
+    result is stored in the instance's __dict__ under the given name. Later
+    lookups find it there directly, without going through this descriptor.
+    """
+    def __init__(self, build, name=None):
+        self.build = build
+        if name is None:
+            name = build.__name__
+        self.name = name
+        self.__doc__ = build.__doc__
+        return
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        func = self.build(obj)
+        obj.__dict__[self.name] = func
+        return func
+
+def set_cache_dir(cache_dir=None):
+    """
+    Set the directory for caching compiled functions (None turns it off).
+    """
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+    if not (CACHE_DIR is None):
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+    return
+
+def cache_report():
+    """
+    Get a string describing cache hits/misses and compile time saved.
+    """
+    report = "FunctionCache: {0:d} hits, {1:d} misses, compiled in {2:.1f}s, " \
+             "loaded in {3:.1f}s, saved ~{4:.1f}s of compile time".format( \
+             CACHE_STATS['hits'], CACHE_STATS['misses'], \
+             CACHE_STATS['compile_time'], CACHE_STATS['load_time'], \
+             CACHE_STATS['saved_time'])
+    return report
+
+def print_cache_report():
+    """
+    Print cache_report(), if the cache is turned on.
+    """
+    if not (CACHE_DIR is None):
+        print(cache_report())
+    return
+
+def _as_pairs(pairs):
+    """
+    Get a list of (key, value) pairs from a dict or a list of pairs.
+    """
+    if pairs is None:
+        return []
+    if hasattr(pairs, 'items'):
+        return list(pairs.items())
+    return list(pairs)
+
+def _describe(obj):
+    """
+    Get a repr of obj that doesn't depend on memory addresses.
+    """
+    if isinstance(obj, dict):
+        items = sorted([(str(k), _describe(v)) for (k, v) in obj.items()])
+        return "{" + ", ".join(["{0:s}: {1:s}".format(k, v) for (k, v) in items]) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ", ".join([_describe(v) for v in obj]) + "]"
+    if hasattr(obj, 'shape') and hasattr(obj, 'dtype'):
+        return "array({0:s}, {1:s})".format(str(obj.shape), str(obj.dtype))
+    if callable(obj):
+        return getattr(obj, '__name__', type(obj).__name__)
+    return repr(obj)
+
+def _sort_pairs(pairs, roots):
+    """
+    Sort (variable, value) pairs by where their variables first show up in a
+    traversal of the graph for roots, as givens are often passed in a plain
+    dict, whose order can change from run to run.
+    """
+    order = dict([(v, i) for (i, v) in reversed(list(enumerate(ancestors(roots))))])
+    last = len(order)
+    return sorted(pairs, key=lambda p: (order.get(p[0], last), str(p[0].name)))
+
+def _graph_shared_vars(outputs, updates, givens):
+    """
+    Get the shared variables in a graph, in a deterministic order.
+    """
+    roots = list(outputs)
+    roots.extend([v for (k, v) in updates])
+    roots.extend([v for (k, v) in givens])
+    shared = [v for v in graph_inputs(roots) if isinstance(v, SharedVariable)]
+    shared.extend([k for (k, v) in updates])
+    seen = set()
+    shared_vars = []
+    for sv in shared:
+        if not (sv in seen):
+            seen.add(sv)
+            shared_vars.append(sv)
+    return shared_vars
+
+def _graph_key(tag, key_info, inputs, outputs, updates, givens, shared_vars):
+    """
+    Hash everything that determines the compiled function.
+    """
+    h = hashlib.sha1()
+    h.update(tag.encode('utf-8'))
+    h.update(_describe(key_info).encode('utf-8'))
+    h.update("{0:s} {1:s} {2:s}".format(theano.config.floatX, \
+            theano.config.device, theano.__version__).encode('utf-8'))
+    for x in inputs:
+        h.update(str(getattr(x, 'type', x)).encode('utf-8'))
+    for sv in shared_vars:
+        val = sv.get_value(borrow=True, return_internal_type=True)
+        h.update("{0:s} {1:s} {2:s}".format(str(sv.name), str(sv.type), \
+                str(getattr(val, 'shape', None))).encode('utf-8'))
+    roots = list(outputs)
+    for (k, v) in updates:
+        roots.extend([k, v])
+    for (k, v) in givens:
+        roots.extend([k, v])
+    h.update(theano.printing.debugprint(roots, file='str').encode('utf-8'))
+    return h.hexdigest()
+
+def _load_function(f_name, shared_vars):
+    """
+    Load a pickled function and swap in the given shared variables.
+    """
+    old_reopt = theano.config.reoptimize_unpickled_function
+    theano.config.reoptimize_unpickled_function = False
+    try:
+        with open(f_name, 'rb') as f:
+            record = pickle.load(f)
+    finally:
+        theano.config.reoptimize_unpickled_function = old_reopt
+    func = record['func']
+    swap = {}
+    for (i_idx, s_idx) in record['shared_pos']:
+        swap[func.maker.inputs[i_idx].variable] = shared_vars[s_idx]
+    func = func.copy(swap=swap)
+    return [func, record['compile_time']]
+
+def _save_function(f_name, func, shared_vars, compile_time):
+    """
+    Pickle a compiled function, recording where each of its shared variables
+    sits in shared_vars. Returns False if some shared variable isn't there.
+    """
+    shared_idx = dict([(sv, i) for (i, sv) in enumerate(shared_vars)])
+    shared_pos = []
+    for (i_idx, inp) in enumerate(func.maker.inputs):
+        if inp.implicit:
+            if not (inp.variable in shared_idx):
+                return False
+            shared_pos.append((i_idx, shared_idx[inp.variable]))
+    record = {'func': func, 'shared_pos': shared_pos, \
+              'compile_time': compile_time}
+    # write to a temp file first, so other processes never see partial files
+    tmp_name = "{0:s}.tmp{1:d}".format(f_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_name, f_name)
+    return True
+
+def cached_function(inputs, outputs=None, updates=None, givens=None, \
+                    tag='function', key_info=None, **kwargs):
+    """
+    Compile a theano function, or load it from the cache if it was compiled
+    before for the same graph. Arguments other than tag and key_info are as
+    for theano.function().
+    """
+    if CACHE_DIR is None:
+        return theano.function(inputs, outputs=outputs, updates=updates, \
+                               givens=givens, **kwargs)
+    # deep graphs need a deep stack for hashing and pickling
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    out_list = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+    update_pairs = _as_pairs(updates)
+    given_pairs = _sort_pairs(_as_pairs(givens), \
+            out_list + [v for (k, v) in update_pairs])
+    shared_vars = _graph_shared_vars(out_list, update_pairs, given_pairs)
+    key = _graph_key(tag, key_info, inputs, out_list, update_pairs, \
+                     given_pairs, shared_vars)
+    f_name = os.path.join(CACHE_DIR, "{0:s}_{1:s}.pkl".format(tag, key))
+    if os.path.exists(f_name):
+        start = time.time()
+        try:
+            func, compile_time = _load_function(f_name, shared_vars)
+            load_time = time.time() - start
+            CACHE_STATS['hits'] += 1
+            CACHE_STATS['load_time'] += load_time
+            CACHE_STATS['saved_time'] += max(0.0, compile_time - load_time)
+            return func
+        except Exception as e:
+            print("FunctionCache: failed to load {0:s} ({1:s}), recompiling".format( \
+                    f_name, str(e)))
+    start = time.time()
+    func = theano.function(inputs, outputs=outputs, updates=updates, \
+                           givens=givens, **kwargs)
+    compile_time = time.time() - start
+    CACHE_STATS['misses'] += 1
+    CACHE_STATS['compile_time'] += compile_time
+    try:
+        _save_function(f_name, func, shared_vars, compile_time)
+    except Exception as e:
+        print("FunctionCache: failed to save {0:s} ({1:s})".format( \
+                f_name, str(e)))
+    return func
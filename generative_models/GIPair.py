@@ -21,6 +21,7 @@ from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
 from LogPDFs import gaussian_kld
+from FunctionCache import cached_function, lazy_function, print_cache_report
 
 #
 #
@@ -197,10 +198,9 @@ class GIPair(object):
         self.joint_updates[self.IN.kld_mean] = self.IN.kld_mean_update
 
         # Construct a function for jointly training the generator/inferencer
+        # (the other functions are compiled on first use, see below)
         self.train_joint = self._construct_train_joint()
-        self.compute_costs = self._construct_compute_costs()
-        self.compute_ll_bound = self._construct_compute_ll_bound()
-        self.compute_post_stats = self._construct_compute_post_stats()
+        print_cache_report()
         return
 
     def set_all_sgd_params(self, lr_gn=0.01, lr_in=0.01, \
@@ -280,8 +280,9 @@ class GIPair(object):
             log_likelihood = self.GN.compute_log_prob(self.IN.Xd)
         # construct a theano function for actually computing stuff
         outputs = [post_kld, log_likelihood]
-        out_func = theano.function([Xd], outputs=outputs, \
-                givens={ self.Xd: Xd, self.Xc: Xc, self.Xm: Xm })
+        out_func = cached_function([Xd], outputs=outputs, \
+                givens={ self.Xd: Xd, self.Xc: Xc, self.Xm: Xm }, \
+                tag='GIPair.compute_ll_bound', key_info=self.params)
         # construct a function for computing multi-sample averages
         def multi_sample_bound(X, sample_count=10):
             post_klds = np.zeros((X.shape[0], 1))
@@ -346,9 +347,10 @@ class GIPair(object):
         """
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.other_reg_cost, self.posterior_norms, self.posterior_klds]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm ], \
                 outputs=outputs, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                tag='GIPair.train_joint', key_info=self.params)
         return func
 
     def _construct_compute_costs(self):
@@ -358,8 +360,9 @@ class GIPair(object):
         """
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.other_reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm ], \
-                outputs=outputs)
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+                outputs=outputs, \
+                tag='GIPair.compute_costs', key_info=self.params)
         return func
 
     def _construct_compute_post_stats(self):
@@ -378,10 +381,18 @@ class GIPair(object):
         dim_vars = T.sum(self.IN.output_mean**2.0, axis=0) / obs_count
         # make a theano function to compute them
         outputs = [all_klds, obs_klds, dim_klds, dim_vars]
-        func = theano.function(inputs=[self.Xd, self.Xc, self.Xm], \
-                outputs=outputs)
+        func = cached_function(inputs=[self.Xd, self.Xc, self.Xm], \
+                outputs=outputs, \
+                tag='GIPair.compute_post_stats', key_info=self.params)
         return func
 
+    # auxiliary functions, which are compiled on first use
+    compute_costs = lazy_function(_construct_compute_costs, 'compute_costs')
+    compute_ll_bound = lazy_function(_construct_compute_ll_bound, \
+                                     'compute_ll_bound')
+    compute_post_stats = lazy_function(_construct_compute_post_stats, \
+                                       'compute_post_stats')
+
     def shared_param_clone(self, rng=None, Xd=None, Xc=None, Xm=None):
         """
         Create a "shared-parameter" clone of this GIPair.
@@ -26,6 +26,7 @@ from DKCode import get_adam_updates, get_adadelta_updates
 from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
+from FunctionCache import lazy_function
 
 ######################################################
 # HELPER FUNCTIONS FOR PEAR AND CLASSIFICATION COSTS #
@@ -493,6 +494,18 @@ class GIStack(object):
                 "label samples": label_samples}
         return result
 
+    def _construct_label_predictor(self):
+        """
+        Construct theano function to compute the output of the label generator.
+        """
+        func = theano.function([self.Xd, self.Xc, self.Xm], \
+            outputs=self.Yp2_proto)
+        return func
+
+    # compiled on first use, rather than on every call to classification_error
+    label_predictor = lazy_function(_construct_label_predictor, \
+                                    'label_predictor')
+
     def classification_error(self, X_d, Y_d, samples=20):
         """
         Compute classification error for a set of observations X_d with known
@@ -502,9 +515,8 @@ class GIStack(object):
         # first, convert labels to account for semi-supervised labeling
         Y_mask = 1.0 * (Y_d != 0)
         Y_d = Y_d - 1
-        # make a function for computing the output of the label generator
-        func = theano.function([self.Xd, self.Xc, self.Xm], \
-            outputs=self.Yp2_proto)
+        # get the (memoized) function for computing the label generator output
+        func = self.label_predictor
         input_count = X_d.shape[0]
         X_c = 0.0 * X_d
         X_m = 0.0 * X_d
@@ -530,9 +542,8 @@ class GIStack(object):
         based on multiple samples from its continuous posterior (computed via
         self.IN2), passed through the label generator (i.e. self.PN2).
         """
-        # make a function for computing the output of the label generator
-        func = theano.function([self.Xd, self.Xc, self.Xm], \
-            outputs=self.Yp2_proto)
+        # get the (memoized) function for computing the label generator output
+        func = self.label_predictor
         input_count = X_d.shape[0]
         X_c = 0.0 * X_d
         X_m = 0.0 * X_d
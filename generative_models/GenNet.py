@@ -18,6 +18,7 @@ from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 from NetLayers import HiddenLayer, DiscLayer, relu_actfun, \
                       max_normalize
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2
+from Checkpoints import save_checkpoint, load_checkpoint, is_checkpoint
 
 #####################################
 # GENERATIVE NETWORK IMPLEMENTATION #
@@ -590,30 +591,22 @@ class GenNet(object):
                 shared_param_dicts=self.shared_param_dicts)
         return clone_net
 
-    def save_to_file(self, f_name=None):
+    def save_to_file(self, f_name=None, async_save=True):
         """
-        Dump important stuff to a Python pickle, so that we can reload this
-        model later. We'll pickle everything required to create a clone of
-        this model given the pickle and the rng/Xd params to the cloning
-        function: "GenNet.shared_param_clone()".
+        Dump important stuff to a checkpoint file (see Checkpoints.py), so
+        that we can reload this model later. We'll save everything required
+        to create a clone of this model given the file and the rng/Xd params
+        to the cloning function: "GenNet.shared_param_clone()".
+
+        The parameter values are snapshotted before this returns, but if
+        async_save is True the file is written on a background thread.
         """
         assert(not (f_name is None))
-        f_handle = file(f_name, 'wb')
-        # dump the "simple" python value in self.prior_sigma
-        cPickle.dump(self.prior_sigma, f_handle, protocol=-1)
-        # dump the dict self.params, which just holds "simple" python values
-        cPickle.dump(self.params, f_handle, protocol=-1)
-        # make a copy of self.shared_param_dicts, with numpy arrays in place
-        # of the theano shared variables
-        numpy_param_dicts = []
-        for shared_dict in self.shared_param_dicts:
-            numpy_dict = {}
-            for key in shared_dict:
-                numpy_dict[key] = shared_dict[key].get_value(borrow=False)
-            numpy_param_dicts.append(numpy_dict)
-        # dump the numpy version of self.shared_param_dicts
-        cPickle.dump(numpy_param_dicts, f_handle, protocol=-1)
-        f_handle.close()
+        # self.prior_sigma and self.params just hold "simple" python values
+        meta = {'prior_sigma': self.prior_sigma, 'params': self.params}
+        save_checkpoint(f_name, 'GenNet', meta, \
+                        {'layers': self.shared_param_dicts}, \
+                        async_save=async_save)
         return
 
 def load_gennet_from_file(f_name=None, rng=None, Xp=None, new_params=None):
@@ -622,19 +615,29 @@ def load_gennet_from_file(f_name=None, rng=None, Xp=None, new_params=None):
     the loaded model to be clamped at 0 post-hoc.
     """
     assert(not (f_name is None))
-    pickle_file = open(f_name)
-    self_dot_prior_sigma = cPickle.load(pickle_file)
-    self_dot_params = cPickle.load(pickle_file)
+    if is_checkpoint(f_name):
+        meta, param_groups = load_checkpoint(f_name, 'GenNet')
+        self_dot_prior_sigma = meta['prior_sigma']
+        self_dot_params = meta['params']
+        self_dot_numpy_param_dicts = param_groups['layers']
+    else:
+        # old-style sequential pickle file
+        pickle_file = open(f_name)
+        self_dot_prior_sigma = cPickle.load(pickle_file)
+        self_dot_params = cPickle.load(pickle_file)
+        self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+        pickle_file.close()
     if not (new_params is None):
         for k in new_params:
             self_dot_params[k] = new_params[k]
-    self_dot_numpy_param_dicts = cPickle.load(pickle_file)
     self_dot_shared_param_dicts = []
     for numpy_dict in self_dot_numpy_param_dicts:
         shared_dict = {}
         for key in numpy_dict:
-            val = numpy_dict[key].astype(theano.config.floatX)
-            shared_dict[key] = theano.shared(val)
+            val = numpy_dict[key]
+            if val.dtype != theano.config.floatX:
+                val = val.astype(theano.config.floatX)
+            shared_dict[key] = theano.shared(val, borrow=True)
         self_dot_shared_param_dicts.append(shared_dict)
     # now, create a PeaNet with the configuration we just unpickled
     clone_net = GenNet(rng=rng, Xp=Xp, \
@@ -21,6 +21,9 @@ from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FunctionCache import cached_function, lazy_function, print_cache_report
+from MultiSampleEval import tiled_inputs, sample_means, sample_log_mean_exp, \
+                            multi_sample_eval
 
 #
 #
@@ -269,10 +272,9 @@ class IRModel(object):
 
         # Construct a function for jointly training the generator/inferencer
         print("Compiling training function...")
+        # (the other functions are compiled on first use, see below)
         self.train_joint = self._construct_train_joint()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.sample_from_prior = self._construct_sample_from_prior()
+        print_cache_report()
         # make easy access points for some interesting parameters
         if self.model_init:
             self.inf_1_weights = self.q_z_given_x.shared_layers[0].W
@@ -471,37 +473,84 @@ class IRModel(object):
         outputs = [self.joint_cost, self.nll_cost, self.kld_cost, \
                 self.reg_cost]
         # compile the theano function
-        func = theano.function(inputs=[ x, self.batch_reps ], \
+        func = cached_function(inputs=[ x, self.batch_reps ], \
                 outputs=outputs, \
                 givens={ self.x: x.repeat(self.batch_reps, axis=0) }, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                tag='IRModel.train_joint', key_info=self.params)
         return func
 
-    def _construct_compute_fe_terms(self):
+    def _construct_fe_chunk(self):
         """
-        Construct a function for computing terms in variational free energy.
+        Construct a function for computing terms in variational free energy
+        and the importance log-weights, with each input repeated for some
+        number of samples (see MultiSampleEval.py).
         """
         # setup some symbolic variables for theano to deal with
         x_in = T.matrix()
+        reps = T.lscalar()
         # construct values to output
         nll = self._construct_nll_costs()
         kld = self.kld_z + self.kld_zti_cond
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[x_in], \
-                outputs=[nll, kld], givens={self.x: x_in})
-        # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(X, sample_count):
-            nll_sum = np.zeros((X.shape[0],))
-            kld_sum = np.zeros((X.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(X)
-                nll_sum += result[0].ravel()
-                kld_sum += result[1].ravel()
-            mean_nll = nll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            return [mean_nll, mean_kld]
+        # log-densities of the sampled z and zti under the priors and under
+        # the distributions they were actually sampled from, for the
+        # importance weights. these assume train_switch is 1, i.e. zti is
+        # drawn from q_zti_given_x_xti.
+        log_p = 0.0 * nll
+        log_q = 0.0 * nll
+        if self.model_init:
+            log_p = log_p + log_prob_gaussian2(self.z, 0.0 * self.z, \
+                    log_vars=0.0)
+            log_q = log_q + log_prob_gaussian2(self.z, \
+                    self.q_z_given_x.output_mean, \
+                    log_vars=(2.0 * T.log(self.q_z_given_x.output_sigma)))
+        for i in range(self.ir_steps):
+            log_p = log_p + log_prob_gaussian2(self.zt[i], \
+                    self.p_zti_given_xti[i].output_mean, \
+                    log_vars=self.p_zti_given_xti[i].output_logvar)
+            log_q = log_q + log_prob_gaussian2(self.zt[i], \
+                    self.q_zti_given_x_xti[i].output_mean, \
+                    log_vars=(2.0 * T.log(self.q_zti_given_x_xti[i].output_sigma)))
+        log_w = -nll + log_p - log_q
+        outputs = [sample_means(nll, reps), sample_means(kld, reps), \
+                sample_log_mean_exp(log_w, reps)]
+        # compile theano function for a multi-sample free-energy estimate
+        func = cached_function(inputs=[x_in, reps], outputs=outputs, \
+                givens={self.x: tiled_inputs(x_in, reps)}, \
+                tag='IRModel.fe_chunk', key_info=self.params)
+        return func
+
+    def _eval_fe_chunks(self, X, sample_count, max_rows=None):
+        """
+        Compute multi-sample estimates of the free-energy terms and the
+        importance-weighted bound, with zti drawn from the guide model.
+        """
+        old_train_switch = self.train_switch.get_value(borrow=False)
+        self.train_switch.set_value((0.0 * old_train_switch) + 1.0)
+        result = multi_sample_eval(self.fe_chunk, [X], sample_count, \
+                max_rows=max_rows)
+        self.train_switch.set_value(old_train_switch)
+        return result
+
+    def _construct_compute_fe_terms(self):
+        """
+        Construct a function for computing terms in variational free energy.
+        """
+        def fe_term_estimator(X, sample_count, max_rows=None):
+            result = self._eval_fe_chunks(X, sample_count, max_rows=max_rows)
+            return result[0:2]
         return fe_term_estimator
 
+    def compute_ll_bounds(self, X, sample_count, max_rows=None):
+        """
+        Compute the free-energy bound and the importance-weighted bound on
+        -log p(x) for each row of X, using sample_count samples per row.
+        """
+        result = self._eval_fe_chunks(X, sample_count, max_rows=max_rows)
+        fe_bound = result[0] + result[1]
+        iwae_bound = result[2]
+        return [fe_bound, iwae_bound]
+
     def _construct_compute_post_klds(self):
         """
         Construct theano function to compute the info about the variational
@@ -530,8 +579,9 @@ class IRModel(object):
                     0.0, 0.0)
             all_klds.append(kld_z_all)
         # compile theano function for a one-sample free-energy estimate
-        kld_func = theano.function(inputs=[x], outputs=all_klds, \
-                givens={ self.x: x })
+        kld_func = cached_function(inputs=[x], outputs=all_klds, \
+                givens={ self.x: x }, \
+                tag='IRModel.compute_post_klds', key_info=self.params)
         def post_kld_computer(X):
             f_all_klds = kld_func(X)
             if self.model_init:
@@ -556,12 +606,14 @@ class IRModel(object):
         x_sym = T.matrix()
         oputs = [self.xt_transform(xti) for xti in self.xt]
         if self.model_init:
-            sample_func = theano.function(inputs=[z_sym, x_sym], outputs=oputs, \
+            sample_func = cached_function(inputs=[z_sym, x_sym], outputs=oputs, \
                     givens={ self.z: z_sym, \
-                            self.x: T.zeros_like(x_sym) })
+                            self.x: T.zeros_like(x_sym) }, \
+                    tag='IRModel.sample_from_prior', key_info=self.params)
         else:
-            sample_func = theano.function(inputs=[x_sym], outputs=oputs, \
-                    givens={ self.x: T.zeros_like(x_sym) })
+            sample_func = cached_function(inputs=[x_sym], outputs=oputs, \
+                    givens={ self.x: T.zeros_like(x_sym) }, \
+                    tag='IRModel.sample_from_prior', key_info=self.params)
         def prior_sampler(samp_count):
             x_samps = np.zeros((samp_count, self.x_dim))
             x_samps = x_samps.astype(theano.config.floatX)
@@ -579,6 +631,15 @@ class IRModel(object):
             return model_samps
         return prior_sampler
 
+    # auxiliary functions, which are compiled on first use
+    compute_post_klds = lazy_function(_construct_compute_post_klds, \
+                                      'compute_post_klds')
+    fe_chunk = lazy_function(_construct_fe_chunk, 'fe_chunk')
+    compute_fe_terms = lazy_function(_construct_compute_fe_terms, \
+                                     'compute_fe_terms')
+    sample_from_prior = lazy_function(_construct_sample_from_prior, \
+                                      'sample_from_prior')
+
 if __name__=="__main__":
     print("Hello world!")
 
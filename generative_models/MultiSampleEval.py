@@ -0,0 +1,118 @@
+################################################################
+# Multi-sample free-energy and importance-weighted bounds.     #
+################################################################
+
+# basic python
+import numpy as np
+
+# theano business
+import theano.tensor as T
+
+# phil's sweetness
+from LogPDFs import log_mean_exp
+
+#
+# Each model's compute_fe_terms used to call a one-sample theano function once
+# per sample, in a python loop, re-running the whole network on the same
+# inputs each time. Instead, the models compile a single "chunk" function
+# which takes a batch of inputs and a repeat count K, tiles the inputs K times
+# inside the graph (i.e. x.repeat(K, axis=0), like train_joint does with
+# batch_reps) and returns, for each input row:
+#
+#   the mean (over the K samples) of the negative log-likelihood term
+#   the mean (over the K samples) of the posterior KL-divergence term
+#   the log-mean-exp (over the K samples) of the importance log-weights
+#       log p(x|z) + log p(z) - log q(z|x)
+#
+# multi_sample_eval() then splits a request for N inputs with sample_count
+# samples each into calls to the chunk function that tile at most max_rows
+# rows at once, and combines the results across calls. The log-mean-exps are
+# combined with np.logaddexp, so large sample counts don't under/overflow.
+#
+# The free-energy bound is mean_nll + mean_kld, and the importance-weighted
+# bound (Burda et al., 2015) on -log p(x) is -log_mean_exp(log-weights),
+# which gets tighter as sample_count grows.
+#
+
+# default cap on the number of (tiled) rows passed through a model at once,
+# this is what bounds the memory used by one call to a chunk function
+MAX_ROWS = 20000
+
+def tiled_inputs(x, reps):
+    """
+    Repeat each row of the symbolic matrix x reps times, keeping copies of
+    the same row next to each other.
+    """
+    return x.repeat(reps, axis=0)
+
+def sample_means(vals, reps):
+    """
+    Get the mean over each group of reps consecutive values in vals, which
+    should be a column vector or vector computed from tiled_inputs().
+    """
+    return T.mean(vals.reshape((-1, reps)), axis=1)
+
+def sample_log_mean_exp(log_ws, reps):
+    """
+    Get a stable log-mean-exp over each group of reps consecutive values in
+    log_ws, which should be a column vector or vector of log-weights.
+    """
+    return log_mean_exp(log_ws.reshape((-1, reps)))
+
+def chunk_sizes(sample_count, max_rows=None):
+    """
+    Get the number of inputs and samples per input to use in each call to a
+    chunk function, so that at most max_rows rows are tiled at once.
+    """
+    if max_rows is None:
+        max_rows = MAX_ROWS
+    assert(sample_count > 0)
+    samp_chunk = min(sample_count, max_rows)
+    obs_chunk = max(1, int(max_rows / samp_chunk))
+    return [obs_chunk, samp_chunk]
+
+def multi_sample_eval(chunk_func, inputs, sample_count, max_rows=None):
+    """
+    Compute multi-sample estimates of the free-energy terms and the
+    importance-weighted bound for some inputs.
+
+    Parameters:
+        chunk_func: function taking the arrays in inputs (restricted to some
+                    subset of their rows) followed by a repeat count K, and
+                    returning the per-row [mean_nll, mean_kld, log_mean_w]
+                    over K samples
+        inputs: list of arrays with matching numbers of rows
+        sample_count: number of samples to draw for each row
+        max_rows: max number of tiled rows in one call to chunk_func
+    Outputs:
+        [mean_nll, mean_kld, iwae_nll]: per-row estimates, where mean_nll +
+                    mean_kld is the free-energy bound, and iwae_nll is the
+                    importance-weighted bound on -log p(x)
+    """
+    obs_count = inputs[0].shape[0]
+    for X in inputs:
+        assert(X.shape[0] == obs_count)
+    obs_chunk, samp_chunk = chunk_sizes(sample_count, max_rows)
+    nll_sum = np.zeros((obs_count,))
+    kld_sum = np.zeros((obs_count,))
+    log_w_sum = np.zeros((obs_count,)) - np.inf
+    obs_start = 0
+    while obs_start < obs_count:
+        obs_end = min(obs_count, obs_start + obs_chunk)
+        Xb = [X[obs_start:obs_end] for X in inputs]
+        samps_left = sample_count
+        while samps_left > 0:
+            reps = min(samps_left, samp_chunk)
+            result = chunk_func(*(Xb + [reps]))
+            nll_sum[obs_start:obs_end] += reps * result[0].ravel()
+            kld_sum[obs_start:obs_end] += reps * result[1].ravel()
+            # log of the sum of the weights for these samples
+            chunk_log_w = result[2].ravel() + np.log(reps)
+            log_w_sum[obs_start:obs_end] = np.logaddexp( \
+                    log_w_sum[obs_start:obs_end], chunk_log_w)
+            samps_left = samps_left - reps
+        obs_start = obs_end
+    mean_nll = nll_sum / float(sample_count)
+    mean_kld = kld_sum / float(sample_count)
+    iwae_nll = -(log_w_sum - np.log(sample_count))
+    return [mean_nll, mean_kld, iwae_nll]
@@ -21,6 +21,9 @@ from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FunctionCache import cached_function, lazy_function, print_cache_report
+from MultiSampleEval import tiled_inputs, sample_means, sample_log_mean_exp, \
+                            multi_sample_eval
 
 #
 # Important symbolic variables:
@@ -267,11 +270,9 @@ class MultiStageModel(object):
 
         # Construct a function for jointly training the generator/inferencer
         print("Compiling training function...")
+        # (the other functions are compiled on first use, see below)
         self.train_joint = self._construct_train_joint()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.sample_from_prior = self._construct_sample_from_prior()
-        self.sample_from_input = self._construct_sample_from_input()
+        print_cache_report()
         # make easy access points for some interesting parameters
         self.inf_1_weights = self.q_z_given_x.shared_layers[0].W
         self.gen_1_weights = self.p_s0_obs_given_z_obs.mu_layers[-1].W
@@ -491,59 +492,104 @@ class MultiStageModel(object):
         outputs = [self.joint_cost, self.nll_cost, self.kld_cost, \
                 self.reg_cost]
         # compile the theano function
-        func = theano.function(inputs=[ xi, xo, self.batch_reps ], \
+        func = cached_function(inputs=[ xi, xo, self.batch_reps ], \
                 outputs=outputs, \
                 givens={ self.x_in: xi.repeat(self.batch_reps, axis=0), \
                          self.x_out: xo.repeat(self.batch_reps, axis=0) }, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                tag='MultiStageModel.train_joint', key_info=self.params)
         return func
 
-    def _construct_compute_fe_terms(self):
+    def _construct_fe_chunk(self):
         """
-        Construct a function for computing terms in variational free energy.
+        Construct a function for computing terms in variational free energy
+        and the importance log-weights, with each input repeated for some
+        number of samples (see MultiSampleEval.py).
         """
         # setup some symbolic variables for theano to deal with
         xi = T.matrix()
         xo = T.matrix()
+        reps = T.lscalar()
         # construct values to output
         nll = self._construct_nll_costs()
         kld = self.kld_z + self.kld_hi_cond
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[ xi, xo ], \
-                outputs=[nll, kld], givens={self.x_in: xi, self.x_out: xo})
-        # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(XI, XO, sample_count):
-            # set values of some regularization parameters to the values that
-            # produce the variational free energy bound.
-            old_lam_nll = self.lam_nll.get_value(borrow=False)
-            old_lam_kld_1 = self.lam_kld_1.get_value(borrow=False)
-            old_lam_kld_2 = self.lam_kld_2.get_value(borrow=False)
-            old_l1l2_weight = self.l1l2_weight.get_value(borrow=False)
-            vfe_lam_nll = (0.0 * old_lam_nll) + 1.0
-            vfe_lam_kld_1 = (0.0 * old_lam_kld_1) + 1.0
-            vfe_lam_kld_2 = (0.0 * old_lam_kld_2) + 1.0
-            vfe_l1l2_weight = (0.0 * old_l1l2_weight) + 1.0
-            self.lam_nll.set_value(vfe_lam_nll)
-            self.lam_kld_1.set_value(vfe_lam_kld_1)
-            self.lam_kld_2.set_value(vfe_lam_kld_2)
-            self.l1l2_weight.set_value(vfe_l1l2_weight)
-            # compute a multi-sample estimate of variational free-energy
-            nll_sum = np.zeros((XI.shape[0],))
-            kld_sum = np.zeros((XI.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(XI, XO)
-                nll_sum += result[0].ravel()
-                kld_sum += result[1].ravel()
-            mean_nll = nll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            # reset regularization parameters to their previous values
-            self.lam_nll.set_value(old_lam_nll)
-            self.lam_kld_1.set_value(old_lam_kld_1)
-            self.lam_kld_2.set_value(old_lam_kld_2)
-            self.l1l2_weight.set_value(old_l1l2_weight)
-            return [mean_nll, mean_kld]
+        # log-densities of the sampled z and hi under the priors and under the
+        # distributions they were actually sampled from, for the importance
+        # weights. these assume train_switch is 1, i.e. hi is drawn from
+        # q_hi_given_x_si.
+        log_p = log_prob_gaussian2(self.z, 0.0 * self.z, log_vars=0.0)
+        log_q = log_prob_gaussian2(self.z, self.q_z_given_x.output_mean, \
+                log_vars=(2.0 * T.log(self.q_z_given_x.output_sigma)))
+        for i in range(self.ir_steps):
+            log_p = log_p + log_prob_gaussian2(self.hi[i], \
+                    self.p_hi_given_si[i].output_mean, \
+                    log_vars=self.p_hi_given_si[i].output_logvar)
+            log_q = log_q + log_prob_gaussian2(self.hi[i], \
+                    self.q_hi_given_x_si[i].output_mean, \
+                    log_vars=(2.0 * T.log(self.q_hi_given_x_si[i].output_sigma)))
+        log_w = -nll + log_p - log_q
+        outputs = [sample_means(nll, reps), sample_means(kld, reps), \
+                sample_log_mean_exp(log_w, reps)]
+        # compile theano function for a multi-sample free-energy estimate
+        func = cached_function(inputs=[ xi, xo, reps ], outputs=outputs, \
+                givens={ self.x_in: tiled_inputs(xi, reps), \
+                         self.x_out: tiled_inputs(xo, reps) }, \
+                tag='MultiStageModel.fe_chunk', key_info=self.params)
+        return func
+
+    def _eval_fe_chunks(self, XI, XO, sample_count, max_rows=None):
+        """
+        Compute multi-sample estimates of the free-energy terms and the
+        importance-weighted bound, with the regularization parameters set to
+        the values that produce the variational free energy bound.
+        """
+        old_lam_nll = self.lam_nll.get_value(borrow=False)
+        old_lam_kld_1 = self.lam_kld_1.get_value(borrow=False)
+        old_lam_kld_2 = self.lam_kld_2.get_value(borrow=False)
+        old_l1l2_weight = self.l1l2_weight.get_value(borrow=False)
+        old_train_switch = self.train_switch.get_value(borrow=False)
+        vfe_lam_nll = (0.0 * old_lam_nll) + 1.0
+        vfe_lam_kld_1 = (0.0 * old_lam_kld_1) + 1.0
+        vfe_lam_kld_2 = (0.0 * old_lam_kld_2) + 1.0
+        vfe_l1l2_weight = (0.0 * old_l1l2_weight) + 1.0
+        vfe_train_switch = (0.0 * old_train_switch) + 1.0
+        self.lam_nll.set_value(vfe_lam_nll)
+        self.lam_kld_1.set_value(vfe_lam_kld_1)
+        self.lam_kld_2.set_value(vfe_lam_kld_2)
+        self.l1l2_weight.set_value(vfe_l1l2_weight)
+        self.train_switch.set_value(vfe_train_switch)
+        # compute the multi-sample estimates
+        result = multi_sample_eval(self.fe_chunk, [XI, XO], sample_count, \
+                max_rows=max_rows)
+        # reset regularization parameters to their previous values
+        self.lam_nll.set_value(old_lam_nll)
+        self.lam_kld_1.set_value(old_lam_kld_1)
+        self.lam_kld_2.set_value(old_lam_kld_2)
+        self.l1l2_weight.set_value(old_l1l2_weight)
+        self.train_switch.set_value(old_train_switch)
+        return result
+
+    def _construct_compute_fe_terms(self):
+        """
+        Construct a function for computing terms in variational free energy.
+        """
+        def fe_term_estimator(XI, XO, sample_count, max_rows=None):
+            result = self._eval_fe_chunks(XI, XO, sample_count, \
+                    max_rows=max_rows)
+            return result[0:2]
         return fe_term_estimator
 
+    def compute_ll_bounds(self, XI, XO, sample_count, max_rows=None):
+        """
+        Compute the free-energy bound and the importance-weighted bound on
+        -log p(XO | XI) for each row, using sample_count samples per row.
+        """
+        result = self._eval_fe_chunks(XI, XO, sample_count, \
+                max_rows=max_rows)
+        fe_bound = result[0] + result[1]
+        iwae_bound = result[2]
+        return [fe_bound, iwae_bound]
+
     def _construct_compute_post_klds(self):
         """
         Construct theano function to compute the info about the variational
@@ -572,8 +618,9 @@ class MultiStageModel(object):
                 0.0, 0.0)
         all_klds.append(kld_z_all)
         # compile theano function for a one-sample free-energy estimate
-        kld_func = theano.function(inputs=[xi, xo], outputs=all_klds, \
-                givens={ self.x_in: xi, self.x_out: xo })
+        kld_func = cached_function(inputs=[xi, xo], outputs=all_klds, \
+                givens={ self.x_in: xi, self.x_out: xo }, \
+                tag='MultiStageModel.compute_post_klds', key_info=self.params)
         def post_kld_computer(XI, XO):
             f_all_klds = kld_func(XI,XO)
             f_kld_z = f_all_klds[-1]
@@ -594,10 +641,11 @@ class MultiStageModel(object):
         z_sym = T.matrix()
         x_sym = T.matrix()
         oputs = [self.obs_transform(s[:,:self.obs_dim]) for s in self.si]
-        sample_func = theano.function(inputs=[z_sym, x_sym], outputs=oputs, \
+        sample_func = cached_function(inputs=[z_sym, x_sym], outputs=oputs, \
                 givens={ self.z: z_sym, \
                          self.x_in: T.zeros_like(x_sym), \
-                         self.x_out: T.zeros_like(x_sym) })
+                         self.x_out: T.zeros_like(x_sym) }, \
+                tag='MultiStageModel.sample_from_prior', key_info=self.params)
         def prior_sampler(samp_count):
             x_samps = np.zeros((samp_count, self.obs_dim))
             x_samps = x_samps.astype(theano.config.floatX)
@@ -624,9 +672,10 @@ class MultiStageModel(object):
         xi = T.matrix()
         xo = T.matrix()
         oputs = [self.obs_transform(s[:,:self.obs_dim]) for s in self.si]
-        sample_func = theano.function(inputs=[xi, xo], outputs=oputs, \
+        sample_func = cached_function(inputs=[xi, xo], outputs=oputs, \
                 givens={ self.x_in: xi, \
-                         self.x_out: xo })
+                         self.x_out: xo }, \
+                tag='MultiStageModel.sample_from_input', key_info=self.params)
         def conditional_sampler(XI, XO=None, guided_decoding=False):
             XI = XI.astype(theano.config.floatX)
             if XO is None:
@@ -646,6 +695,17 @@ class MultiStageModel(object):
             return model_samps
         return conditional_sampler
 
+    # auxiliary functions, which are compiled on first use
+    compute_post_klds = lazy_function(_construct_compute_post_klds, \
+                                      'compute_post_klds')
+    fe_chunk = lazy_function(_construct_fe_chunk, 'fe_chunk')
+    compute_fe_terms = lazy_function(_construct_compute_fe_terms, \
+                                     'compute_fe_terms')
+    sample_from_prior = lazy_function(_construct_sample_from_prior, \
+                                      'sample_from_prior')
+    sample_from_input = lazy_function(_construct_sample_from_input, \
+                                      'sample_from_input')
+
 if __name__=="__main__":
     print("Hello world!")
 
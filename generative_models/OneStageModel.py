@@ -21,6 +21,9 @@ from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FunctionCache import cached_function, lazy_function, print_cache_report
+from MultiSampleEval import tiled_inputs, sample_means, sample_log_mean_exp, \
+                            multi_sample_eval
 
 
 #
@@ -186,14 +189,9 @@ class OneStageModel(object):
                 mom2_init=1e-3, smoothing=1e-8, max_grad_norm=10.0)
 
         # Construct a function for jointly training the generator/inferencer
+        # (the other functions are compiled on first use, see below)
         self.train_joint = self._construct_train_joint()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.sample_from_prior = self._construct_sample_from_prior()
-        self.transform_x_to_z = theano.function([self.q_z_given_x.Xd], \
-                outputs=self.q_z_given_x.output_mean)
-        self.transform_z_to_x = theano.function([self.p_x_given_z.Xd], \
-                outputs=self.xt_transform(self.p_x_given_z.output_mean))
+        print_cache_report()
         self.inf_weights = self.q_z_given_x.shared_layers[0].W
         self.gen_weights = self.p_x_given_z.mu_layers[-1].W
         return
@@ -311,12 +309,13 @@ class OneStageModel(object):
         # collect the values to output with each function evaluation
         outputs = [self.joint_cost, self.nll_cost, self.kld_cost, \
                 self.reg_cost, self.nll_costs, self.kld_costs]
-        func = theano.function(inputs=[ Xd, Xc, Xm, self.batch_reps ], \
+        func = cached_function(inputs=[ Xd, Xc, Xm, self.batch_reps ], \
                 outputs=outputs, \
                 givens={ self.Xd: Xd.repeat(self.batch_reps, axis=0), \
                          self.Xc: Xc.repeat(self.batch_reps, axis=0), \
                          self.Xm: Xm.repeat(self.batch_reps, axis=0) }, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                tag='OneStageModel.train_joint', key_info=self.params)
         return func
 
     def _construct_compute_post_klds(self):
@@ -332,19 +331,23 @@ class OneStageModel(object):
                 self.q_z_given_x.output_logvar, \
                 self.prior_mean, self.prior_logvar)
         # compile theano function for a one-sample free-energy estimate
-        kld_func = theano.function(inputs=[Xd], outputs=all_klds, \
-                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm})
+        kld_func = cached_function(inputs=[Xd], outputs=all_klds, \
+                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm}, \
+                tag='OneStageModel.compute_post_klds', key_info=self.params)
         return kld_func
 
-    def _construct_compute_fe_terms(self):
+    def _construct_fe_chunk(self):
         """
-        Construct theano function to compute the log-likelihood and posterior
-        KL-divergence terms for the variational free-energy.
+        Construct theano function to compute the free-energy terms and the
+        importance log-weights for some inputs, with each input repeated for
+        some number of samples (see MultiSampleEval.py).
         """
         # setup some symbolic variables for theano to deal with
         Xd = T.matrix()
-        Xc = T.zeros_like(Xd)
-        Xm = T.zeros_like(Xd)
+        reps = T.lscalar()
+        Xr = tiled_inputs(Xd, reps)
+        Xc = T.zeros_like(Xr)
+        Xm = T.zeros_like(Xr)
         # construct values to output
         if self.x_type == 'bernoulli':
             ll_term = log_prob_bernoulli(self.x, self.xg)
@@ -355,23 +358,44 @@ class OneStageModel(object):
                 self.q_z_given_x.output_logvar, \
                 self.prior_mean, self.prior_logvar)
         kld_term = T.sum(all_klds, axis=1)
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[Xd], \
-                outputs=[ll_term, kld_term], \
-                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm})
-        # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(X, sample_count):
-            ll_sum = np.zeros((X.shape[0],))
-            kld_sum = np.zeros((X.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(X)
-                ll_sum = ll_sum + result[0].ravel()
-                kld_sum = kld_sum + result[1].ravel()
-            mean_nll = -ll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            return [mean_nll, mean_kld]
+        # log-density of z under the prior and under the distribution that
+        # it was actually sampled from (which includes the InfNet's sigma
+        # scaling), for the importance weights
+        log_p_z = log_prob_gaussian2(self.z, (0.0 * self.z) + self.prior_mean, \
+                log_vars=self.prior_logvar)
+        log_q_z = log_prob_gaussian2(self.z, self.q_z_given_x.output_mean, \
+                log_vars=(2.0 * T.log(self.q_z_given_x.output_sigma)))
+        log_w = ll_term + log_p_z - log_q_z
+        outputs = [-sample_means(ll_term, reps), sample_means(kld_term, reps), \
+                sample_log_mean_exp(log_w, reps)]
+        # compile theano function for a multi-sample free-energy estimate
+        func = cached_function(inputs=[Xd, reps], outputs=outputs, \
+                givens={self.Xd: Xr, self.Xc: Xc, self.Xm: Xm}, \
+                tag='OneStageModel.fe_chunk', key_info=self.params)
+        return func
+
+    def _construct_compute_fe_terms(self):
+        """
+        Construct a function to compute the log-likelihood and posterior
+        KL-divergence terms for the variational free-energy.
+        """
+        def fe_term_estimator(X, sample_count, max_rows=None):
+            result = multi_sample_eval(self.fe_chunk, [X], sample_count, \
+                    max_rows=max_rows)
+            return result[0:2]
         return fe_term_estimator
 
+    def compute_ll_bounds(self, X, sample_count, max_rows=None):
+        """
+        Compute the free-energy bound and the importance-weighted bound on
+        -log p(x) for each row of X, using sample_count samples per row.
+        """
+        result = multi_sample_eval(self.fe_chunk, [X], sample_count, \
+                max_rows=max_rows)
+        fe_bound = result[0] + result[1]
+        iwae_bound = result[2]
+        return [fe_bound, iwae_bound]
+
     def _construct_sample_from_prior(self):
         """
         Construct a function for drawing independent samples from the
@@ -379,8 +403,9 @@ class OneStageModel(object):
         """
         z_sym = T.matrix()
         oputs = self.xg
-        sample_func = theano.function(inputs=[z_sym], outputs=oputs, \
-                givens={ self.z: z_sym })
+        sample_func = cached_function(inputs=[z_sym], outputs=oputs, \
+                givens={ self.z: z_sym }, \
+                tag='OneStageModel.sample_from_prior', key_info=self.params)
         def prior_sampler(samp_count):
             z_samps = npr.randn(samp_count, self.z_dim)
             z_samps = (np.exp(0.5 * self.prior_logvar) * z_samps) + \
@@ -390,6 +415,38 @@ class OneStageModel(object):
             return model_samps
         return prior_sampler
 
+    def _construct_transform_x_to_z(self):
+        """
+        Construct theano function to compute posterior means for some inputs.
+        """
+        func = cached_function([self.q_z_given_x.Xd], \
+                outputs=self.q_z_given_x.output_mean, \
+                tag='OneStageModel.transform_x_to_z', key_info=self.params)
+        return func
+
+    def _construct_transform_z_to_x(self):
+        """
+        Construct theano function to compute the (transformed) output means
+        of the generator for some latent points.
+        """
+        func = cached_function([self.p_x_given_z.Xd], \
+                outputs=self.xt_transform(self.p_x_given_z.output_mean), \
+                tag='OneStageModel.transform_z_to_x', key_info=self.params)
+        return func
+
+    # auxiliary functions, which are compiled on first use
+    fe_chunk = lazy_function(_construct_fe_chunk, 'fe_chunk')
+    compute_fe_terms = lazy_function(_construct_compute_fe_terms, \
+                                     'compute_fe_terms')
+    compute_post_klds = lazy_function(_construct_compute_post_klds, \
+                                      'compute_post_klds')
+    sample_from_prior = lazy_function(_construct_sample_from_prior, \
+                                      'sample_from_prior')
+    transform_x_to_z = lazy_function(_construct_transform_x_to_z, \
+                                     'transform_x_to_z')
+    transform_z_to_x = lazy_function(_construct_transform_z_to_x, \
+                                     'transform_z_to_x')
+
     def sample_from_chain(self, X_d, X_c=None, X_m=None, loop_iters=5, \
             sigma_scale=None):
         """
@@ -423,30 +480,26 @@ class OneStageModel(object):
         result = {"data samples": data_samples, "prior samples": prior_samples}
         return result
 
-def compute_fe_bound(OSM, X, sample_count):
+def compute_fe_bound(OSM, X, sample_count, max_rows=None):
     """
-    Compute free-energy bound for X, in minibatches.
+    Compute free-energy bound for X, with all samples for a chunk of rows
+    drawn in one call to OSM's compiled function (see MultiSampleEval.py).
     """
-    obs_count = X.shape[0]
-    batch_size = 2000
-    X_nll = np.zeros((obs_count,))
-    X_kld = np.zeros((obs_count,))
-    batch_start = 0
-    while True:
-        batch_end = min(obs_count, batch_start+batch_size)
-        print("batch index: {0:d} --> {1:d}".format(batch_start, batch_end))
-        Xb = X[batch_start:batch_end]
-        fe_terms = OSM.compute_fe_terms(Xb, sample_count)
-        X_nll[batch_start:batch_end] = fe_terms[0].ravel()
-        X_kld[batch_start:batch_end] = fe_terms[1].ravel()
-        # advance batch bounds
-        batch_start = batch_end
-        # quit when its the right time
-        if batch_start == obs_count:
-            break
+    fe_terms = OSM.compute_fe_terms(X, sample_count, max_rows=max_rows)
+    X_nll = fe_terms[0].ravel()
+    X_kld = fe_terms[1].ravel()
     X_fe = X_nll + X_kld
     return [X_fe, X_nll, X_kld]
 
+def compute_iwae_bound(OSM, X, sample_count, max_rows=None):
+    """
+    Compute the importance-weighted bound on -log p(x) for X. This is tighter
+    than the free-energy bound, and gets tighter as sample_count grows.
+    """
+    ll_bounds = OSM.compute_ll_bounds(X, sample_count, max_rows=max_rows)
+    X_iwae = ll_bounds[1].ravel()
+    return X_iwae
+
 def collect_obs_costs(batch_costs, batch_reps):
     """
     Collect per-observation costs from a cost vector containing the cost for
@@ -7,6 +7,7 @@ import numpy.random as npr
 import theano
 import theano.tensor as T
 import cPickle
+from Checkpoints import save_checkpoint, load_checkpoint, is_checkpoint
 #from theano.tensor.shared_randomstreams import RandomStreams as RandStream
 from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 
@@ -417,28 +418,22 @@ class PeaNet(object):
                     shared_param_dicts=self.shared_param_dicts)
         return clone_net
 
-    def save_to_file(self, f_name=None):
+    def save_to_file(self, f_name=None, async_save=True):
         """
-        Dump important stuff to a Python pickle, so that we can reload this
-        model later. We'll pickle everything required to create a clone of
-        this model given the pickle and the rng/Xd params to the cloning
-        function: "PeaNet.shared_param_clone()".
+        Dump important stuff to a checkpoint file (see Checkpoints.py), so
+        that we can reload this model later. We'll save everything required
+        to create a clone of this model given the file and the rng/Xd params
+        to the cloning function: "PeaNet.shared_param_clone()".
+
+        The parameter values are snapshotted before this returns, but if
+        async_save is True the file is written on a background thread.
         """
         assert(not (f_name is None))
-        f_handle = file(f_name, 'wb')
-        # dump the dict self.params, which just holds "simple" python values
-        cPickle.dump(self.params, f_handle, protocol=-1)
-        # make a copy of self.shared_param_dicts, with numpy arrays in place
-        # of the theano shared variables
-        numpy_param_dicts = []
-        for shared_dict in self.shared_param_dicts:
-            numpy_dict = {}
-            for key in shared_dict:
-                numpy_dict[key] = shared_dict[key].get_value(borrow=False)
-            numpy_param_dicts.append(numpy_dict)
-        # dump the numpy version of self.shared_param_dicts
-        cPickle.dump(numpy_param_dicts, f_handle, protocol=-1)
-        f_handle.close()
+        # self.params just holds "simple" python values
+        meta = {'params': self.params}
+        save_checkpoint(f_name, 'PeaNet', meta, \
+                        {'layers': self.shared_param_dicts}, \
+                        async_save=async_save)
         return
 
 def load_peanet_from_file(f_name=None, rng=None, Xd=None):
@@ -446,15 +441,24 @@ def load_peanet_from_file(f_name=None, rng=None, Xd=None):
     Load a clone of some previously trained model.
     """
     assert(not (f_name is None))
-    pickle_file = open(f_name)
-    self_dot_params = cPickle.load(pickle_file)
-    self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+    if is_checkpoint(f_name):
+        meta, param_groups = load_checkpoint(f_name, 'PeaNet')
+        self_dot_params = meta['params']
+        self_dot_numpy_param_dicts = param_groups['layers']
+    else:
+        # old-style sequential pickle file
+        pickle_file = open(f_name)
+        self_dot_params = cPickle.load(pickle_file)
+        self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+        pickle_file.close()
     self_dot_shared_param_dicts = []
     for numpy_dict in self_dot_numpy_param_dicts:
         shared_dict = {}
         for key in numpy_dict:
-            val = numpy_dict[key].astype(theano.config.floatX)
-            shared_dict[key] = theano.shared(val)
+            val = numpy_dict[key]
+            if val.dtype != theano.config.floatX:
+                val = val.astype(theano.config.floatX)
+            shared_dict[key] = theano.shared(val, borrow=True)
         self_dot_shared_param_dicts.append(shared_dict)
     # now, create a PeaNet with the configuration we just unpickled
     clone_net = PeaNet(rng=rng, Xd=Xd, params=self_dot_params, \
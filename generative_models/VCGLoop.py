@@ -21,6 +21,7 @@ from NetLayers import HiddenLayer, DiscLayer, softplus_actfun, \
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
 from DKCode import get_adam_updates, get_adadelta_updates
 from OneStageModel import OneStageModel
+from FunctionCache import cached_function, print_cache_report
 
 #############################
 # SOME HANDY LOSS FUNCTIONS #
@@ -341,6 +342,7 @@ class VCGLoop(object):
 
         # construct the function for training on training data
         self.train_joint = self._construct_train_joint()
+        print_cache_report()
         return
 
     def set_dn_sgd_params(self, learn_rate=0.01):
@@ -629,12 +631,13 @@ class VCGLoop(object):
         outputs = [self.joint_cost, self.chain_nll_cost, self.chain_kld_cost, \
                 self.mask_nll_cost, self.mask_kld_cost, self.disc_cost_gn, \
                 self.disc_cost_dn, self.other_reg_cost]
-        func = theano.function(inputs=[ xd, xc, xm, xt, batch_reps ], \
+        func = cached_function(inputs=[ xd, xc, xm, xt, batch_reps ], \
                 outputs=outputs, updates=self.joint_updates, \
                 givens={ self.Xd: xd.repeat(batch_reps, axis=0), \
                          self.Xc: xc.repeat(batch_reps, axis=0), \
                          self.Xm: xm.repeat(batch_reps, axis=0), \
-                         self.Xt: xt })
+                         self.Xt: xt }, \
+                tag='VCGLoop.train_joint', key_info=self.params)
         return func
 
     def sample_from_chain(self, X_d, X_c=None, X_m=None, loop_iters=5, \
@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+import numpy.random as npr
+
+#
+# The train() loops in NLModels.py used to draw each minibatch on the main
+# thread, right before running the (GIL-free) training kernels on it. A
+# BatchProducer instead draws minibatches on a background thread, into a ring
+# of pre-allocated buffers, so that sampling for the next few batches overlaps
+# with training on the current one.
+#
+# What gets sampled is described by a "batch source", which has two methods:
+#
+#   alloc(batch_size): return a list of arrays that can hold one minibatch
+#   fill(bufs, rng): draw a minibatch into the arrays in bufs, using only the
+#                    numpy RandomState rng for randomness
+#
+# Each producer has its own RandomState, and the ring hands out buffers in
+# the order they were filled, so the sequence of minibatches depends only on
+# the seed (and not on the prefetch depth or on thread timing).
+#
+
+class BatchProducer(object):
+    """
+    Draw batch_count minibatches from source, up to depth batches ahead of
+    the consumer. Iterating over the producer yields each minibatch as the
+    list of arrays returned by source.alloc(). These arrays are reused, so a
+    minibatch is only valid until the next one is requested.
+
+    If depth is 0, minibatches are drawn on the calling thread as they are
+    requested. If seed is None, a seed is drawn from numpy.random.
+    """
+    def __init__(self, source, batch_size, batch_count, depth=2, seed=None):
+        assert(depth >= 0)
+        if seed is None:
+            seed = npr.randint(0, high=2**31 - 1)
+        self.source = source
+        self.batch_size = batch_size
+        self.batch_count = batch_count
+        self.depth = depth
+        self.rng = npr.RandomState(seed)
+        # the consumer holds one buffer while the producer fills the others
+        self.bufs = [source.alloc(batch_size) for i in range(depth + 1)]
+        self.free_queue = Queue()
+        self.full_queue = Queue()
+        self.held_slot = None
+        self.stopped = False
+        self.thread = None
+        if depth > 0:
+            for slot in range(depth + 1):
+                self.free_queue.put(slot)
+            self.thread = threading.Thread(target=self._produce)
+            self.thread.daemon = True
+            self.thread.start()
+        return
+
+    def _produce(self):
+        """Main loop for the producer thread."""
+        for b in range(self.batch_count):
+            slot = self.free_queue.get()
+            if (slot is None) or self.stopped:
+                break
+            try:
+                self.source.fill(self.bufs[slot], self.rng)
+            except Exception as e:
+                self.full_queue.put((None, e))
+                break
+            self.full_queue.put((slot, None))
+        return
+
+    def next_batch(self):
+        """Get the next minibatch, releasing the previous one for reuse."""
+        if self.depth == 0:
+            self.source.fill(self.bufs[0], self.rng)
+            return self.bufs[0]
+        if not (self.held_slot is None):
+            self.free_queue.put(self.held_slot)
+            self.held_slot = None
+        slot, error = self.full_queue.get()
+        if not (error is None):
+            raise error
+        self.held_slot = slot
+        return self.bufs[slot]
+
+    def close(self):
+        """Stop the producer thread, if it's still running."""
+        self.stopped = True
+        if not (self.thread is None):
+            self.free_queue.put(None)
+            self.thread.join()
+            self.thread = None
+        return
+
+    def __iter__(self):
+        try:
+            for b in range(self.batch_count):
+                yield self.next_batch()
+        finally:
+            self.close()
+        return
+
+class PairSource(object):
+    """
+    Batch source for anchor/context word pairs from a PhraseSampler, plus
+    (optionally) negative samples from a NegSampler.
+
+    Minibatches are [anc_keys, pos_keys, phrase_keys, neg_keys] when using a
+    NegSampler, and [anc_keys, pos_keys, phrase_keys] otherwise (e.g. when
+    predicting the context words with an HSMLayer, which looks up the codes
+    for pos_keys itself).
+    """
+    def __init__(self, pos_sampler, neg_sampler=None):
+        self.pos_sampler = pos_sampler
+        self.neg_sampler = neg_sampler
+        return
+
+    def alloc(self, batch_size):
+        bufs = [np.zeros((batch_size,), dtype=np.uint32) for i in range(3)]
+        if not (self.neg_sampler is None):
+            neg_count = self.neg_sampler.neg_count
+            bufs.append(np.zeros((batch_size, neg_count), dtype=np.uint32))
+        return bufs
+
+    def fill(self, bufs, rng):
+        batch_size = bufs[0].shape[0]
+        anc_keys, pos_keys, phrase_keys = \
+                self.pos_sampler.sample_pairs(batch_size, rng=rng)
+        bufs[0][:] = anc_keys
+        bufs[1][:] = pos_keys
+        bufs[2][:] = phrase_keys
+        if not (self.neg_sampler is None):
+            bufs[3][:] = self.neg_sampler.sample(batch_size, rng=rng)
+        return
+
+class NGramSource(object):
+    """
+    Batch source for n-grams from a PhraseSampler.
+
+    Minibatches are [pre_keys, post_keys, phrase_keys], where pre_keys holds
+    the first (gram_n - 1) words of each n-gram and post_keys holds the last.
+    """
+    def __init__(self, ngram_sampler, gram_n, pad_key):
+        self.ngram_sampler = ngram_sampler
+        self.gram_n = gram_n
+        self.pad_key = pad_key
+        return
+
+    def alloc(self, batch_size):
+        bufs = [np.zeros((batch_size, self.gram_n-1), dtype=np.uint32), \
+                np.zeros((batch_size,), dtype=np.uint32), \
+                np.zeros((batch_size,), dtype=np.uint32)]
+        return bufs
+
+    def fill(self, bufs, rng):
+        batch_size = bufs[0].shape[0]
+        seq_keys, phrase_keys = self.ngram_sampler.sample_ngrams(batch_size, \
+                gram_n=self.gram_n, pad_key=self.pad_key, rng=rng)
+        bufs[0][:] = seq_keys[:,0:-1]
+        bufs[1][:] = seq_keys[:,-1]
+        bufs[2][:] = phrase_keys
+        return
+
+
+##############
+# EYE BUFFER #
+##############
@@ -11,10 +11,10 @@
 
 import os
 import sys
-import heapq
 import time
 import random
 import itertools
+import multiprocessing
 try:
     from queue import Queue
 except ImportError:
@@ -24,7 +24,7 @@ import numpy as np
 import numpy.random as npr
 import numba
 
-from six import iteritems, itervalues
+from six import iteritems, iterkeys, itervalues
 from six.moves import xrange
 
 MAX_HSM_KEY = 12345678
@@ -43,11 +43,15 @@ class SentenceFileIterator(object):
         self.dirname = dirname
         return
 
+    def file_paths(self):
+        """Get the paths of the text files that this iterator reads."""
+        return [os.path.join(self.dirname, fname) for fname in \
+                sorted(os.listdir(self.dirname)) if (fname.find('.txt') > -1)]
+
     def __iter__(self):
-        for fname in os.listdir(self.dirname):
-            if fname.find('.txt') > -1:
-                for line in open(os.path.join(self.dirname, fname)):
-                    yield line.split()
+        for fpath in self.file_paths():
+            for line in open(fpath):
+                yield line.split()
 
 class Vocab(object):
     """
@@ -68,28 +72,98 @@ class Vocab(object):
         vals = ['%s:%r' % (key, self.__dict__[key]) for key in sorted(self.__dict__) if not key.startswith('_')]
         return "<" + ', '.join(vals) + ">"
 
-def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
-                compute_ns_table=True, down_sample=0.0):
+def _count_words(sentences, max_vocab_size=None, verbose=True):
     """
-    Build vocabulary from a sequence of sentences (can be a once-only generator stream).
-    Each sentence must be an iterable sequence of hashable objects.
+    Count the occurrences of each word in sentences. If max_vocab_size is
+    given, low-count words are pruned whenever the number of distinct words
+    grows past max_vocab_size, as with min_reduce in word2vec. Each pruning
+    pass drops all words whose (partial) count is at most min_reduce, and
+    then increments min_reduce.
+
+    Returns [word_counts, total_words, sentence_count, pruned_count], where
+    pruned_count is the total count of all pruned words.
     """
-    # scan the given corpus of sentences and count the occurrences of each word
-    sentence_no = -1
-    raw_vocab = {}
+    word_counts = {}
     total_words = 0
+    pruned_count = 0
+    min_reduce = 1
+    sentence_no = -1
     for sentence_no, sentence in enumerate(sentences):
-        if sentence_no % 10000 == 0:
+        if verbose and ((sentence_no % 10000) == 0):
             print("PROGRESS: at sentence #%i, processed %i words and %i word types" % \
-                (sentence_no, total_words, len(raw_vocab)))
+                (sentence_no, total_words, len(word_counts)))
+        total_words += len(sentence)
         for word in sentence:
-            total_words += 1
-            if word in raw_vocab:
-                raw_vocab[word].count += 1
-            else:
-                raw_vocab[word] = Vocab(count=1)
+            word_counts[word] = word_counts.get(word, 0) + 1
+        if (not (max_vocab_size is None)) and (len(word_counts) > max_vocab_size):
+            pruned_count += _prune_counts(word_counts, min_reduce)
+            min_reduce += 1
+    return [word_counts, total_words, sentence_no + 1, pruned_count]
+
+def _prune_counts(word_counts, min_reduce):
+    """Drop words with count <= min_reduce, and return their total count."""
+    pruned_count = 0
+    for word in [w for (w, c) in iteritems(word_counts) if (c <= min_reduce)]:
+        # *UNK* collects the pruned counts, so never prune it
+        if not (word == '*UNK*'):
+            pruned_count += word_counts.pop(word)
+    return pruned_count
+
+def _count_files(args):
+    """Count words in a list of files. Runs in a worker process."""
+    file_paths, max_vocab_size = args
+    def file_lines():
+        for fpath in file_paths:
+            for line in open(fpath):
+                yield line.split()
+    return _count_words(file_lines(), max_vocab_size=max_vocab_size, \
+                        verbose=False)
+
+def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
+                compute_ns_table=True, down_sample=0.0, workers=1, \
+                max_vocab_size=None):
+    """
+    Build vocabulary from a sequence of sentences (can be a once-only generator stream).
+    Each sentence must be an iterable sequence of hashable objects.
+
+    If workers > 1, sentences must be a SentenceFileIterator (or anything
+    else with a file_paths() method). Its files will be split across worker
+    processes, which count words in parallel, and the counts will be merged.
+
+    If max_vocab_size is given, rare words are pruned while counting (see
+    _count_words()), so that memory use stays bounded on huge corpora. The
+    counts of pruned words go to *UNK*.
+    """
+    # scan the given corpus of sentences and count the occurrences of each word
+    if (workers > 1):
+        file_paths = sentences.file_paths()
+        shard_args = [(file_paths[i::workers], max_vocab_size) \
+                      for i in range(workers)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            shard_counts = pool.map(_count_files, shard_args)
+        finally:
+            pool.close()
+            pool.join()
+        # merge the counts from each worker, pruning the merged counts if
+        # required to keep the vocabulary size bounded
+        raw_counts, total_words, sentence_count, pruned_count = shard_counts[0]
+        for (w_counts, w_total, w_sentences, w_pruned) in shard_counts[1:]:
+            for (word, c) in iteritems(w_counts):
+                raw_counts[word] = raw_counts.get(word, 0) + c
+            total_words += w_total
+            sentence_count += w_sentences
+            pruned_count += w_pruned
+        if not (max_vocab_size is None):
+            min_reduce = 1
+            while (len(raw_counts) > max_vocab_size):
+                pruned_count += _prune_counts(raw_counts, min_reduce)
+                min_reduce += 1
+    else:
+        raw_counts, total_words, sentence_count, pruned_count = \
+                _count_words(sentences, max_vocab_size=max_vocab_size)
     print("collected %i word types from a corpus of %i words and %i sentences" % \
-        (len(raw_vocab), total_words, sentence_no + 1))
+        (len(raw_counts), total_words, sentence_count))
 
     # assign a unique index to each sufficiently frequent word
     #
@@ -99,34 +173,53 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     # threshold will be treated as if "converted" to *UNK*. The total frequency
     # for *UNK* will thus be the frequency of the "raw" token *UNK* in the
     # source text plus the summed frequencies of all words in the source text
-    # that do not meet the frequency threshold on their own. If *UNK* was not
-    # present in the source text as a raw token, it will be added to the vocab
-    # and will collect the frequencies of all dropped words.
+    # that do not meet the frequency threshold on their own (or that were
+    # pruned while counting). If *UNK* was not present in the source text as
+    # a raw token, it will be added to the vocab and will collect the
+    # frequencies of all dropped words.
+    #
+    # Words get keys in order of decreasing count (ties broken by the word
+    # itself), so the keys don't depend on dict ordering or on the number of
+    # workers used for counting.
     words_to_vocabs, words_to_keys, keys_to_words = {}, {}, {}
-    idx = 0
-    unk_count = 0
-    for word, v in iteritems(raw_vocab):
-        if ((v.count >= min_count) or (word == '*UNK*')):
+    unk_count = pruned_count
+    kept_words = []
+    for (word, c) in iteritems(raw_counts):
+        if ((c >= min_count) or (word == '*UNK*')):
             # this word meets the frequency threshold or is *UNK*
-            v.index = idx
-            words_to_vocabs[word] = v
-            words_to_keys[word] = idx
-            keys_to_words[idx] = word
-            idx += 1
+            kept_words.append((-c, word))
         else:
             # collect count for a word that will become *UNK*
-            unk_count += v.count
-    if '*UNK*' in raw_vocab:
+            unk_count += c
+    kept_words.sort()
+    for (idx, (neg_c, word)) in enumerate(kept_words):
+        words_to_vocabs[word] = Vocab(count=-neg_c, index=idx)
+        words_to_keys[word] = idx
+        keys_to_words[idx] = word
+    if '*UNK*' in words_to_vocabs:
         # *UNK* must have been processed in the above loop
         words_to_vocabs['*UNK*'].count += unk_count
     else:
         # *UNK* was not processed by the above loop, so add it now
+        idx = len(kept_words)
         words_to_vocabs['*UNK*'] = Vocab(count=unk_count, index=idx)
         words_to_keys['*UNK*'] = idx
         keys_to_words[idx] = '*UNK*'
     print("total %i word types after removing those with count<%s" % \
         (len(words_to_vocabs), min_count))
+    result = _finish_vocab(words_to_vocabs, words_to_keys, keys_to_words, \
+            compute_hs_tree=compute_hs_tree, \
+            compute_ns_table=compute_ns_table, down_sample=down_sample)
+    return result
+
+def _finish_vocab(words_to_vocabs, words_to_keys, keys_to_words, \
+                  compute_hs_tree=True, compute_ns_table=True, down_sample=0.0):
+    """
+    Compute downsampling probs, HSM codes, and the negative sampling table
+    for a vocabulary whose words have already been assigned LUT keys.
 
+    Called from `build_vocab()` and `FlatCorpus.key_dicts()`.
+    """
     # precalculate downsampling thresholds, which are written into the vocab
     # objects in words_to_vocabs
     _precalc_downsampling(words_to_vocabs, down_sample=down_sample)
@@ -148,12 +241,14 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #   unk_word: the textish representation that stands in for words that
     #             aren't included in the "trained" vocabulary
     #
-    #   ns_table: a large list of word LUT keys such that sampling keys
-    #             uniformly at random from the list samples the keys nearly in
-    #             proportion to the frequency of their corresponding words
+    #   keys_to_probs: array giving the downsampling retention probability
+    #                  (i.e. Vocab.sample_prob) for each word LUT key
+    #
+    #   ns_table: an AliasTable over word LUT keys, which samples each key in
+    #             proportion to its corresponding word's count**0.75
     #
-    #   hs_tree: dict containing containing three items: 'keys_to_code_keys',
-    #            'keys_to_code_signs', and 'max_code_key'.
+    #   hs_tree: dict containing containing four items: 'keys_to_code_keys',
+    #            'keys_to_code_signs', 'max_code_key', and 'csr_codes'.
     #     keys_to_code_keys: this maps word LUT keys to their corresponding
     #                        sequence of keys into a LUT containing HSM code
     #                        vectors. 
@@ -161,6 +256,8 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #                         predictions (i.e. +/- 1) for each HSM code.
     #     max_code_key: the maximum key required by the HSM codes recorded in
     #                   keys_to_code_keys.
+    #     csr_codes: the same codes in variable-length form, as a list
+    #                [code_offsets, flat_keys, flat_signs] (see csr_codes()).
     #
     #     NOTE: All HSM code keys/signs are stored in a key/sign matrix, so all
     #           codes have the same length, in some sense. However, to be most
@@ -169,12 +266,14 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #           Unused entries in the key matrix are set to > MAX_HSM_KEY, and
     #           unused entries in the sign matrix are set to 0. This lets us
     #           use the "fixed-length" codes just like variable-length codes.
+    #           HSMLayer uses csr_codes, which skips the unused entries.
     #                            
     result = {}
     result['words_to_vocabs'] = words_to_vocabs
     result['words_to_keys'] = words_to_keys
     result['keys_to_words'] = keys_to_words
     result['unk_word'] = '*UNK*'
+    result['keys_to_probs'] = _key_sample_probs(words_to_vocabs, words_to_keys)
     result['hs_tree'] = None
     result['ns_table'] = None
     if compute_hs_tree:
@@ -185,6 +284,62 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
                 words_to_keys)
     return result
 
+def extend_vocab(key_dicts, sentences, min_count=5, down_sample=0.0, \
+                 max_vocab_size=None):
+    """
+    Extend a vocabulary from build_vocab() with the words in some new
+    sentences, updating key_dicts in place (and returning it).
+
+    Counts for words already in the vocabulary are increased, and new words
+    that occur at least min_count times in the new sentences get the next
+    unused LUT keys (in order of decreasing count), so the keys of existing
+    words never change. Counts for the other new words go to *UNK*. Then,
+    the downsampling probs and the negative sampling table are recomputed
+    from the updated counts. This takes a pass over the vocabulary, but not
+    over the text it was built from.
+
+    The HSM codes can't be extended without changing the codes of existing
+    words, so 'hs_tree' is set to None. A model trained with the old vocab
+    can be grown to fit the new one, e.g. with W2VModel.grow_vocab().
+    """
+    words_to_vocabs = key_dicts['words_to_vocabs']
+    words_to_keys = key_dicts['words_to_keys']
+    keys_to_words = key_dicts['keys_to_words']
+    unk_word = key_dicts['unk_word']
+    raw_counts, total_words, sentence_count, pruned_count = \
+            _count_words(sentences, max_vocab_size=max_vocab_size)
+    print("collected %i word types from %i new words and %i new sentences" % \
+        (len(raw_counts), total_words, sentence_count))
+    # add counts for known words, and pick out the new words to keep
+    unk_count = pruned_count
+    new_words = []
+    for (word, c) in iteritems(raw_counts):
+        if word in words_to_vocabs:
+            words_to_vocabs[word].count += c
+        elif (c >= min_count):
+            new_words.append((-c, word))
+        else:
+            unk_count += c
+    words_to_vocabs[unk_word].count += unk_count
+    # new words get keys after all existing keys, as in build_vocab()
+    new_words.sort()
+    next_key = max(iterkeys(keys_to_words)) + 1
+    for (idx, (neg_c, word)) in enumerate(new_words):
+        words_to_vocabs[word] = Vocab(count=-neg_c, index=(next_key + idx))
+        words_to_keys[word] = next_key + idx
+        keys_to_words[next_key + idx] = word
+    print("added %i word types with count>=%s, for %i in total" % \
+        (len(new_words), min_count, len(words_to_vocabs)))
+    # recompute everything that depends on the counts
+    _precalc_downsampling(words_to_vocabs, down_sample=down_sample)
+    key_dicts['keys_to_probs'] = _key_sample_probs(words_to_vocabs, \
+            words_to_keys)
+    if not (key_dicts['ns_table'] is None):
+        key_dicts['ns_table'] = _make_table(words_to_vocabs, keys_to_words, \
+                words_to_keys)
+    key_dicts['hs_tree'] = None
+    return key_dicts
+
 def _precalc_downsampling(w2v, down_sample=0.0):
     """
     Precalculate each vocabulary item's retention probability.
@@ -196,93 +351,156 @@ def _precalc_downsampling(w2v, down_sample=0.0):
     total_words = sum([v.count for v in itervalues(w2v)])
     for v in itervalues(w2v):
         prob = 1.0
-        if sample:
-            prob = np.sqrt(down_sample / (v.count / total_words))
+        if sample and (v.count > 0):
+            # words with zero count (e.g. an *UNK* that never got used) are
+            # never drawn, so their retention probability doesn't matter
+            prob = np.sqrt(down_sample / (float(v.count) / total_words))
         v.sample_prob = min(prob, 1.0)
     return
 
-def _make_table(w2v, k2w, w2k, table_size=20000000, power=0.75):
+def _key_sample_probs(w2v, w2k):
+    """
+    Gather the retention probability computed by `_precalc_downsampling()`
+    for each word into an array indexed by word LUT key.
+    """
+    probs = np.ones((max(itervalues(w2k)) + 1,), dtype=np.float64)
+    for (w, k) in iteritems(w2k):
+        probs[k] = w2v[w].sample_prob
+    return probs
+
+def _make_table(w2v, k2w, w2k, power=0.75):
     """
-    Create a table using stored vocabulary word counts for drawing random words
-    in parts of training based on 'negative sampling'.
+    Create an alias table using stored vocabulary word counts for drawing
+    random words in parts of training based on 'negative sampling'.
 
     Called from `build_vocab()`.
     """
-    # table (= list of words) of noise distribution for negative sampling
+    # word LUT keys run from 0 to vocab_size-1, and key k is drawn with
+    # probability proportional to (count of word k)**power
     vocab_size = len(k2w)
-    table = np.zeros((table_size,), dtype=np.uint32)
-
-    # compute sum of all power (Z in paper)
-    power_sum = float(sum([w2v[word].count**power for word in w2v]))
-    # go through the whole table and fill it up with the word indexes proportional to a word's count**power
-    widx = 0
-    # normalize count^0.75 by Z
-    d1 = w2v[k2w[widx]].count**power / power_sum
-    for tidx in xrange(table_size):
-        table[tidx] = widx
-        if ((float(tidx) / table_size) > d1):
-            widx += 1
-            d1 += w2v[k2w[widx]].count**power / power_sum
-        if widx >= vocab_size:
-            widx = vocab_size - 1
-    return table.astype(np.uint32)
-
+    counts = np.asarray([w2v[k2w[k]].count for k in range(vocab_size)], \
+                        dtype=np.float64)
+    return AliasTable(counts**power)
+
+
+@numba.jit("i8(i8[:], i8[:], i1[:], i8[:])", nopython=True)
+def fast_huffman_tree(counts, parent, binary, depth):
+    # build a Huffman tree over n leaves, with counts sorted in decreasing
+    # order, using the two-queue method from word2vec. nodes 0...(n-1) are
+    # the leaves and nodes n...(2n-2) are the inner nodes, in order of
+    # creation, so the root is node 2n-2 and each node's parent has a higher
+    # index than the node. returns the depth of the deepest leaf.
+    n = counts.size
+    node_counts = np.zeros((2*n - 1,), dtype=np.int64)
+    for i in range(n):
+        node_counts[i] = counts[i]
+    pos1 = n - 1 # next unused leaf (leaves are used from the rarest)
+    pos2 = n     # next unused inner node
+    for a in range(n - 1):
+        # find the two nodes with the smallest counts
+        if ((pos1 >= 0) and ((pos2 >= (n + a)) or \
+                (node_counts[pos1] < node_counts[pos2]))):
+            min1 = pos1
+            pos1 -= 1
+        else:
+            min1 = pos2
+            pos2 += 1
+        if ((pos1 >= 0) and ((pos2 >= (n + a)) or \
+                (node_counts[pos1] < node_counts[pos2]))):
+            min2 = pos1
+            pos1 -= 1
+        else:
+            min2 = pos2
+            pos2 += 1
+        node_counts[n + a] = node_counts[min1] + node_counts[min2]
+        parent[min1] = n + a
+        parent[min2] = n + a
+        binary[min1] = 0
+        binary[min2] = 1
+    # compute node depths from the root down
+    max_depth = 0
+    depth[2*n - 2] = 0
+    for i in range(2*n - 3, -1, -1):
+        depth[i] = depth[parent[i]] + 1
+        if ((i < n) and (depth[i] > max_depth)):
+            max_depth = depth[i]
+    return max_depth
+
+@numba.jit("void(i8[:], i1[:], i8[:], u4[:,:], f4[:,:])", nopython=True)
+def fast_huffman_codes(parent, binary, depth, code_keys, code_signs):
+    # write the code for each leaf, from the root down, into code_keys and
+    # code_signs. a code key is the index of an inner node minus n (i.e. the
+    # number of leaves), and the sign is -1/+1 for the left/right child.
+    n = code_keys.shape[0]
+    for i in range(n):
+        node = i
+        for j in range(depth[i] - 1, -1, -1):
+            code_keys[i,j] = parent[node] - n
+            if (binary[node] == 1):
+                code_signs[i,j] = 1.0
+            else:
+                code_signs[i,j] = -1.0
+            node = parent[node]
+    return
 
 def _create_binary_tree(w2v):
     """
     Create a binary Huffman tree using stored vocabulary word counts. Frequent words
     will have shorter binary codes. Called internally from `build_vocab()`.
 
-    The codes (presumably for use in a Hierarchical Softmax Layer) are stored
-    directly into the Vocab ojects that are the values in the dict param 'w2v'.
-    """
-    # build the huffman tree
-    heap = list(itervalues(w2v))
-    heapq.heapify(heap)
-    for i in xrange(len(w2v) - 1):
-        min1, min2 = heapq.heappop(heap), heapq.heappop(heap)
-        heapq.heappush(heap, Vocab(count=(min1.count + min2.count), \
-                index=(i + len(w2v)), left=min1, right=min2))
-    # recurse over the tree, assigning a binary code to each vocabulary word
-    key_dict = {} # map from word LUT keys to HSM code keys
-    sign_dict = {} # map from word LUT keys to HSM code signs
-    if heap:
-        stack = [(heap[0], [], [])]
-        while stack:
-            node, signs, keys = stack.pop()
-            if node.index < len(w2v):
-                # leaf node => store its path from the root
-                key_dict[node.index] = keys
-                sign_dict[node.index] = signs
-            else:
-                # inner node => continue recursion
-                keys = np.array(list(keys) + [node.index - len(w2v)], dtype=np.uint32)
-                stack.append((node.left, np.array(list(signs) + [-1.0], dtype=np.float32), keys))
-                stack.append((node.right, np.array(list(signs) + [1.0], dtype=np.float32), keys))
-    # get the max code length and maximum word LUT key
-    max_code_len = np.max(np.array([v.size for v in key_dict.values()]))
-    max_word_key = np.max(np.array([k for k in key_dict.keys()]))
-    # extend all v.codes/v.points to the same size
-    max_code_key =0
-    code_keys = np.zeros((max_word_key+1, max_code_len), dtype=np.uint32)
-    code_signs = np.zeros((max_word_key+1, max_code_len), dtype=np.float32)
-    for k in key_dict.keys():
-        c_len = key_dict[k].size
-        for j in range(max_code_len):
-            if (j >= c_len):
-                code_keys[k,j] = MAX_HSM_KEY + 1
-            else:
-                code_keys[k,j] = key_dict[k][j]
-                code_signs[k,j] = sign_dict[k][j]
-                if (code_keys[k,j] > max_code_key):
-                    max_code_key = code_keys[k,j]
-    # record hsm code keys and signs for returnage
+    The tree is built in flat arrays (parent, binary, depth), indexed by
+    position in the list of words sorted by decreasing count, rather than
+    from a heap of Vocab objects.
+    """
+    # gather the counts for all words by their LUT keys
+    word_count = max([v.index for v in itervalues(w2v)]) + 1
+    assert(word_count >= 2)
+    counts = np.zeros((word_count,), dtype=np.int64)
+    for v in itervalues(w2v):
+        counts[v.index] = v.count
+    order = np.argsort(-counts, kind='mergesort')
+    # build the tree over the sorted counts
+    parent = np.zeros((2*word_count - 1,), dtype=np.int64)
+    binary = np.zeros((2*word_count - 1,), dtype=np.int8)
+    depth = np.zeros((2*word_count - 1,), dtype=np.int64)
+    max_code_len = fast_huffman_tree(counts[order], parent, binary, depth)
+    # unused entries in the key matrix are set to > MAX_HSM_KEY, and unused
+    # entries in the sign matrix are set to 0
+    sorted_keys = (MAX_HSM_KEY + 1) * \
+            np.ones((word_count, max_code_len), dtype=np.uint32)
+    sorted_signs = np.zeros((word_count, max_code_len), dtype=np.float32)
+    fast_huffman_codes(parent, binary, depth, sorted_keys, sorted_signs)
+    # put the codes back in LUT key order
+    code_keys = np.zeros((word_count, max_code_len), dtype=np.uint32)
+    code_signs = np.zeros((word_count, max_code_len), dtype=np.float32)
+    code_keys[order] = sorted_keys
+    code_signs[order] = sorted_signs
+    # record hsm code keys and signs for returnage (the root has the largest
+    # code key, which all codes start with)
     hsm_tree = {}
-    hsm_tree['keys_to_code_keys'] = code_keys.astype(np.uint32)
-    hsm_tree['keys_to_code_signs'] = code_signs.astype(np.float32)
-    hsm_tree['max_code_key'] = max_code_key
+    hsm_tree['keys_to_code_keys'] = code_keys
+    hsm_tree['keys_to_code_signs'] = code_signs
+    hsm_tree['max_code_key'] = word_count - 2
+    hsm_tree['csr_codes'] = csr_codes(code_keys, code_signs)
     return hsm_tree
 
+def csr_codes(code_keys, code_signs):
+    """
+    Convert padded HSM code key/sign matrices (like 'keys_to_code_keys' and
+    'keys_to_code_signs') into [code_offsets, flat_keys, flat_signs], where
+    the code for the word with LUT key k is flat_keys[code_offsets[k]:
+    code_offsets[k+1]] (and likewise for its signs). This is the form taken
+    by HSMLayer.ff_bp().
+    """
+    valid = (code_keys <= MAX_HSM_KEY)
+    code_offsets = np.zeros((code_keys.shape[0] + 1,), dtype=np.int64)
+    code_offsets[1:] = np.cumsum(np.sum(valid, axis=1))
+    # valid entries are gathered row by row, and each code is a prefix of
+    # its row, so the flat codes keep their order
+    flat_keys = code_keys[valid].astype(np.uint32)
+    flat_signs = code_signs[valid].astype(np.float32)
+    return [code_offsets, flat_keys, flat_signs]
+
 def sample_phrases(text_stream, words_to_keys, unk_word='*UNK*', \
                     max_phrases=100000):
     phrases = []
@@ -298,55 +516,365 @@ def sample_phrases(text_stream, words_to_keys, unk_word='*UNK*', \
             break
     return phrases
 
+########################################
+# COMPILED (FLAT, MEMMAPPABLE) CORPORA #
+########################################
+
+class FlatCorpus(object):
+    """
+    A corpus of phrases stored as a single flat array of LUT keys.
+
+    The keys for phrase i are tokens[offsets[i]:offsets[i+1]]. A FlatCorpus
+    can be indexed and iterated like the lists of per-phrase key arrays
+    produced by sample_phrases(), but indexing returns views into tokens,
+    so no keys are copied. When loaded by load_corpus(), tokens and offsets
+    are memory-mapped from the .npy files written by compile_corpus().
+    """
+    def __init__(self, tokens, offsets, keys_to_words=None, key_counts=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.keys_to_words = keys_to_words
+        self.key_counts = key_counts
+        self.words_to_keys = None
+        if not (keys_to_words is None):
+            self.words_to_keys = {}
+            for (k, w) in iteritems(keys_to_words):
+                self.words_to_keys[w] = k
+        return
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def phrase_lens(self):
+        """Get the length of each phrase in this corpus."""
+        return np.diff(self.offsets)
+
+    def subset(self, start_idx, end_idx):
+        """Get a FlatCorpus for phrases start_idx...end_idx-1, without copying."""
+        sub_corpus = FlatCorpus(self.tokens, \
+                self.offsets[start_idx:(end_idx+1)], keys_to_words=None, \
+                key_counts=self.key_counts)
+        sub_corpus.keys_to_words = self.keys_to_words
+        sub_corpus.words_to_keys = self.words_to_keys
+        return sub_corpus
+
+    def key_dicts(self, compute_hs_tree=True, compute_ns_table=True, \
+                  down_sample=0.0, unk_word='*UNK*'):
+        """
+        Get the same dict as build_vocab() would return for this corpus's
+        vocabulary, keeping the LUT keys used in the compiled corpus. Word
+        counts come from the compiled corpus, so no text is re-read.
+        """
+        words_to_vocabs = {}
+        for (k, w) in iteritems(self.keys_to_words):
+            words_to_vocabs[w] = Vocab(count=int(self.key_counts[k]), index=k)
+        result = _finish_vocab(words_to_vocabs, self.words_to_keys, \
+                self.keys_to_words, compute_hs_tree=compute_hs_tree, \
+                compute_ns_table=compute_ns_table, down_sample=down_sample)
+        result['unk_word'] = unk_word
+        return result
+
+def compile_corpus(text_stream, words_to_keys, corpus_dir, unk_word='*UNK*', \
+                   chunk_size=1000000):
+    """
+    Tokenize text_stream once and write it to corpus_dir in the FlatCorpus
+    format, i.e. as tokens.npy (uint32 LUT keys for all phrases), offsets.npy
+    (int64 start of each phrase in tokens, plus the end of the last phrase),
+    words.npy (the word for each LUT key) and counts.npy (the number of
+    occurrences of each LUT key in tokens).
+
+    text_stream can be any iterable over lists of words, e.g. a
+    SentenceFileIterator. Keys are streamed to disk, so memory use does not
+    grow with the size of the corpus.
+    """
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    key_count = max(itervalues(words_to_keys)) + 1
+    unk_key = words_to_keys[unk_word]
+    raw_file = os.path.join(corpus_dir, 'tokens.bin')
+    key_counts = np.zeros((key_count,), dtype=np.int64)
+    phrase_lens = []
+    token_count = 0
+    buf = np.zeros((chunk_size,), dtype=np.uint32)
+    buf_len = 0
+    lens_buf = []
+    with open(raw_file, 'wb') as f:
+        for text_blob in text_stream:
+            p_keys = [words_to_keys.get(w, unk_key) for w in text_blob]
+            p_len = len(p_keys)
+            if ((buf_len + p_len) > chunk_size):
+                # flush the buffered keys to disk
+                key_counts += np.bincount(buf[0:buf_len], minlength=key_count)
+                buf[0:buf_len].tofile(f)
+                buf_len = 0
+                if (p_len > chunk_size):
+                    buf = np.zeros((p_len,), dtype=np.uint32)
+            buf[buf_len:(buf_len+p_len)] = p_keys
+            buf_len += p_len
+            token_count += p_len
+            lens_buf.append(p_len)
+            if (len(lens_buf) >= chunk_size):
+                phrase_lens.append(np.asarray(lens_buf, dtype=np.int64))
+                lens_buf = []
+        key_counts += np.bincount(buf[0:buf_len], minlength=key_count)
+        buf[0:buf_len].tofile(f)
+    phrase_lens.append(np.asarray(lens_buf, dtype=np.int64))
+    # write the phrase offsets
+    phrase_lens = np.concatenate(phrase_lens)
+    offsets = np.zeros((phrase_lens.size + 1,), dtype=np.int64)
+    np.cumsum(phrase_lens, out=offsets[1:])
+    np.save(os.path.join(corpus_dir, 'offsets.npy'), offsets)
+    # copy the raw keys into a .npy file, one chunk at a time
+    tokens = np.lib.format.open_memmap(os.path.join(corpus_dir, 'tokens.npy'), \
+            mode='w+', dtype=np.uint32, shape=(token_count,))
+    if (token_count > 0):
+        raw_tokens = np.memmap(raw_file, dtype=np.uint32, mode='r', \
+                               shape=(token_count,))
+        for s_idx in xrange(0, token_count, chunk_size):
+            e_idx = min(s_idx + chunk_size, token_count)
+            tokens[s_idx:e_idx] = raw_tokens[s_idx:e_idx]
+        del raw_tokens
+    tokens.flush()
+    del tokens
+    os.remove(raw_file)
+    # write the vocabulary and per-key counts
+    words = [''] * key_count
+    for (w, k) in iteritems(words_to_keys):
+        words[k] = w
+    np.save(os.path.join(corpus_dir, 'words.npy'), np.asarray(words))
+    np.save(os.path.join(corpus_dir, 'counts.npy'), key_counts)
+    print("compiled %i words in %i phrases into %s" % \
+        (token_count, offsets.size - 1, corpus_dir))
+    return
+
+def load_corpus(corpus_dir, mmap=True):
+    """
+    Load a FlatCorpus written by compile_corpus(). If mmap is True, the keys
+    and offsets are memory-mapped rather than read into memory.
+    """
+    mmap_mode = 'r' if mmap else None
+    tokens = np.load(os.path.join(corpus_dir, 'tokens.npy'), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(corpus_dir, 'offsets.npy'), mmap_mode=mmap_mode)
+    words = np.load(os.path.join(corpus_dir, 'words.npy'))
+    key_counts = np.load(os.path.join(corpus_dir, 'counts.npy'))
+    keys_to_words = {}
+    for (k, w) in enumerate(words):
+        if (len(w) > 0):
+            keys_to_words[k] = w.item()
+    # plain ndarray views (no copies) of the memmaps, so they can be passed
+    # straight into Numba functions
+    corpus = FlatCorpus(np.asarray(tokens), np.asarray(offsets), \
+                        keys_to_words=keys_to_words, key_counts=key_counts)
+    return corpus
+
+def flatten_phrases(phrase_list):
+    """Get (tokens, offsets) for a FlatCorpus or a list of key arrays."""
+    if isinstance(phrase_list, FlatCorpus):
+        return [phrase_list.tokens, phrase_list.offsets]
+    phrase_lens = np.asarray([p.size for p in phrase_list], dtype=np.int64)
+    offsets = np.zeros((phrase_lens.size + 1,), dtype=np.int64)
+    np.cumsum(phrase_lens, out=offsets[1:])
+    tokens = np.concatenate(phrase_list).astype(np.uint32)
+    return [tokens, offsets]
+
+#########################
+# ALIAS-METHOD SAMPLING #
+#########################
+
+@numba.jit("void(f8[:], i8[:], i8, i8[:], i8, f8[:], u4[:])")
+def fast_alias_build(scaled, small, s_count, large, l_count, prob, alias):
+    # small and large are stacks of bucket indices whose scaled weights are
+    # below/above 1, with s_count and l_count entries in use
+    while (s_count > 0) and (l_count > 0):
+        s_count -= 1
+        s = small[s_count]
+        l = large[l_count-1]
+        prob[s] = scaled[s]
+        alias[s] = l
+        # the large bucket gives up the mass needed to fill bucket s
+        scaled[l] = (scaled[l] + scaled[s]) - 1.0
+        if (scaled[l] < 1.0):
+            l_count -= 1
+            small[s_count] = l
+            s_count += 1
+    return
+
+@numba.jit("void(f8[:], u4[:], u4[:], f8[:], u4[:])", nogil=True)
+def fast_alias_draw(prob, alias, rand_bins, rand_fracs, samples):
+    for i in range(samples.size):
+        b = rand_bins[i]
+        if (rand_fracs[i] < prob[b]):
+            samples[i] = b
+        else:
+            samples[i] = alias[b]
+    return
+
+class AliasTable(object):
+    """
+    Walker/Vose alias table for drawing indices 0...(n-1) with probability
+    proportional to a given vector of n non-negative weights.
+
+    A draw picks a uniformly random bucket b, and then returns b with
+    probability prob[b] or alias[b] otherwise. So, each draw takes O(1) time
+    and the table takes O(n) memory, rather than the O(table_size) memory
+    needed by a table of repeated indices.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        assert(weights.size > 0)
+        assert(np.all(weights >= 0.0) and (np.sum(weights) > 0.0))
+        self.size = weights.size
+        scaled = weights * (self.size / np.sum(weights))
+        # every bucket starts "full" and aliased to itself, so any buckets
+        # left over at the end of fast_alias_build (which are full, up to
+        # rounding error) need no further work.
+        self.prob = np.ones((self.size,), dtype=np.float64)
+        self.alias = np.arange(self.size, dtype=np.uint32)
+        small = np.zeros((self.size,), dtype=np.int64)
+        large = np.zeros((self.size,), dtype=np.int64)
+        s_idx = np.flatnonzero(scaled < 1.0)
+        l_idx = np.flatnonzero(scaled >= 1.0)
+        small[0:s_idx.size] = s_idx
+        large[0:l_idx.size] = l_idx
+        fast_alias_build(scaled, small, s_idx.size, large, l_idx.size, \
+                         self.prob, self.alias)
+        return
+
+    def __len__(self):
+        return self.size
+
+    def probs(self):
+        """Get the (normalized) probability with which each index is drawn."""
+        p = np.bincount(self.alias, weights=(1.0 - self.prob), \
+                        minlength=self.size)
+        p = (p + self.prob) / self.size
+        return p
+
+    def sample(self, shape, rng=None):
+        """Draw an array of indices with the given shape.
+
+        Random numbers come from rng (a numpy RandomState) if it's given, and
+        from the global numpy.random state otherwise.
+        """
+        if rng is None:
+            rng = npr
+        samples = np.zeros(shape, dtype=np.uint32)
+        sample_count = samples.size
+        rand_bins = rng.randint(0, high=self.size, \
+                size=(sample_count,)).astype(np.uint32)
+        rand_fracs = rng.random_sample((sample_count,))
+        fast_alias_draw(self.prob, self.alias, rand_bins, rand_fracs, \
+                        samples.reshape((sample_count,)))
+        return samples
+
 ###################################
 # TRAINING EXAMPLE SAMPLING UTILS #
 ###################################
 
-@numba.jit("void(u4[:], i8, i8, i8, u4[:], u4[:], u4[:], u4[:])")
-def fast_pair_sample(phrase, max_window, i, repeats, anc_keys, pos_keys, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        a_idx = rand_pool[ri[0]] % phrase_len
-        ri[0] += 1
-        red_win = (rand_pool[ri[0]] % max_window) + 1
-        ri[0] += 1
-        c_min = a_idx - red_win
-        if (c_min < 0):
-            c_min = 0
-        c_max = a_idx + red_win
-        if (c_max >= phrase_len):
-            c_max = phrase_len - 1
-        c_span = c_max - c_min + 1
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = c_min + (rand_pool[ri[0]] % c_span)
-            ri[0] += 1
-        anc_keys[j] = phrase[a_idx]
-        pos_keys[j] = phrase[c_idx]
+# upper bound for random ints drawn from numpy.random
+RAND_HIGH = 2**31 - 1
+
+# constants for the 48-bit LCG used inside the batch sampling kernels (it's
+# the same generator as in the original word2vec code)
+LCG_MULT = np.uint64(25214903917)
+LCG_INC = np.uint64(11)
+LCG_MASK = np.uint64(281474976710655)
+LCG_SHIFT = np.uint64(16)
+LCG_SCALE = 1.0 / 4294967296.0
+
+@numba.jit("i8(u8[:])", nopython=True, nogil=True)
+def fast_rand(rand_state):
+    # step the LCG in rand_state[0] and return its top 32 bits (as an i8, so
+    # that callers don't mix signed and unsigned ints)
+    rand_state[0] = ((rand_state[0] * LCG_MULT) + LCG_INC) & LCG_MASK
+    return np.int64(rand_state[0] >> LCG_SHIFT)
+
+@numba.jit("i8(u4[:], i8[:], i8, f8[:], u4[:], u8[:])", nopython=True, nogil=True)
+def fast_load_phrase(tokens, offsets, p_idx, keep_probs, phrase_buf, rand_state):
+    # copy phrase p_idx into phrase_buf, dropping each word with probability
+    # 1 - keep_probs[word] (if keep_probs is non-empty), and return the number
+    # of words kept. if fewer than 2 words are kept, keep the whole phrase.
+    p_start = offsets[p_idx]
+    p_end = offsets[p_idx+1]
+    p_len = 0
+    if (keep_probs.size > 0):
+        for t in range(p_start, p_end):
+            key = tokens[t]
+            if ((key >= keep_probs.size) or (keep_probs[key] >= 1.0) or \
+                    ((fast_rand(rand_state) * LCG_SCALE) < keep_probs[key])):
+                phrase_buf[p_len] = key
+                p_len += 1
+    if (p_len < 2):
+        p_len = 0
+        for t in range(p_start, p_end):
+            phrase_buf[p_len] = tokens[t]
+            p_len += 1
+    return p_len
+
+@numba.jit("void(u4[:], i8[:], u4[:], i8, i8, f8[:], u4[:], u4[:], u4[:], u4[:], u8[:])", \
+           nopython=True, nogil=True)
+def fast_pair_batch(tokens, offsets, p_idx, repeats, max_window, keep_probs, \
+                    anc_keys, pos_keys, phrase_keys, phrase_buf, rand_state):
+    # draw all anchor/context pairs for a batch, with "repeats" pairs drawn
+    # from each phrase in p_idx (except maybe the last one)
+    sample_count = anc_keys.size
+    for g in range(p_idx.size):
+        phrase_len = fast_load_phrase(tokens, offsets, p_idx[g], keep_probs, \
+                                      phrase_buf, rand_state)
+        i_start = g * repeats
+        i_end = min(i_start + repeats, sample_count)
+        for j in range(i_start, i_end):
+            a_idx = fast_rand(rand_state) % phrase_len
+            red_win = (fast_rand(rand_state) % max_window) + 1
+            c_min = a_idx - red_win
+            if (c_min < 0):
+                c_min = 0
+            c_max = a_idx + red_win
+            if (c_max >= phrase_len):
+                c_max = phrase_len - 1
+            c_span = c_max - c_min + 1
+            c_idx = a_idx
+            while (c_idx == a_idx):
+                c_idx = c_min + (fast_rand(rand_state) % c_span)
+            anc_keys[j] = phrase_buf[a_idx]
+            pos_keys[j] = phrase_buf[c_idx]
+            phrase_keys[j] = p_idx[g]
     return
 
-@numba.jit("void(u4[:], i8, i8, u4[:], i8, u4[:,:], u4[:], u4[:])")
-def fast_seq_sample(phrase, gram_n, pad_key, i, repeats, key_seqs, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        # Get a random stopping point for the n-gram. For now, assume that
-        # n-grams containing fewer than 2 valid words, i.e. a context word and
-        # a predicted word, are not desired.
-        stop_idx = (rand_pool[ri[0]] % (phrase_len - 1)) + 1
-        ri[0] += 1
-        # Get the start index of the n-gram (maybe negative)
-        start_idx = stop_idx - gram_n + 1
-        cur_pos = 0
-        while (cur_pos < gram_n):
-            # Record the word LUT keys for this n-gram, substituting the
-            # "padding key" as required due to phrase length
-            if ((start_idx + cur_pos) < 0):
-                key_seqs[j,cur_pos] = pad_key[0]
-            else:
-                key_seqs[j,cur_pos] = phrase[start_idx+cur_pos]
-            cur_pos += 1
+@numba.jit("void(u4[:], i8[:], u4[:], i8, i8, i8, f8[:], u4[:,:], u4[:], u4[:], u8[:])", \
+           nopython=True, nogil=True)
+def fast_seq_batch(tokens, offsets, p_idx, repeats, gram_n, pad_key, keep_probs, \
+                   key_seqs, phrase_keys, phrase_buf, rand_state):
+    # draw all n-grams for a batch, with "repeats" n-grams drawn from each
+    # phrase in p_idx (except maybe the last one)
+    sample_count = key_seqs.shape[0]
+    for g in range(p_idx.size):
+        phrase_len = fast_load_phrase(tokens, offsets, p_idx[g], keep_probs, \
+                                      phrase_buf, rand_state)
+        i_start = g * repeats
+        i_end = min(i_start + repeats, sample_count)
+        for j in range(i_start, i_end):
+            # Get a random stopping point for the n-gram. For now, assume that
+            # n-grams containing fewer than 2 valid words, i.e. a context word
+            # and a predicted word, are not desired.
+            stop_idx = (fast_rand(rand_state) % (phrase_len - 1)) + 1
+            # Get the start index of the n-gram (maybe negative)
+            start_idx = stop_idx - gram_n + 1
+            for cur_pos in range(gram_n):
+                # Record the word LUT keys for this n-gram, substituting the
+                # "padding key" as required due to phrase length
+                if ((start_idx + cur_pos) < 0):
+                    key_seqs[j,cur_pos] = pad_key
+                else:
+                    key_seqs[j,cur_pos] = phrase_buf[start_idx+cur_pos]
+            phrase_keys[j] = p_idx[g]
     return
 
 class PhraseSampler:
@@ -354,104 +882,89 @@ class PhraseSampler:
     This samples positive example pairs each comprising an anchor word and a
     near-by context word from its "skip-gram window". This can also samples
     n_gram sequences from the managed collection of phrases.
+
+    The phrases can be given either as a list of key arrays or as a
+    FlatCorpus. Either way, they are kept in flat (tokens, offsets) form, and
+    a FlatCorpus (e.g. a memory-mapped one from load_corpus()) is used
+    without copying.
+
+    If sample_probs is given (e.g. the 'keys_to_probs' from build_vocab()),
+    frequent words are downsampled: each time a phrase is drawn, each of its
+    words is kept with probability sample_probs[word key].
     """
-    def __init__(self, phrase_list, max_window, max_phrase_key=50000):
+    def __init__(self, phrase_list, max_window, max_phrase_key=50000, \
+                 sample_probs=None):
         # phrase_list contains the phrases to sample from
         self.max_window = max_window
-        self.phrase_list = phrase_list
-        self.phrase_table = self._make_table(self.phrase_list)
-        self.max_phrase_key = min(len(self.phrase_list), max_phrase_key)
-        self.pt_size = self.phrase_table.size
+        self.tokens, self.offsets = flatten_phrases(phrase_list)
+        self.phrase_count = self.offsets.size - 1
+        phrase_lens = np.diff(self.offsets)
+        # phrases are drawn in proportion to their length
+        self.phrase_table = AliasTable(phrase_lens)
+        self.max_phrase_key = min(self.phrase_count, max_phrase_key)
+        self.max_phrase_len = int(np.max(phrase_lens))
+        if sample_probs is None:
+            sample_probs = np.zeros((0,), dtype=np.float64)
+        self.sample_probs = np.asarray(sample_probs, dtype=np.float64)
         return
 
-    def _make_table(self, p_list, table_size=20000000):
-        """
-        Create a table for quickly drawing phrase indices in proportion to
-        the length of each phrase.
-        """
-        phrase_count = len(p_list)
-        phrase_lens = np.asarray([p.size for p in p_list]).astype(np.float64)
-        len_sum = np.sum(phrase_lens)
-        table = np.zeros((table_size,), dtype=np.uint32)
-        widx = 0
-        d1 = phrase_lens[0] / len_sum
-        for tidx in xrange(table_size):
-            table[tidx] = widx
-            if ((float(tidx) / table_size) > d1):
-                widx += 1
-                d1 += phrase_lens[widx] / len_sum
-            if widx >= phrase_count:
-                widx = phrase_count - 1
-        return table.astype(np.uint32)
-
-    def sample_pairs(self, sample_count):
-        """Draw a sample."""
+    def _batch_setup(self, sample_count, rng):
+        """Draw the phrases and LCG seed for a batch of sample_count samples."""
+        if rng is None:
+            rng = npr
+        repeats = 5
+        group_count = (sample_count + (repeats - 1)) // repeats
+        p_idx = self.phrase_table.sample((group_count,), rng=rng)
+        rand_state = np.asarray([rng.randint(0, high=RAND_HIGH)], \
+                                dtype=np.uint64)
+        phrase_buf = np.zeros((self.max_phrase_len,), dtype=np.uint32)
+        return [p_idx, repeats, phrase_buf, rand_state]
+
+    def sample_pairs(self, sample_count, rng=None):
+        """Draw a sample, using rng for randomness (if it's given)."""
         anc_keys = np.zeros((sample_count,), dtype=np.uint32)
         pos_keys = np.zeros((sample_count,), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_pair_sample(self.phrase_list[phrase_keys[i]], self.max_window, \
-                             i, repeats, anc_keys, pos_keys, rand_pool, ri)
-        anc_keys = anc_keys.astype(np.uint32)
-        pos_keys = pos_keys.astype(np.uint32)
+        p_idx, repeats, phrase_buf, rand_state = \
+                self._batch_setup(sample_count, rng)
+        fast_pair_batch(self.tokens, self.offsets, p_idx, repeats, \
+                        self.max_window, self.sample_probs, anc_keys, pos_keys, \
+                        phrase_keys, phrase_buf, rand_state)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [anc_keys, pos_keys, phrase_keys]
 
-    def sample_ngrams(self, sample_count, gram_n=5, pad_key=None):
-        """Draw a sample."""
+    def sample_ngrams(self, sample_count, gram_n=5, pad_key=None, rng=None):
+        """Draw a sample, using rng for randomness (if it's given)."""
         key_seqs = np.zeros((sample_count, gram_n), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        pad_key = np.asarray([pad_key]).astype(np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_seq_sample(self.phrase_list[phrase_keys[i]], gram_n, pad_key, \
-                    i, repeats, key_seqs, rand_pool, ri)
-        key_seqs = key_seqs.astype(np.uint32)
+        p_idx, repeats, phrase_buf, rand_state = \
+                self._batch_setup(sample_count, rng)
+        fast_seq_batch(self.tokens, self.offsets, p_idx, repeats, gram_n, \
+                       pad_key, self.sample_probs, key_seqs, phrase_keys, \
+                       phrase_buf, rand_state)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [key_seqs, phrase_keys]
 
 class NegSampler:
     """
     This samples "contrastive words" for training via negative sampling.
+
+    neg_table should be an AliasTable over word LUT keys, like the 'ns_table'
+    from build_vocab(). An array of keys to sample uniformly from (i.e. the
+    old-style table) is also accepted, and gets converted to an AliasTable.
     """
     def __init__(self, neg_table=None, neg_count=10):
-        # phrase_list contains the phrases to sample from 
+        if not isinstance(neg_table, AliasTable):
+            neg_table = AliasTable(np.bincount(np.asarray(neg_table).ravel()))
         self.neg_table = neg_table
         self.neg_table_size = self.neg_table.size
         self.neg_count = neg_count
         return
 
-    def sample(self, sample_count, neg_count=0):
+    def sample(self, sample_count, neg_count=0, rng=None):
         if (neg_count == 0):
             neg_count = self.neg_count
-        neg_keys = np.zeros((sample_count, neg_count), dtype=np.uint32)
-        neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
-        for i in range(neg_keys.shape[1]):
-            neg_keys[:,i] = self.neg_table[neg_idx[:,i]]
-        neg_keys = neg_keys.astype(np.uint32)
+        neg_keys = self.neg_table.sample((sample_count, neg_count), rng=rng)
         return neg_keys
 
 
@@ -26,6 +26,7 @@ from scipy.linalg import blas
 ctypedef np.float32_t REAL_t
 ctypedef np.uint32_t UI32_t
 ctypedef np.int32_t I32_t
+ctypedef np.int64_t I64_t
 
 DEF MAX_SENTENCE_LEN = 10000
 
@@ -50,6 +51,13 @@ ctypedef void (*cy_nsl_ff_bp_ptr) (
     REAL_t *dX, REAL_t *dW, REAL_t *db,
     REAL_t *L, const int do_grad, const int vec_dim) nogil
 
+ctypedef void (*cy_hsm_ff_bp_ptr) (
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *word_keys,
+    const I64_t *code_offsets, const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil
+
 ctypedef void (*cy_acl_ff_bp_ptr) (
     const int sp_size, const UI32_t *sp_idx,
     const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
@@ -66,6 +74,7 @@ cdef sscal_ptr sscal=<sscal_ptr>PyCObject_AsVoidPtr(blas.sscal._cpointer) # x =
 
 cdef cy_w2v_ff_bp_ptr cy_w2v_ff_bp
 cdef cy_nsl_ff_bp_ptr cy_nsl_ff_bp
+cdef cy_hsm_ff_bp_ptr cy_hsm_ff_bp
 cdef cy_acl_ff_bp_ptr cy_acl_ff_bp
 
 # define some useful constants
@@ -314,6 +323,126 @@ def nsl_ff_bp_pyx(sp_idx_p, pn_keys_p, pn_sign_p, X_p, W_p, b_p,
     return
 
 
+#########################################
+# HSM_FF_BP (VARIABLE-LENGTH CSR CODES) #
+#########################################
+
+################################################################################
+#                                                                              #
+#   hsm_ff_bp_pyx(sp_idx_p, word_keys_p, code_offsets_p, code_keys_p,          #
+#                 code_signs_p, X_p, W_p, b_p, dX_p, dW_p, db_p, L_p,          #
+#                 do_grad_p):                                                  #
+#                                                                              #
+#       Feedforward and backprop for HSMLayer, with the HSM codes for all      #
+#       words stored in "CSR" form (see CorpusUtils.csr_codes()). The code     #
+#       for the word with LUT key k is given by the code vector keys in        #
+#       code_keys[code_offsets[k]:code_offsets[k+1]], with the target class    #
+#       for each code vector in the same part of code_signs. Row i of X is     #
+#       trained to predict the code for the word with key word_keys[i].        #
+#                                                                              #
+#       Since each row only walks its own code, the short codes of frequent    #
+#       words don't pay for the long codes of rare words, as they do with      #
+#       the padded code matrices used by nsl_ff_bp_pyx. The loss for row i is  #
+#       summed over its code, into L[i].                                       #
+#                                                                              #
+################################################################################
+
+cdef void cy_hsm_ff_bp0(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *word_keys,
+    const I64_t *code_offsets, const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2, j
+    cdef REAL_t neg_label, y, exp_pns_y, g
+    cdef UI32_t X_key, W_key, word_key
+    cdef int sp_i
+
+    # update loop
+    for sp_i in range(sp_size):
+        X_key = sp_idx[sp_i]
+        word_key = word_keys[X_key]
+        row1 = X_key * vec_dim # get the starting index of input row (in X)
+        L[X_key] = 0.0
+        for j in range(code_offsets[word_key], code_offsets[word_key+1]):
+            W_key = code_keys[j]
+            row2 = W_key * vec_dim # get the starting index of code row (in W)
+            neg_label = -1.0 * code_signs[j] # minus the label
+            # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
+            y = <REAL_t>dsdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
+            exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+            L[X_key] += log(1.0 + exp_pns_y) # record the loss
+            if (do_grad == 1):
+                # Compute gradient and update gradient accumulators
+                g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
+                saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
+                db[W_key] = db[W_key] + g
+    return
+
+
+cdef void cy_hsm_ff_bp1(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *word_keys,
+    const I64_t *code_offsets, const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2, j
+    cdef REAL_t neg_label, y, exp_pns_y, g
+    cdef UI32_t X_key, W_key, word_key
+    cdef int sp_i
+
+    # update loop
+    for sp_i in range(sp_size):
+        X_key = sp_idx[sp_i]
+        word_key = word_keys[X_key]
+        row1 = X_key * vec_dim # get the starting index of input row (in X)
+        L[X_key] = 0.0
+        for j in range(code_offsets[word_key], code_offsets[word_key+1]):
+            W_key = code_keys[j]
+            row2 = W_key * vec_dim # get the starting index of code row (in W)
+            neg_label = -1.0 * code_signs[j] # minus the label
+            # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
+            y = <REAL_t>sdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
+            exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+            L[X_key] += log(1.0 + exp_pns_y) # record the loss
+            if (do_grad == 1):
+                # Compute gradient and update gradient accumulators
+                g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
+                saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
+                db[W_key] = db[W_key] + g
+    return
+
+def hsm_ff_bp_pyx(sp_idx_p, word_keys_p, code_offsets_p, code_keys_p, \
+                  code_signs_p, X_p, W_p, b_p, dX_p, dW_p, db_p, L_p, do_grad_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int do_grad = <int>do_grad_p
+    cdef int vec_dim = <int>W_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *word_keys = <UI32_t *>(np.PyArray_DATA(word_keys_p))
+    cdef I64_t *code_offsets = <I64_t *>(np.PyArray_DATA(code_offsets_p))
+    cdef UI32_t *code_keys = <UI32_t *>(np.PyArray_DATA(code_keys_p))
+    cdef REAL_t *code_signs = <REAL_t *>(np.PyArray_DATA(code_signs_p))
+    cdef REAL_t *X = <REAL_t *>(np.PyArray_DATA(X_p))
+    cdef REAL_t *W = <REAL_t *>(np.PyArray_DATA(W_p))
+    cdef REAL_t *b = <REAL_t *>(np.PyArray_DATA(b_p))
+    cdef REAL_t *dX = <REAL_t *>(np.PyArray_DATA(dX_p))
+    cdef REAL_t *dW = <REAL_t *>(np.PyArray_DATA(dW_p))
+    cdef REAL_t *db = <REAL_t *>(np.PyArray_DATA(db_p))
+    cdef REAL_t *L = <REAL_t *>(np.PyArray_DATA(L_p))
+
+    with nogil:
+        cy_hsm_ff_bp(sp_size, sp_idx, word_keys, code_offsets, code_keys,
+                     code_signs, X, W, b, dX, dW, db, L, do_grad, vec_dim)
+    return
+
+
 ################################
 # AUTO-CONTRASTIVE LAYER FF/BP #
 ################################
@@ -558,6 +687,87 @@ def ag_update_1d_pyx(sp_idx_p, row_idx_p, W_p, dW_p, mW_p, alpha_p):
         cy_ag_update_1d(sp_size, sp_idx, row_idx, W, dW, mW, alpha)
     return
 
+###################################
+# AG_UPDATE_SP_2D/1D (COMPACT dW) #
+###################################
+
+#
+# These are like ag_update_2d/1d, but the grads are stored compactly: row i
+# of dG holds the grad for row row_idx[i] of W (and mW). The used rows of dG
+# are zeroed, as in ag_update_2d/1d.
+#
+
+cdef void cy_ag_update_sp_2d(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *row_idx,
+    REAL_t *W, REAL_t *dG, REAL_t *mW, REAL_t alpha,
+    const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row_ptr, g_ptr, v_i
+    cdef int sp_i
+    cdef UI32_t i, row_key
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        row_key = row_idx[i]
+        row_ptr = row_key * vec_dim
+        g_ptr = i * vec_dim
+        for v_i in range(vec_dim):
+            mW[row_ptr + v_i] = (ADA_RHO * mW[row_ptr + v_i]) + \
+                    ((1 - ADA_RHO) * dG[g_ptr + v_i] * dG[g_ptr + v_i])
+            W[row_ptr + v_i] -= alpha * \
+                    (dG[g_ptr + v_i] / (sqrt(mW[row_ptr + v_i]) + ADA_EPS))
+            dG[g_ptr + v_i] = 0.0
+    return
+
+def ag_update_sp_2d_pyx(sp_idx_p, row_idx_p, W_p, dG_p, mW_p, alpha_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int vec_dim = <int>W_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *row_idx = <UI32_t *>(np.PyArray_DATA(row_idx_p))
+    cdef REAL_t *W = <REAL_t *>(np.PyArray_DATA(W_p))
+    cdef REAL_t *dG = <REAL_t *>(np.PyArray_DATA(dG_p))
+    cdef REAL_t *mW = <REAL_t *>(np.PyArray_DATA(mW_p))
+    cdef REAL_t alpha = <REAL_t>alpha_p
+
+    with nogil:
+        cy_ag_update_sp_2d(sp_size, sp_idx, row_idx, W, dG, mW, alpha, vec_dim)
+    return
+
+cdef void cy_ag_update_sp_1d(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *row_idx, REAL_t *W,
+    REAL_t *dG, REAL_t *mW, REAL_t alpha) nogil:
+
+    # declarations
+    cdef int sp_i
+    cdef UI32_t i, row_key
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        row_key = row_idx[i]
+        mW[row_key] = (ADA_RHO * mW[row_key]) + \
+                ((1 - ADA_RHO) * dG[i] * dG[i])
+        W[row_key] -= alpha * (dG[i] / (sqrt(mW[row_key]) + ADA_EPS))
+        dG[i] = 0.0
+    return
+
+def ag_update_sp_1d_pyx(sp_idx_p, row_idx_p, W_p, dG_p, mW_p, alpha_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *row_idx = <UI32_t *>(np.PyArray_DATA(row_idx_p))
+    cdef REAL_t *W = <REAL_t *>(np.PyArray_DATA(W_p))
+    cdef REAL_t *dG = <REAL_t *>(np.PyArray_DATA(dG_p))
+    cdef REAL_t *mW = <REAL_t *>(np.PyArray_DATA(mW_p))
+    cdef REAL_t alpha = <REAL_t>alpha_p
+
+    with nogil:
+        cy_ag_update_sp_1d(sp_size, sp_idx, row_idx, W, dG, mW, alpha)
+    return
+
 ##########
 # LUT_BP #
 ##########
@@ -603,6 +813,7 @@ def init():
     """
     global cy_w2v_ff_bp
     global cy_nsl_ff_bp
+    global cy_hsm_ff_bp
     global cy_acl_ff_bp
 
     cdef float *x = [<float>10.0]
@@ -618,11 +829,13 @@ def init():
     if (abs(d_res - expected) < 0.0001):
         cy_w2v_ff_bp = cy_w2v_ff_bp0
         cy_nsl_ff_bp = cy_nsl_ff_bp0
+        cy_hsm_ff_bp = cy_hsm_ff_bp0
         cy_acl_ff_bp = cy_acl_ff_bp0
         return 0  # double
     elif (abs(p_res[0] - expected) < 0.0001):
         cy_w2v_ff_bp = cy_w2v_ff_bp1
         cy_nsl_ff_bp = cy_nsl_ff_bp1
+        cy_hsm_ff_bp = cy_hsm_ff_bp1
         cy_acl_ff_bp = cy_acl_ff_bp1
         return 1  # float
     else:
@@ -1,3 +1,7 @@
+import os
+import re
+import shutil
+import hashlib
 import numpy as np
 import numpy.random as npr
 
@@ -30,186 +34,202 @@ def make_key_dicts(word_list, min_freq=2, unk_word='*UNK*'):
     k2w[unk_key] = unk_word
     return [w2k, k2w]
 
-class STBNode:
-    """
-    Node structure for use by STBParser.
-    """
-    # Set of "punctuation-type" characters, for output formatting
-    _right_punctuation = set([",","'","''",".","!","?",":",";"])
-    _left_punctuation = set(["`","``"])
-    def __init__(self, token='', auto_spawn=False):
-        self.gold_class = int(token[1])
-        self.word = None
-        self.lut_key = -1
-        self.has_children = False
-        self.left_child = []
-        self.right_child = []
-        # Deal with token
-        assert ((token[0] == '(') and (token[-1] == ')'))
-        if (token[3] == '('):
-            # This node joins a pair of children
-            self.has_children = True
-            if auto_spawn:
-                child_tokens = self.extract_child_tokens(token)
-                self.left_child = STBNode(child_tokens[0], True)
-                self.right_child = STBNode(child_tokens[1], True)
-        else:
-            self.word = token[3:-1]
-            self.word = self.word.lower()
-        return
+#
+# The treebank files are parsed with a single pass over each line's tokens,
+# describing each tree as a run of leaf words plus (start, end) spans into
+# those words for each of its sub-phrases. The spans are emitted in post-order
+# (left subtree, right subtree, then the node itself), so a tree's full phrase
+# is always its last span.
+#
+# The train/dev/test files are parsed in separate worker processes, and if a
+# cache_dir is given, the resulting key arrays are saved there as flat .npy
+# files, in a subdirectory named by a hash of the tree files and the vocab
+# options. Later loads with the same files and options just read the arrays.
+#
+# (nlp_convnet/StanfordTrees.py loads its trees with these functions too.)
+#
 
-    def extract_child_tokens(self, token):
-        """Extract the pair of child tokens from this parent token."""
-        # First extract left token
-        par_count = 1
-        start_idx = 3
-        end_idx = 4
-        while (par_count > 0):
-            if (token[end_idx] == '('):
-                par_count = par_count + 1
-            if (token[end_idx] == ')'):
-                par_count = par_count - 1
-            end_idx = end_idx + 1
-        left_token = token[start_idx:end_idx]
-        # Then extract right token
-        par_count = 1
-        start_idx = end_idx + 1
-        end_idx = start_idx + 1
-        while (par_count > 0):
-            if (token[end_idx] == '('):
-                par_count = par_count + 1
-            if (token[end_idx] == ')'):
-                par_count = par_count - 1
-            end_idx = end_idx + 1
-        right_token = token[start_idx:end_idx]
-        child_tokens = [left_token, right_token]
-        return child_tokens
+STB_SPLITS = ['train', 'dev', 'test']
+STB_ARRAYS = ['tokens', 'offsets', 'labels', 'tree_offsets']
 
-    def phrase_str(self):
-        """Get a string representing the phrase rooted at this node."""
-        phrase = ""
-        if self.has_children:
-            left_phrase = self.left_child.phrase_str()
-            right_phrase = self.right_child.phrase_str()
-            if ((right_phrase[0] in STBNode._right_punctuation) or \
-                    (right_phrase[0:3] == "n't") or \
-                    (left_phrase[-1] in STBNode._left_punctuation)):
-                phrase = "{0:s}{1:s}".format(left_phrase, right_phrase)
+def parse_stb_file(f_name):
+    """
+    Parse the trees in an STB file into flat lists. The result is a dict with
+    keys:
+      words: the (lowercased) leaf words for all trees, in order
+      leaf_offsets: tree i's words are words[leaf_offsets[i]:leaf_offsets[i+1]]
+      spans: (start, end) of each sub-phrase, as indices into words
+      labels: the gold class of each sub-phrase
+      tree_offsets: tree i's sub-phrases are spans[tree_offsets[i]:tree_offsets[i+1]]
+    """
+    tok_re = re.compile(r'\(|\)|[^\s()]+')
+    words = []
+    leaf_offsets = [0]
+    spans = []
+    labels = []
+    tree_offsets = [0]
+    for line in open(f_name):
+        toks = tok_re.findall(line)
+        if (len(toks) == 0):
+            continue
+        stack = []
+        i = 0
+        while (i < len(toks)):
+            if (toks[i] == '('):
+                if (toks[i+2] == '('):
+                    # This node joins a pair of children, its span ends once
+                    # we reach its closing parenthesis
+                    stack.append((int(toks[i+1]), len(words)))
+                    i += 2
+                else:
+                    # This node is a leaf, i.e. "(label word)"
+                    assert (toks[i+3] == ')')
+                    spans.append((len(words), len(words) + 1))
+                    labels.append(int(toks[i+1]))
+                    words.append(toks[i+2].lower())
+                    i += 4
             else:
-                phrase = "{0:s} {1:s}".format(left_phrase, right_phrase)
-        else:
-            assert (not (self.word is None))
-            phrase = "{0:s}".format(self.word)
-        return phrase
+                assert (toks[i] == ')')
+                label, start = stack.pop()
+                spans.append((start, len(words)))
+                labels.append(label)
+                i += 1
+        assert (len(stack) == 0)
+        leaf_offsets.append(len(words))
+        tree_offsets.append(len(spans))
+    parse = {}
+    parse['words'] = words
+    parse['leaf_offsets'] = leaf_offsets
+    parse['spans'] = spans
+    parse['labels'] = labels
+    parse['tree_offsets'] = tree_offsets
+    return parse
 
-    def get_all_tokens(self):
-        """Get a list of all tokens in the phrase rooted at this node."""
-        tokens = []
-        if self.has_children:
-            tokens.extend(self.left_child.get_all_tokens())
-            tokens.extend(self.right_child.get_all_tokens())
-        else:
-            assert (not (self.word is None))
-            tokens = [self.word]
-        return tokens
+def parse_stb_files(f_names, workers=3):
+    """Run parse_stb_file on each of f_names, using worker processes."""
+    if (workers <= 1):
+        return [parse_stb_file(f) for f in f_names]
+    from multiprocessing import Pool
+    pool = Pool(min(workers, len(f_names)))
+    try:
+        parses = pool.map(parse_stb_file, f_names)
+    finally:
+        pool.close()
+        pool.join()
+    return parses
 
-    def set_lut_keys(self, lut_keys, unk_word='*UNK*'):
-        """Set numeric look-up-table indices for words in the subtree rooted
-        at this node, based on the dict "lut_keys"."""
-        if self.has_children:
-            self.left_child.set_lut_keys(lut_keys)
-            self.right_child.set_lut_keys(lut_keys)
-        else:
-            assert (not (self.word is None))
-            if (self.word in lut_keys):
-                # The word here is known by the dict
-                self.lut_key = lut_keys[self.word]
-            else:
-                # The word here is not known by the dict
-                self.lut_key = lut_keys[unk_word]
-        return
+def stb_key_arrays(parse, w2k, unk_word='*UNK*'):
+    """
+    Convert an STB file parse to flat arrays of LUT keys. Sub-phrase i has
+    keys tokens[offsets[i]:offsets[i+1]] and label labels[i], and tree i has
+    sub-phrases tree_offsets[i] to tree_offsets[i+1]-1.
+    """
+    unk_key = w2k[unk_word]
+    leaf_keys = np.asarray([w2k.get(w, unk_key) for w in parse['words']], \
+                           dtype=np.uint32)
+    spans = np.asarray(parse['spans'], dtype=np.int64).reshape((-1, 2))
+    span_lens = spans[:,1] - spans[:,0]
+    offsets = np.zeros((span_lens.size + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum(span_lens)
+    # position t of the flattened phrases maps to leaf spans[i,0] + (t - offsets[i])
+    leaf_idx = np.arange(offsets[-1], dtype=np.int64) + \
+            np.repeat(spans[:,0] - offsets[:-1], span_lens)
+    arrays = {}
+    arrays['tokens'] = leaf_keys[leaf_idx]
+    arrays['offsets'] = offsets
+    arrays['labels'] = np.asarray(parse['labels'], dtype=np.int8)
+    arrays['tree_offsets'] = np.asarray(parse['tree_offsets'], dtype=np.int64)
+    return arrays
 
-    def get_lutis_and_labels(self):
-        """Get phrase labels and lut index sequences for all sub-phrases
-        rooted at this node."""
-        lut_idx_seqs = []
-        labels = []
-        if self.has_children:
-            left_vals = self.left_child.get_lutis_and_labels()
-            right_vals = self.right_child.get_lutis_and_labels()
-            # Make the joint lut index sequence for this node in phrase tree
-            my_lut_idx_seq = [luti for luti in left_vals[0][-1]]
-            my_lut_idx_seq.extend([luti for luti in right_vals[0][-1]])
-            # Get the label for this node in phrase tree
-            my_label = self.gold_class
-            # Augment the lut_idx_seqs and labels lists
-            lut_idx_seqs.extend(left_vals[0])
-            lut_idx_seqs.extend(right_vals[0])
-            lut_idx_seqs.append(my_lut_idx_seq)
-            labels.extend(left_vals[1])
-            labels.extend(right_vals[1])
-            labels.append(my_label)
-        else:
-            assert (self.lut_key >= 0)
-            lut_idx_seqs.append([self.lut_key])
-            labels.append(self.gold_class)
-        return [lut_idx_seqs, labels]
+def stb_cache_key(f_names, min_freq, use_all_words):
+    """Hash the STB files and the vocab options, for naming cache dirs."""
+    h = hashlib.sha1()
+    for f_name in f_names:
+        with open(f_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update("min_freq={0:d},use_all_words={1:d}".format( \
+            int(min_freq), int(use_all_words)).encode('utf-8'))
+    return h.hexdigest()[0:16]
 
-class STBParser:
+def LoadSTBArrays(tree_dir, min_freq=2, use_all_words=False, cache_dir=None, \
+                  workers=3):
     """
-    Parse trees in the format of the train/dev/test set provided for the paper
-    "Recursive Deep Models for Semantic Compositionality over a Sentiment
-    Treebank" by Socher et. al, EMNLP 2013.
+    Load the Stanford Treebank train/dev/test trees as flat key arrays.
 
-    TODO: More docs.
+    The result holds 'words_to_keys' and 'keys_to_words', as for LoadSTB, and
+    '*_tokens', '*_offsets', '*_labels' and '*_tree_offsets' for * in {train,
+    dev, test}, as described in stb_key_arrays. If cache_dir is given, the
+    arrays are read from (or, on the first load, written to) a subdirectory
+    of cache_dir keyed by the tree files and by min_freq/use_all_words.
     """
-    def __init__(self, tree_dir, min_freq=2, use_all_words=False):
-        # Get file names for train/dev/test trees
-        train_file = "{0:s}/train.txt".format(tree_dir)
-        dev_file = "{0:s}/dev.txt".format(tree_dir)
-        test_file = "{0:s}/test.txt".format(tree_dir)
-        # Parse files for train/dev/test trees
-        self.train_trees = self.parse_tree_file(train_file)
-        self.dev_trees = self.parse_tree_file(dev_file)
-        self.test_trees = self.parse_tree_file(test_file)
-        # Get the set of all word occurrences in the training trees
-        train_words = self.get_all_words(self.train_trees)
-        if use_all_words:
-            # Keep all words present in the corpus in the vocab
-            train_words.extend(self.get_all_words(self.dev_trees))
-            train_words.extend(self.get_all_words(self.test_trees))
-            min_freq = 0
-        # Compute maps from words to LUT keys and visa-versa, while discarding
-        # words that occur fewer than 'min_freq' times.
-        w2k, k2w = make_key_dicts(train_words, min_freq=min_freq, \
-                                       unk_word='*UNK*')
-        self.words_to_keys = w2k
-        self.keys_to_words = k2w
-        # Set the look-up-table indices for train/dev/test trees
-        for tree in self.train_trees:
-            tree.set_lut_keys(self.words_to_keys, unk_word='*UNK*')
-        for tree in self.dev_trees:
-            tree.set_lut_keys(self.words_to_keys, unk_word='*UNK*')
-        for tree in self.test_trees:
-            tree.set_lut_keys(self.words_to_keys, unk_word='*UNK*')
-        return
-
-    def parse_tree_file(self, f_name):
-        """Parse an STB file."""
-        root_tokens = [line.strip('\n') for line in open(f_name)]
-        trees = [STBNode(token=rt, auto_spawn=True) for rt in root_tokens]
-        return trees
+    f_names = ["{0:s}/{1:s}.txt".format(tree_dir, s) for s in STB_SPLITS]
+    if not (cache_dir is None):
+        key_dir = os.path.join(cache_dir, "stb_{0:s}".format( \
+                stb_cache_key(f_names, min_freq, use_all_words)))
+        if os.path.exists(key_dir):
+            return load_stb_arrays(key_dir)
+    # Parse the tree text files
+    parses = parse_stb_files(f_names, workers=workers)
+    # Compute maps from words to LUT keys and visa-versa, while discarding
+    # words that occur fewer than 'min_freq' times in the training trees.
+    vocab_words = list(parses[0]['words'])
+    if use_all_words:
+        # Keep all words present in the corpus in the vocab
+        vocab_words.extend(parses[1]['words'])
+        vocab_words.extend(parses[2]['words'])
+        min_freq = 0
+    w2k, k2w = make_key_dicts(vocab_words, min_freq=min_freq, unk_word='*UNK*')
+    dataset = {}
+    dataset['words_to_keys'] = w2k
+    dataset['keys_to_words'] = k2w
+    for (set_str, parse) in zip(STB_SPLITS, parses):
+        arrays = stb_key_arrays(parse, w2k, unk_word='*UNK*')
+        for a_str in STB_ARRAYS:
+            dataset["{0:s}_{1:s}".format(set_str, a_str)] = arrays[a_str]
+    if not (cache_dir is None):
+        save_stb_arrays(dataset, key_dir)
+    return dataset
 
-    def get_all_words(self, tree_list):
-        """Get the set of unique word tokens for the trees in "tree_list"."""
-        all_words = []
-        for tree in tree_list:
-            all_words.extend(tree.get_all_tokens())
-        return all_words
+def save_stb_arrays(dataset, key_dir):
+    """Save the result of LoadSTBArrays as .npy files in key_dir."""
+    # Write into a temporary dir first, so a partly written cache never
+    # gets picked up by a later load
+    tmp_dir = "{0:s}.tmp{1:d}".format(key_dir, os.getpid())
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    k2w = dataset['keys_to_words']
+    words = np.asarray([k2w[k] for k in range(len(k2w))])
+    np.save(os.path.join(tmp_dir, 'words.npy'), words)
+    for set_str in STB_SPLITS:
+        for a_str in STB_ARRAYS:
+            s = "{0:s}_{1:s}".format(set_str, a_str)
+            np.save(os.path.join(tmp_dir, "{0:s}.npy".format(s)), dataset[s])
+    try:
+        os.rename(tmp_dir, key_dir)
+    except OSError:
+        # Another process got there first, and its arrays are the same
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return
 
+def load_stb_arrays(key_dir):
+    """Load arrays saved by save_stb_arrays."""
+    words = np.load(os.path.join(key_dir, 'words.npy'))
+    dataset = {}
+    dataset['keys_to_words'] = dict(enumerate(words.tolist()))
+    dataset['words_to_keys'] = dict((w, k) for (k, w) in enumerate(words.tolist()))
+    for set_str in STB_SPLITS:
+        for a_str in STB_ARRAYS:
+            s = "{0:s}_{1:s}".format(set_str, a_str)
+            dataset[s] = np.load(os.path.join(key_dir, "{0:s}.npy".format(s)))
+    return dataset
 
+def split_stb_phrases(tokens, offsets):
+    """Split flat phrase keys into a list of per-phrase arrays (views)."""
+    return np.split(tokens, offsets[1:-1])
 
-def LoadSTB(tree_dir, min_freq=2, use_all_words=False):
+def LoadSTB(tree_dir, min_freq=2, use_all_words=False, cache_dir=None, \
+            workers=3):
     """
     Load Stanford Treebank train/dev/test trees in a simple format.
 
@@ -227,52 +247,29 @@ def LoadSTB(tree_dir, min_freq=2, use_all_words=False):
     assigned to words which appear at least min_freq times in full phrases from
     the training set. All other words will be assigned a LUT key associated
     with the word/token '*UNK*'.
+
+    The tree files are parsed by LoadSTBArrays, using up to workers processes.
+    If cache_dir is given, the parsed key arrays are cached there, and later
+    loads of the same files with the same vocab options skip the parsing.
     """
-    # Parse the tree text files
-    stbp = STBParser(tree_dir, min_freq=min_freq, use_all_words=use_all_words)
+    stb = LoadSTBArrays(tree_dir, min_freq=min_freq, \
+                        use_all_words=use_all_words, cache_dir=cache_dir, \
+                        workers=workers)
     dataset = {}
     # Get the vocab list (and look-up-table index map)
-    dataset['words_to_keys'] = stbp.words_to_keys
-    dataset['keys_to_words'] = stbp.keys_to_words
-    # Get the training set phrases and labels
-    dataset['train_phrases'] = []
-    dataset['train_labels'] = []
-    dataset['train_full_phrases'] = []
-    dataset['train_full_labels'] = []
-    for tree in stbp.train_trees:
-        lutis_and_labels = tree.get_lutis_and_labels()
-        dataset['train_full_phrases'].append(lutis_and_labels[0][-1])
-        dataset['train_full_labels'].append(lutis_and_labels[1][-1])
-        dataset['train_phrases'].extend(lutis_and_labels[0])
-        dataset['train_labels'].extend(lutis_and_labels[1])
-    # Get the development set phrases and labels
-    dataset['dev_phrases'] = []
-    dataset['dev_labels'] = []
-    dataset['dev_full_phrases'] = []
-    dataset['dev_full_labels'] = []
-    for tree in stbp.dev_trees:
-        lutis_and_labels = tree.get_lutis_and_labels()
-        dataset['dev_full_phrases'].append(lutis_and_labels[0][-1])
-        dataset['dev_full_labels'].append(lutis_and_labels[1][-1])
-        dataset['dev_phrases'].extend(lutis_and_labels[0])
-        dataset['dev_labels'].extend(lutis_and_labels[1])
-    # Get the testing set phrases and labels
-    dataset['test_phrases'] = []
-    dataset['test_labels'] = []
-    dataset['test_full_phrases'] = []
-    dataset['test_full_labels'] = []
-    for tree in stbp.test_trees:
-        lutis_and_labels = tree.get_lutis_and_labels()
-        dataset['test_full_phrases'].append(lutis_and_labels[0][-1])
-        dataset['test_full_labels'].append(lutis_and_labels[1][-1])
-        dataset['test_phrases'].extend(lutis_and_labels[0])
-        dataset['test_labels'].extend(lutis_and_labels[1])
-    # Convert to np.uint32 (which we always use for LUT keys)
-    for set_str in ['train', 'dev', 'test']:
-        s = '{0:s}_full_phrases'.format(set_str)
-        dataset[s] = [np.array(p).astype(np.uint32) for p in dataset[s]]
-        s = '{0:s}_phrases'.format(set_str)
-        dataset[s] = [np.array(p).astype(np.uint32) for p in dataset[s]]
+    dataset['words_to_keys'] = stb['words_to_keys']
+    dataset['keys_to_words'] = stb['keys_to_words']
+    # Get the train/dev/test phrases and labels. Each tree's full phrase is
+    # its last sub-phrase.
+    for set_str in STB_SPLITS:
+        phrases = split_stb_phrases(stb[set_str + '_tokens'], \
+                                    stb[set_str + '_offsets'])
+        labels = stb[set_str + '_labels'].tolist()
+        full_idx = (stb[set_str + '_tree_offsets'][1:] - 1).tolist()
+        dataset[set_str + '_phrases'] = phrases
+        dataset[set_str + '_labels'] = labels
+        dataset[set_str + '_full_phrases'] = [phrases[i] for i in full_idx]
+        dataset[set_str + '_full_labels'] = [labels[i] for i in full_idx]
     return dataset
 
 def parse_1bwords_file(f_name):
@@ -281,8 +278,29 @@ def parse_1bwords_file(f_name):
     txt_phrases = [p for p in txt_phrases if len(p) > 2]
     return txt_phrases
 
-def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5):
+def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5, \
+                corpus_dir=None):
+    """
+    Load (part of) the "1 Billion Words..." corpus, as LUT key phrases.
+
+    If corpus_dir is given, the tokenized corpus is compiled into corpus_dir
+    the first time this is called (see CorpusUtils.compile_corpus), and is
+    memory-mapped from there on later calls, without re-reading the text. In
+    this case, the train/dev phrases are returned as CorpusUtils.FlatCorpus
+    objects, which can be indexed like lists of key arrays.
+    """
     import os
+    import CorpusUtils as cu
+    if (not (corpus_dir is None)) and \
+            os.path.exists(os.path.join(corpus_dir, 'tokens.npy')):
+        corpus = cu.load_corpus(corpus_dir)
+        split_idx = (4 * len(corpus)) // 5
+        dataset = {}
+        dataset['words_to_keys'] = corpus.words_to_keys
+        dataset['keys_to_words'] = corpus.keys_to_words
+        dataset['train_key_phrases'] = corpus.subset(0, split_idx)
+        dataset['dev_key_phrases'] = corpus.subset(split_idx, len(corpus))
+        return dataset
     # Get the list of relevant files in the given directory
     txt_files = [f for f in os.listdir(data_dir) if (f.find('news.en-') > -1)]
     if file_count > len(txt_files):
@@ -293,6 +311,10 @@ def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5):
        txt_phrases.extend(parse_1bwords_file("{0:s}/{1:s}".format(data_dir, txt_files[i])))
     # Make dicts for words -> LUT keys and LUT keys -> words
     w2k, k2w = make_key_dicts(txt_phrases, min_freq=min_freq, unk_word='*UNK*')
+    if not (corpus_dir is None):
+        # Compile the corpus, and then load it back in memory-mapped form
+        cu.compile_corpus(txt_phrases, w2k, corpus_dir, unk_word='*UNK*')
+        return Load1BWords(corpus_dir=corpus_dir)
     # Create LUT key representations of each phrase
     lk_phrases = [[(w2k[w] if (w in w2k) else w2k['*UNK*']) for w in p] for p in txt_phrases]
     lk_phrases = [np.asarray(p).astype(np.uint32) for p in lk_phrases]
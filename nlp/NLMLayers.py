@@ -8,27 +8,359 @@ import numexpr as ne
 # Imports of my stuff
 from HelperFuncs import randn, ones, zeros
 from CythonFuncs import w2v_ff_bp, nsl_ff_bp, lut_bp, \
-                        ag_update_2d, ag_update_1d, hsm_ff_bp
+                        ag_update_2d, ag_update_1d, hsm_ff_bp, \
+                        ag_update_sp_2d, ag_update_sp_1d
+from NumbaFuncs import w2v_hogwild, w2v_ff_bp_shard, hsm_ff_bp_g, \
+                       hsm_hogwild, hsm_ff_bp_shard, hsm_ff_bp_shard_csr, \
+                       shard_rows, w2v_fused_slots, w2v_fused_g, \
+                       w2v_fused_anc, w2v_fused_ctx, w2v_fused_apply
+from WorkerPool import get_pool
 
 # UH OH, GLOBAL PARAMS (TODO: GET RID OF THESE!)
 ADA_EPS = 1e-3
 MAX_HSM_KEY = 12345678
 
+# Concurrency modes for the multithreaded gradient computations in HSMLayer
+# and W2VLayer. In 'shared' mode all threads add into the same dense grads
+# arrays, which races on frequently occurring keys. In 'hogwild' mode the
+# threads apply their updates straight to the params, skipping the grads
+# arrays (HSMLayer queues the per-code grads in ff_bp, and applies them
+# without locks in apply_grad). In 'sharded' mode each thread accumulates
+# into its own sparse grad shard, and the shards are merged deterministically
+# before the update.
+CONC_MODES = ['shared', 'hogwild', 'sharded']
+
+#######################
+# TOUCHED-ROW TRACKER #
+#######################
+
+class RowTracker:
+    """
+    Track which rows of a look-up-table style parameter matrix have received
+    gradients since the last update.
+
+    A flag array with one entry per row marks the rows seen so far, and the
+    keys of newly touched rows are kept as a list of small uint32 arrays. So,
+    adding a batch of keys and collecting the touched rows never requires a
+    Python-level loop over keys or a pass over every row in the table.
+    """
+    def __init__(self, key_count):
+        self.key_count = key_count
+        self.flags = np.zeros((key_count,), dtype=np.bool_)
+        self.new_rows = []
+        self.row_count = 0
+        return
+
+    def add(self, keys):
+        """Mark the rows given in keys as touched. Invalid keys are ignored."""
+        keys = keys.ravel()
+        keys = keys[keys < self.key_count]
+        keys = np.unique(keys[~self.flags[keys]]).astype(np.uint32)
+        if (keys.size > 0):
+            self.flags[keys] = True
+            self.new_rows.append(keys)
+            self.row_count += keys.size
+        return
+
+    def add_all(self):
+        """Mark all rows as touched."""
+        self.flags[:] = True
+        self.new_rows = [np.arange(self.key_count, dtype=np.uint32)]
+        self.row_count = self.key_count
+        return
+
+    def rows(self):
+        """Get a sorted np.uint32 array of all rows touched since clear()."""
+        if (len(self.new_rows) == 0):
+            return np.zeros((0,), dtype=np.uint32)
+        if (len(self.new_rows) > 1):
+            self.new_rows = [np.sort(np.concatenate(self.new_rows))]
+        return self.new_rows[0]
+
+    def clear(self):
+        """Forget all touched rows."""
+        for keys in self.new_rows:
+            self.flags[keys] = False
+        self.new_rows = []
+        self.row_count = 0
+        return
+
+    def grow(self, key_count):
+        """Add (untouched) rows to be tracked, up to key_count."""
+        self.flags = grow_rows(self.flags, key_count)
+        self.key_count = key_count
+        return
+
+    def __len__(self):
+        return self.row_count
+
+############################
+# COMPACT GRAD ACCUMULATOR #
+############################
+
+class SparseGrads:
+    """
+    Accumulate gradients for the rows of a look-up-table style parameter
+    matrix in a compact buffer, rather than in a dense matrix the same size
+    as the params (i.e. this is the "sparse_grads" alternative to the grads
+    arrays in each layer).
+
+    Row i of buf holds the grad for param row keys[i]. slots maps each param
+    row to its row in buf (or to -1 if the row has no grad yet), so adding
+    grads for a batch of keys never needs a pass over every row in the table.
+    If dim is None, the params (and buf) are 1d, e.g. for bias vectors.
+    The buffer grows (by doubling) as needed, and is reused after clear().
+    """
+    def __init__(self, key_count, dim=None):
+        self.key_count = key_count
+        self.dim = dim
+        self.slots = -1 * np.ones((key_count,), dtype=np.int64)
+        self.keys = np.zeros((0,), dtype=np.uint32)
+        self.buf = None
+        self.row_count = 0
+        self._reserve(64)
+        return
+
+    def _reserve(self, row_count):
+        """Make sure buf has room for at least row_count rows."""
+        if (self.keys.shape[0] < row_count):
+            new_size = max(row_count, 2 * self.keys.shape[0])
+            keys = np.zeros((new_size,), dtype=np.uint32)
+            keys[0:self.row_count] = self.keys[0:self.row_count]
+            if (self.dim is None):
+                buf = np.zeros((new_size,), dtype=np.float32)
+            else:
+                buf = zeros((new_size, self.dim))
+            if not (self.buf is None):
+                buf[0:self.row_count] = self.buf[0:self.row_count]
+            self.keys = keys
+            self.buf = buf
+        return
+
+    def rows_for(self, keys):
+        """
+        Get the rows of buf (as a np.uint32 array shaped like keys) holding
+        the grads for the given keys, adding zeroed rows for new keys.
+        """
+        new_keys = np.unique(keys[self.slots[keys] < 0])
+        if (new_keys.size > 0):
+            start = self.row_count
+            self._reserve(start + new_keys.size)
+            self.keys[start:(start + new_keys.size)] = new_keys
+            self.slots[new_keys] = np.arange(start, start + new_keys.size)
+            self.row_count += new_keys.size
+        return self.slots[keys].astype(np.uint32)
+
+    def add(self, keys, G):
+        """Add G[i] to the grad for row keys[i]. keys must be unique."""
+        rows = self.rows_for(keys)
+        self.buf[rows] += G
+        return
+
+    def apply(self, W, mW, learn_rate):
+        """Apply the accumulated grads to W, with adagrad, and then clear."""
+        if (self.row_count == 0):
+            return
+        keys = self.keys[0:self.row_count]
+        if (self.dim is None):
+            ag_update_sp_1d(keys, W, self.buf, mW, learn_rate)
+        else:
+            ag_update_sp_2d(keys, W, self.buf, mW, learn_rate)
+        self.clear()
+        return
+
+    def clear(self):
+        """Forget all accumulated grads."""
+        self.slots[self.keys[0:self.row_count]] = -1
+        self.buf[0:self.row_count] = 0.0
+        self.row_count = 0
+        return
+
+    def grow(self, key_count):
+        """Allow grads for rows with keys up to key_count-1."""
+        self.slots = grow_rows(self.slots, key_count, fill=-1)
+        self.key_count = key_count
+        return
+
+    def __len__(self):
+        return self.row_count
+
+##########################
+# REUSABLE SCRATCH SPACE #
+##########################
+
+class ScratchBuffers:
+    """
+    Reusable float32 work arrays, e.g. for the per-thread grad shards used by
+    the sharded kernels, which would otherwise be allocated (and zeroed by
+    the allocator) on every minibatch.
+
+    Each named buffer is a flat array that grows (by doubling) when a request
+    doesn't fit, and requests get a view of its first prod(shape) entries.
+    So, the views handed out for a name are only valid until the next request
+    for that name.
+    """
+    def __init__(self):
+        self.bufs = {}
+        return
+
+    def get(self, name, shape):
+        """Get an uninitialized array with the given shape."""
+        size = int(np.prod(shape))
+        buf = self.bufs.get(name, None)
+        if (buf is None) or (buf.size < size):
+            old_size = 0 if (buf is None) else buf.size
+            buf = np.empty((max(size, 2 * old_size),), dtype=np.float32)
+            self.bufs[name] = buf
+        return buf[0:size].reshape(shape)
+
+    def zeros(self, name, shape):
+        """Get a zeroed array with the given shape."""
+        A = self.get(name, shape)
+        A.fill(0.0)
+        return A
+
+    def clear(self):
+        """Release all buffers."""
+        self.bufs = {}
+        return
+
+def grow_rows(A, row_count, fill=0.0):
+    """
+    Get an array holding the rows of A followed by (row_count - A.shape[0])
+    new rows, which are set to fill.
+
+    The result is a view of the first row_count rows of a buffer with spare
+    capacity. If A is already such a view and the spare rows suffice, no rows
+    are copied. Otherwise, the rows of A are copied into a new buffer with
+    at least double the capacity. So, growing an array a few rows at a time
+    only copies each row O(1) times on average.
+    """
+    old_count = A.shape[0]
+    assert(row_count >= old_count)
+    buf = A.base
+    if (not isinstance(buf, np.ndarray)) or \
+            (buf.shape[1:] != A.shape[1:]) or \
+            (buf.ctypes.data != A.ctypes.data) or \
+            (not A.flags['C_CONTIGUOUS']):
+        # A isn't a leading slice of a buffer, so it has no spare rows
+        buf = A
+    if (buf.shape[0] < row_count):
+        new_shape = (max(row_count, 2 * buf.shape[0]),) + A.shape[1:]
+        buf = np.zeros(new_shape, dtype=A.dtype)
+        buf[0:old_count] = A
+    B = buf[0:row_count]
+    B[old_count:] = fill
+    return B
+
+#####################
+# LAZY ROW L2 DECAY #
+#####################
+
+class RowDecay:
+    """
+    Apply l2 regularization (i.e. W *= (1 - lam_l2)) to the rows of a
+    look-up-table style parameter matrix lazily, so that each decay step
+    doesn't need a pass over every row in the table.
+
+    Calls to decay() just add log(1 - lam_l2) to a running total. Each row
+    records the value of this total when it was last brought up to date, and
+    catch_up() applies the decay accumulated since then (as one multiplicative
+    scale) to the given rows. So, rows should be caught up right before they
+    are read or updated, and finalize() should be called to catch up all rows
+    before the full matrix is used (e.g. for export or nearest neighbours).
+    """
+    def __init__(self, key_count):
+        self.key_count = key_count
+        self.total = 0.0
+        self.marks = np.zeros((key_count,), dtype=np.float64)
+        return
+
+    def decay(self, lam_l2):
+        """Decay all rows by (1 - lam_l2), the next time they are used."""
+        assert(lam_l2 < 1.0)
+        self.total += np.log(1.0 - lam_l2)
+        return
+
+    def catch_up(self, keys, W):
+        """Apply any pending decay to the rows of W given in keys."""
+        keys = keys.ravel()
+        keys = keys[keys < self.key_count]
+        keys = keys[self.marks[keys] != self.total]
+        if (keys.size > 0):
+            scales = np.exp(self.total - self.marks[keys]).astype(np.float32)
+            if (W.ndim == 1):
+                W[keys] *= scales
+            else:
+                W[keys] *= scales[:,np.newaxis]
+            self.marks[keys] = self.total
+        return
+
+    def decayed_copy(self, W):
+        """Get a copy of W with any pending decay applied, leaving W (and
+        the record of pending decay) unchanged.
+        """
+        scales = np.exp(self.total - self.marks).astype(np.float32)
+        if (W.ndim == 1):
+            return W * scales
+        return W * scales[:,np.newaxis]
+
+    def finalize(self, W):
+        """Apply any pending decay to all rows of W."""
+        scales = np.exp(self.total - self.marks).astype(np.float32)
+        if (W.ndim == 1):
+            W *= scales
+        else:
+            W *= scales[:,np.newaxis]
+        self.marks[:] = self.total
+        return
+
+    def grow(self, key_count):
+        """Add rows (with no pending decay) to be tracked, up to key_count."""
+        self.marks = grow_rows(self.marks, key_count, fill=self.total)
+        self.key_count = key_count
+        return
+
+    def reset(self):
+        """Forget any pending decay (e.g. after reinitializing W)."""
+        self.total = 0.0
+        self.marks[:] = 0.0
+        return
+
+def clip_rows(W, rows, max_norm):
+    """
+    Bound the L2 norm of the given rows of W by max_norm, in place. The rows
+    should be caught up with any pending decay first. Decay can only shrink
+    a row, so layers only clip the rows used (or initialized) since their
+    last clip, which are tracked by a RowTracker, rather than sweeping all
+    of W.
+    """
+    M = W[rows]
+    m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
+    m_scales = np.minimum(m_scales, 1.0).astype(W.dtype)
+    W[rows] = M * m_scales[:,np.newaxis]
+    return
+
 ###########################
 # NEGATIVE SAMPLING LAYER #
 ###########################
 
 class NSLayer:
-    def __init__(self, in_dim=0, max_out_key=0):
+    def __init__(self, in_dim=0, max_out_key=0, sparse_grads=False):
         # Record and initialize layer parameters
         self.dim_input = in_dim
         self.key_count = max_out_key + 1 # assume 0 is a key
+        self.sparse_grads = sparse_grads
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, in_dim))
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
-        self.grads['W'] = zeros((self.key_count, in_dim))
-        self.grads['b'] = zeros((self.key_count,))
+        if self.sparse_grads:
+            self.grads['W'] = SparseGrads(self.key_count, in_dim)
+            self.grads['b'] = SparseGrads(self.key_count)
+        else:
+            self.grads['W'] = zeros((self.key_count, in_dim))
+            self.grads['b'] = zeros((self.key_count,))
         self.moms = {}
         self.moms['W'] = zeros((self.key_count, in_dim))
         self.moms['b'] = zeros((self.key_count,))
@@ -38,25 +370,32 @@ class NSLayer:
         self.dLdX = []
         self.dLdY = []
         self.samp_keys = []
-        self.grad_idx = []
+        self.grad_rows = RowTracker(self.key_count)
+        self.unclipped = RowTracker(self.key_count)
+        self.unclipped.add_all()
+        self.decay = {'W': RowDecay(self.key_count), \
+                      'b': RowDecay(self.key_count)}
+        # reusable grad shards for sparse_grads mode
+        self.scratch = ScratchBuffers()
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        self._reset_grads()
+        self.decay['W'].reset()
+        self.decay['b'].reset()
+        self.unclipped.add_all()
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm, for the rows used since
+        the last call (see clip_rows())."""
+        rows = self.unclipped.rows()
+        self.decay['W'].catch_up(rows, self.params['W'])
+        clip_rows(self.params['W'], rows, max_norm)
+        self.unclipped.clear()
         return
 
     def ff_bp(self, X, pos_samples, neg_samples, do_grad=True):
@@ -81,49 +420,90 @@ class NSLayer:
         samp_keys = np.hstack((pos_samples, neg_samples))
         samp_sign = -1.0 * ones(samp_keys.shape)
         samp_sign[:,0] = 1.0
+        # bring the target rows up to date with any pending l2 decay
+        self.decay['W'].catch_up(samp_keys, self.params['W'])
+        self.decay['b'].catch_up(samp_keys, self.params['b'])
+        self.unclipped.add(samp_keys)
         # do feedforward and backprop all in one go
         L = zeros(samp_keys.shape)
         dLdX = zeros(X.shape)
-        nsl_ff_bp(samp_keys, samp_sign, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L, do_grad)
+        if self.sparse_grads:
+            # accumulate grads in compact per-thread shards, then merge the
+            # shards into the compact grad buffers
+            mod_idx, samp_cidx = np.unique(samp_keys, return_inverse=True)
+            samp_cidx = samp_cidx.reshape(samp_keys.shape).astype(np.int32)
+            pool = get_pool()
+            shard_idx, shard_count = shard_rows(X.shape[0], pool)
+            dW_s = self.scratch.zeros('dW_s', \
+                    (shard_count, mod_idx.size, X.shape[1]))
+            db_s = self.scratch.zeros('db_s', (shard_count, mod_idx.size))
+            hsm_ff_bp_shard(shard_idx, samp_keys, samp_cidx, samp_sign, X, \
+                            self.params['W'], self.params['b'], dLdX, \
+                            dW_s, db_s, L, do_grad, pool=pool)
+            if do_grad:
+                mod_idx = mod_idx.astype(np.uint32)
+                self.grads['W'].add(mod_idx, np.sum(dW_s, axis=0, \
+                        out=self.scratch.get('dW', dW_s.shape[1:])))
+                self.grads['b'].add(mod_idx, np.sum(db_s, axis=0, \
+                        out=self.scratch.get('db', db_s.shape[1:])))
+        else:
+            nsl_ff_bp(samp_keys, samp_sign, X, self.params['W'], \
+                      self.params['b'], dLdX, self.grads['W'], \
+                      self.grads['b'], L, do_grad)
+            if do_grad:
+                self.grad_rows.add(samp_keys)
         # derp dorp
         L = np.sum(L)
-        if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(samp_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(samp_keys)) ))
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Add l2 regularization, which is applied lazily to each row."""
+        self.decay['W'].decay(lam_l2)
+        self.decay['b'].decay(lam_l2)
         return 1
 
+    def finalize(self):
+        """Apply any pending l2 regularization to all rows."""
+        self.decay['W'].finalize(self.params['W'])
+        self.decay['b'].finalize(self.params['b'])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        if self.sparse_grads:
+            self.grads['W'].apply(self.params['W'], self.moms['W'], learn_rate)
+            self.grads['b'].apply(self.params['b'], self.moms['b'], learn_rate)
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.grad_rows.clear()
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.moms['W'].fill(ada_init)
+        self.moms['b'].fill(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self._reset_grads()
+        self.moms['W'].fill(ada_init)
+        self.moms['b'].fill(ada_init)
+        return
+
+    def _reset_grads(self):
+        """Zero the gradients, without allocating new arrays."""
+        if self.sparse_grads:
+            self.grads['W'].clear()
+            self.grads['b'].clear()
+        else:
+            self.grads['W'].fill(0.0)
+            self.grads['b'].fill(0.0)
+            self.grad_rows.clear()
         return
 
     def _cleanup(self):
@@ -139,17 +519,39 @@ class NSLayer:
 # HIERARCHICAL SOFTMAX LAYER -- VERY INCOMPLETE #
 #################################################
 
+def csr_paths(word_keys, code_offsets):
+    """
+    Get [path_idx, path_lens] for the HSM codes of the words in word_keys,
+    with codes stored as in CorpusUtils.csr_codes(). path_lens[i] is the code
+    length for word_keys[i], and path_idx gives the positions in the flat
+    code_keys/code_signs arrays of all the codes, one after another.
+    """
+    path_starts = code_offsets[word_keys]
+    path_lens = code_offsets[word_keys + 1] - path_starts
+    row_starts = np.cumsum(path_lens) - path_lens
+    path_idx = np.arange(np.sum(path_lens)) + \
+            np.repeat(path_starts - row_starts, path_lens)
+    return [path_idx, path_lens]
+
 class HSMLayer:
-    def __init__(self, in_dim=0, max_hs_key=0):
+    def __init__(self, in_dim=0, max_hs_key=0, conc_mode='shared', \
+                 sparse_grads=False):
         # Record and initialize some layer parameters
+        assert(conc_mode in CONC_MODES)
         self.dim_input = in_dim
         self.key_count = max_hs_key + 1 # assume 0 is a key
+        self.conc_mode = conc_mode
+        self.sparse_grads = sparse_grads
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, in_dim))
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
-        self.grads['W'] = zeros((self.key_count, in_dim))
-        self.grads['b'] = zeros((self.key_count,))
+        if self.sparse_grads:
+            self.grads['W'] = SparseGrads(self.key_count, in_dim)
+            self.grads['b'] = SparseGrads(self.key_count)
+        else:
+            self.grads['W'] = zeros((self.key_count, in_dim))
+            self.grads['b'] = zeros((self.key_count,))
         self.moms = {}
         self.moms['W'] = zeros((self.key_count, in_dim))
         self.moms['b'] = zeros((self.key_count,))
@@ -158,90 +560,187 @@ class HSMLayer:
         self.Y = []
         self.dLdX = []
         self.dLdY = []
-        self.grad_idx = []
+        self.grad_rows = RowTracker(self.key_count)
+        self.unclipped = RowTracker(self.key_count)
+        self.unclipped.add_all()
+        self.decay = {'W': RowDecay(self.key_count), \
+                      'b': RowDecay(self.key_count)}
+        # (input, word keys, path starts, code grads, codes) waiting for
+        # hogwild updates
+        self.hw_queue = []
+        # reusable grad shards for the sharded kernels
+        self.scratch = ScratchBuffers()
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        self._reset_grads()
+        self.decay['W'].reset()
+        self.decay['b'].reset()
+        self.unclipped.add_all()
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm, for the rows used since
+        the last call (see clip_rows())."""
+        rows = self.unclipped.rows()
+        self.decay['W'].catch_up(rows, self.params['W'])
+        clip_rows(self.params['W'], rows, max_norm)
+        self.unclipped.clear()
         return
 
-    def ff_bp(self, X, code_keys, code_signs, do_grad=True):
+    def ff_bp(self, X, word_keys, hsm_codes, do_grad=True):
         """Perform feedforward and then backprop for this layer.
 
+        Row i of X is used to predict the HSM code for the word with LUT key
+        word_keys[i]. The codes for all words are given by hsm_codes, which is
+        a list [code_offsets, code_keys, code_signs] as produced by
+        CorpusUtils.csr_codes() (e.g. the 'csr_codes' in an hs_tree).
+
         By setting do_grad to False, we can just compute the loss, without
         making modifications to the gradient accumulators (i.e. no backprop).
+
+        With sparse_grads, the 'shared' mode also accumulates grads through
+        the sharded kernel, as the compact grad buffers can't be indexed by
+        code key directly.
+
+        In 'hogwild' mode, this doesn't update the params itself: the grad
+        for each code is queued (with X and the word keys) in self.hw_queue,
+        and the queued updates are applied, without locks, by apply_grad().
         """
+        code_offsets, code_keys, code_signs = hsm_codes
+        word_keys = np.ascontiguousarray(word_keys)
         # check array types, to avoid "silent" type errors in Cython code
         assert(type(X[0,0]) == np.float32)
-        assert(type(code_keys[0,0]) == np.uint32)
-        assert(type(code_signs[0,0]) == np.float32)
+        assert(type(word_keys[0]) == np.uint32)
+        assert(type(code_offsets[0]) == np.int64)
+        assert(type(code_keys[0]) == np.uint32)
+        assert(type(code_signs[0]) == np.float32)
         # check for valid input shapes
         assert(X.shape[1] == self.params['W'].shape[1])
-        assert(code_keys.shape[0] == X.shape[0])
-        assert(code_signs.shape[0] == X.shape[0])
+        assert(word_keys.shape[0] == X.shape[0])
         # cleanup debris from any previous feedforward
         self._cleanup()
         # change from boolean to int, for Cython code
         do_grad = 1 if do_grad else 0
+        # find the part of code_keys/code_signs holding each row's code
+        path_idx, path_lens = csr_paths(word_keys, code_offsets)
+        # bring the code rows up to date with any pending l2 decay
+        path_keys = code_keys[path_idx]
+        self.decay['W'].catch_up(path_keys, self.params['W'])
+        self.decay['b'].catch_up(path_keys, self.params['b'])
+        self.unclipped.add(path_keys)
         # do feedforward and backprop all in one go
         dLdX = zeros(X.shape)
-        L_cy = zeros(code_keys.shape)
-        hsm_ff_bp(code_keys, code_signs, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L_cy, do_grad)
-        L_cy_sum = np.sum(L_cy)
-        L_cy_pre = L_cy_sum
-        # Derp dorp
-        L = L_cy_sum
-        if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(code_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(code_keys)) ))
+        if (self.conc_mode == 'hogwild'):
+            # record the grads for each code, to be applied in apply_grad()
+            row_starts = np.cumsum(path_lens) - path_lens
+            G = zeros(path_idx.shape)
+            L_cy = zeros(word_keys.shape)
+            hsm_ff_bp_g(word_keys, row_starts, code_offsets, code_keys, \
+                        code_signs, X, self.params['W'], self.params['b'], \
+                        dLdX, G, L_cy, do_grad)
+            if do_grad:
+                self.hw_queue.append((X, word_keys, row_starts, G, hsm_codes))
+            return [dLdX, np.sum(L_cy)]
+        if (self.conc_mode == 'sharded') or self.sparse_grads:
+            # accumulate grads in per-thread shards, then merge the shards
+            row_starts = np.cumsum(path_lens) - path_lens
+            L_cy = zeros(word_keys.shape)
+            mod_idx, code_cidx = np.unique(path_keys, return_inverse=True)
+            code_cidx = code_cidx.astype(np.int32)
+            pool = get_pool()
+            shard_idx, shard_count = shard_rows(X.shape[0], pool)
+            dW_s = self.scratch.zeros('dW_s', \
+                    (shard_count, mod_idx.size, X.shape[1]))
+            db_s = self.scratch.zeros('db_s', (shard_count, mod_idx.size))
+            hsm_ff_bp_shard_csr(shard_idx, word_keys, row_starts, code_offsets, \
+                                code_keys, code_signs, code_cidx, X, \
+                                self.params['W'], self.params['b'], dLdX, \
+                                dW_s, db_s, L_cy, do_grad, pool=pool)
+            if do_grad:
+                dW = np.sum(dW_s, axis=0, \
+                            out=self.scratch.get('dW', dW_s.shape[1:]))
+                db = np.sum(db_s, axis=0, \
+                            out=self.scratch.get('db', db_s.shape[1:]))
+                if self.sparse_grads:
+                    mod_idx = mod_idx.astype(np.uint32)
+                    self.grads['W'].add(mod_idx, dW)
+                    self.grads['b'].add(mod_idx, db)
+                else:
+                    self.grads['W'][mod_idx] += dW
+                    self.grads['b'][mod_idx] += db
+        else:
+            # each row only walks its own code, so no padding is processed
+            L_cy = zeros(word_keys.shape)
+            hsm_ff_bp(word_keys, code_offsets, code_keys, code_signs, X, \
+                      self.params['W'], self.params['b'], dLdX, \
+                      self.grads['W'], self.grads['b'], L_cy, do_grad)
+        L = np.sum(L_cy)
+        if do_grad and not self.sparse_grads:
+            self.grad_rows.add(path_keys)
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Add l2 regularization, which is applied lazily to each row."""
+        self.decay['W'].decay(lam_l2)
+        self.decay['b'].decay(lam_l2)
         return 1
 
+    def finalize(self):
+        """Apply any pending l2 regularization to all rows."""
+        self.decay['W'].finalize(self.params['W'])
+        self.decay['b'].finalize(self.params['b'])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        if (self.conc_mode == 'hogwild'):
+            # apply updates straight to the params, as recorded by ff_bp
+            for (X, word_keys, row_starts, G, hsm_codes) in self.hw_queue:
+                code_offsets, code_keys, code_signs = hsm_codes
+                hsm_hogwild(word_keys, row_starts, code_offsets, code_keys, \
+                            G, X, self.params['W'], self.params['b'], \
+                            self.moms['W'], self.moms['b'], learn_rate)
+            self.hw_queue = []
+            return
+        if self.sparse_grads:
+            self.grads['W'].apply(self.params['W'], self.moms['W'], learn_rate)
+            self.grads['b'].apply(self.params['b'], self.moms['b'], learn_rate)
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.grad_rows.clear()
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.moms['W'].fill(ada_init)
+        self.moms['b'].fill(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self._reset_grads()
+        self.moms['W'].fill(ada_init)
+        self.moms['b'].fill(ada_init)
+        self.hw_queue = []
+        return
+
+    def _reset_grads(self):
+        """Zero the gradients, without allocating new arrays."""
+        if self.sparse_grads:
+            self.grads['W'].clear()
+            self.grads['b'].clear()
+        else:
+            self.grads['W'].fill(0.0)
+            self.grads['b'].fill(0.0)
+            self.grad_rows.clear()
         return
 
     def _cleanup(self):
@@ -257,16 +756,23 @@ class HSMLayer:
 #######################
 
 class LUTLayer:
-    def __init__(self, max_key, embed_dim, n_gram=1):
+    def __init__(self, max_key, embed_dim, n_gram=1, sparse_grads=False):
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.sparse_grads = sparse_grads
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, embed_dim))
         self.grads = {}
-        self.grads['W'] = zeros(self.params['W'].shape)
+        if self.sparse_grads:
+            self.grads['W'] = SparseGrads(self.key_count, embed_dim)
+        else:
+            self.grads['W'] = zeros(self.params['W'].shape)
         self.moms = {}
         self.moms['W'] = zeros(self.params['W'].shape)
-        self.grad_idx = set()
+        self.grad_rows = RowTracker(self.key_count)
+        self.unclipped = RowTracker(self.key_count)
+        self.unclipped.add_all()
+        self.decay = RowDecay(self.key_count)
         self.embed_dim = embed_dim
         self.n_gram = n_gram
         self.X = []
@@ -276,17 +782,18 @@ class LUTLayer:
     def init_params(self, w_scale=0.01):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.embed_dim))
-        self.grads['W'] = zeros((self.key_count, self.embed_dim))
+        self._reset_grads()
+        self.decay.reset()
+        self.unclipped.add_all()
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm, for the rows used since
+        the last call (see clip_rows())."""
+        rows = self.unclipped.rows()
+        self.decay.catch_up(rows, self.params['W'])
+        clip_rows(self.params['W'], rows, max_norm)
+        self.unclipped.clear()
         return
 
     def feedforward(self, X):
@@ -299,6 +806,9 @@ class LUTLayer:
         self._cleanup()
         # Record the incoming list of row indices to extract
         self.X = X.astype(np.uint32)
+        # Bring the rows to extract up to date with any pending l2 decay
+        self.decay.catch_up(self.X, self.params['W'])
+        self.unclipped.add(self.X)
         # Use look-up table to generate the desired sequences
         if (self.n_gram == 1):
             self.Y = self.params['W'].take(self.X, axis=0)
@@ -314,39 +824,64 @@ class LUTLayer:
         """Backprop through this layer.
         """
         assert(np.max(self.X) < self.key_count)
-        self.grad_idx.update(self.X.ravel())
+        if self.sparse_grads:
+            # add into the compact grad rows for the keys in self.X
+            X = self.grads['W'].rows_for(self.X)
+            dW = self.grads['W'].buf
+        else:
+            self.grad_rows.add(self.X)
+            dW = self.grads['W']
+            X = self.X
         # Add the gradients to the gradient accumulator
         if (self.n_gram == 1):
-            lut_bp(self.X, dLdY, self.grads['W'])
+            lut_bp(X, dLdY, dW)
         else:
             # Backprop for each of the predictor words
             dLdY_chunks = np.hsplit(dLdY, self.n_gram)
             for i in range(self.n_gram):
-                lut_bp(self.X[:,i], dLdY_chunks[i], self.grads['W'])
+                lut_bp(np.ascontiguousarray(X[:,i]), \
+                       np.ascontiguousarray(dLdY_chunks[i]), dW)
         return 1
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
+        """Add l2 regularization, which is applied lazily to each row."""
+        self.decay.decay(lam_l2)
         return 1
 
+    def finalize(self):
+        """Apply any pending l2 regularization to all rows."""
+        self.decay.finalize(self.params['W'])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        if self.sparse_grads:
+            self.grads['W'].apply(self.params['W'], self.moms['W'], learn_rate)
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
-        self.grad_idx = set()
+        self.grad_rows.clear()
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self.moms['W'].fill(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self._reset_grads()
+        self.moms['W'].fill(ada_init)
+        return
+
+    def _reset_grads(self):
+        """Zero the gradients, without allocating new arrays."""
+        if self.sparse_grads:
+            self.grads['W'].clear()
+        else:
+            self.grads['W'].fill(0.0)
+            self.grad_rows.clear()
         return
 
     def _cleanup(self):
@@ -360,9 +895,11 @@ class LUTLayer:
 ##########################
 
 class CMLayer:
-    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False):
+    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False, \
+                 sparse_grads=False):
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.sparse_grads = sparse_grads
         self.source_dim = source_dim
         self.bias_dim = bias_dim
         self.do_rescale = do_rescale # set to True for magical fun
@@ -370,12 +907,20 @@ class CMLayer:
         self.params['Wm'] = zeros((self.key_count, source_dim))
         self.params['Wb'] = zeros((self.key_count, bias_dim))
         self.grads = {}
-        self.grads['Wm'] = zeros(self.params['Wm'].shape)
-        self.grads['Wb'] = zeros(self.params['Wb'].shape)
+        if self.sparse_grads:
+            self.grads['Wm'] = SparseGrads(self.key_count, source_dim)
+            self.grads['Wb'] = SparseGrads(self.key_count, bias_dim)
+        else:
+            self.grads['Wm'] = zeros(self.params['Wm'].shape)
+            self.grads['Wb'] = zeros(self.params['Wb'].shape)
         self.moms = {}
         self.moms['Wm'] = zeros(self.params['Wm'].shape)
         self.moms['Wb'] = zeros(self.params['Wb'].shape)
-        self.grad_idx = set()
+        self.grad_rows = RowTracker(self.key_count)
+        self.unclipped = RowTracker(self.key_count)
+        self.unclipped.add_all()
+        self.decay = {'Wm': RowDecay(self.key_count), \
+                      'Wb': RowDecay(self.key_count)}
         # Set common stuff for all types layers
         self.X = []
         self.C = []
@@ -391,25 +936,28 @@ class CMLayer:
         assert((param == 'Wb') or (param == 'Wm'))
         if param == 'Wm':
             self.params['Wm'] = w_scale * randn((self.key_count, self.source_dim))
-            self.grads['Wm'] = zeros(self.params['Wm'].shape)
+            self._reset_grads('Wm')
+            self.decay['Wm'].reset()
         else:
             self.params['Wb'] = w_scale * randn((self.key_count, self.bias_dim))
-            self.grads['Wb'] = zeros(self.params['Wb'].shape)
+            self._reset_grads('Wb')
+            self.decay['Wb'].reset()
+        self.unclipped.add_all()
         return
 
     def clip_params(self, Wm_norm=5.0, Wb_norm=5.0):
-        """Bound L2 (row-wise) norm of Wm and Wb by max_norm."""
+        """Bound L2 (row-wise) norm of Wm and Wb by max_norm, for the rows
+        used since the last call (see clip_rows())."""
+        rows = self.unclipped.rows()
         for (param, max_norm) in zip(['Wm','Wb'],[Wm_norm, Wb_norm]):
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+            self.decay[param].catch_up(rows, self.params[param])
+            clip_rows(self.params[param], rows, max_norm)
+        self.unclipped.clear()
         return
 
     def norm_info(self, param_name='Wm'):
         """Diagnostic info about norms of W's rows."""
+        self.finalize()
         M = self.params[param_name]
         row_norms = np.sqrt(np.sum(M**2.0, axis=1))
         men_n = np.mean(row_norms)
@@ -428,6 +976,10 @@ class CMLayer:
         # Record the incoming list of row indices to extract
         self.X = X
         self.C = C.astype(np.uint32)
+        # Bring the rows to extract up to date with any pending l2 decay
+        self.decay['Wm'].catch_up(self.C, self.params['Wm'])
+        self.decay['Wb'].catch_up(self.C, self.params['Wb'])
+        self.unclipped.add(self.C)
         # Extract the relevant bias parameter rows
         Wb = self.params['Wb'].take(C, axis=0)
         if (self.bias_dim < 5):
@@ -457,7 +1009,17 @@ class CMLayer:
         """
         # Add the gradients to the gradient accumulators
         assert (np.max(self.C) < self.key_count)
-        self.grad_idx.update(self.C.ravel())
+        if self.sparse_grads:
+            # add into the compact grad rows for the keys in self.C
+            Cm = self.grads['Wm'].rows_for(self.C) if self.do_rescale else None
+            Cb = self.grads['Wb'].rows_for(self.C)
+            dWm = self.grads['Wm'].buf
+            dWb = self.grads['Wb'].buf
+        else:
+            self.grad_rows.add(self.C)
+            Cm = Cb = self.C
+            dWm = self.grads['Wm']
+            dWb = self.grads['Wb']
         self.dLdY = dLdY
         dLdYb, dLdYw = np.hsplit(dLdY, [self.bias_dim])
         dLdYb = dLdYb.copy() # copy, because hsplit leaves the new arrays in
@@ -467,14 +1029,17 @@ class CMLayer:
                              # that are in contiguous memory
         if self.do_rescale:
             dLdW = (self.Wm_sig / self.Wm_exp) * self.X * dLdYw
-            lut_bp(self.C, dLdW, self.grads['Wm'])
-        lut_bp(self.C, dLdYb, self.grads['Wb'])
+            lut_bp(Cm, dLdW, dWm)
+        lut_bp(Cb, dLdYb, dWb)
         dLdX = self.Wm_sig * dLdYw
         return dLdX
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        if self.sparse_grads:
+            self._apply_sparse(learn_rate)
+            return
+        nz_idx = self.grad_rows.rows()
         # Information from the word LUT should not pass through this
         # layer when source_dim < 5. In this case, we assume that we
         # will do prediction using only the context-adaptive biases.
@@ -488,27 +1053,51 @@ class CMLayer:
         b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
         ag_update_2d(nz_idx, self.params['Wb'], self.grads['Wb'], \
                      self.moms['Wb'], b_rate)
-        self.grad_idx = set()
+        self.grad_rows.clear()
         return
 
     def l2_regularize(self, lam_Wm=1e-5, lam_Wb=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wm'] -= lam_Wm * self.params['Wm']
-        self.params['Wb'] -= lam_Wb * self.params['Wb']
+        """Add l2 regularization, which is applied lazily to each row."""
+        self.decay['Wm'].decay(lam_Wm)
+        self.decay['Wb'].decay(lam_Wb)
         return 1
 
+    def finalize(self):
+        """Apply any pending l2 regularization to all rows."""
+        self.decay['Wm'].finalize(self.params['Wm'])
+        self.decay['Wb'].finalize(self.params['Wb'])
+        return
+
+    def _apply_sparse(self, learn_rate):
+        """Apply the grads accumulated in sparse_grads mode."""
+        # (the learning rates are chosen as in apply_grad)
+        if self.do_rescale:
+            m_rate = learn_rate if (self.source_dim >= 5) else 0.0
+            self.grads['Wm'].apply(self.params['Wm'], self.moms['Wm'], m_rate)
+        b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
+        self.grads['Wb'].apply(self.params['Wb'], self.moms['Wb'], b_rate)
+        return
+
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self.moms['Wm'].fill(ada_init)
+        self.moms['Wb'].fill(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['Wm'] = (0.0 * self.grads['Wm'])
-        self.grads['Wb'] = (0.0 * self.grads['Wb'])
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self._reset_grads('Wm')
+        self._reset_grads('Wb')
+        self.moms['Wm'].fill(ada_init)
+        self.moms['Wb'].fill(ada_init)
+        return
+
+    def _reset_grads(self, param):
+        """Zero the gradients for param, without allocating new arrays."""
+        if self.sparse_grads:
+            self.grads[param].clear()
+        else:
+            self.grads[param].fill(0.0)
         return
 
     def _cleanup(self):
@@ -622,11 +1211,15 @@ class TanhLayer:
 ################################
 
 class W2VLayer:
-    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3):
+    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3, \
+                 conc_mode='shared', sparse_grads=False):
         # Set basic layer parameters. The max_word_key passed as an argument
         # is incremented by 1 to accommodate 0 indexing.
+        assert(conc_mode in CONC_MODES)
         self.word_dim = word_dim
         self.word_count = max_word_key + 1
+        self.conc_mode = conc_mode
+        self.sparse_grads = sparse_grads
         # Initialize arrays for tracking parameters, gradients, and
         # adagrad "momentums" (i.e. sums of squared gradients).
         self.params = {}
@@ -634,9 +1227,7 @@ class W2VLayer:
         self.params['Wc'] = 0.01 * randn((self.word_count, word_dim))
         self.params['b'] = zeros((self.word_count,))
         self.grads = {}
-        self.grads['Wa'] = zeros((self.word_count, word_dim))
-        self.grads['Wc'] = zeros((self.word_count, word_dim))
-        self.grads['b'] = zeros((self.word_count,))
+        self._init_grads()
         self.moms = {}
         self.moms['Wa'] = zeros((self.word_count, word_dim))
         self.moms['Wc'] = zeros((self.word_count, word_dim))
@@ -646,38 +1237,107 @@ class W2VLayer:
         # Initialize sets for tracking which words we have trained
         self.trained_Wa = set()
         self.trained_Wc = set()
+        # Row stamps/slots and per-batch buffers for the fused training
+        # kernels are created on first use (see batch_train_fused)
+        self.fused_epoch = 0
+        self.a_stamp = None
+        self.a_slot = None
+        self.c_stamp = None
+        self.c_slot = None
+        self.fused_bufs = None
+        # Reusable grad shards for the sharded kernel
+        self.scratch = ScratchBuffers()
+        # Initialize trackers for lazy (per-row) l2 regularization, and for
+        # the rows to check in clip_params()
+        self.decay = {'Wa': RowDecay(self.word_count), \
+                      'Wc': RowDecay(self.word_count)}
+        self.unclipped = {'Wa': RowTracker(self.word_count), \
+                          'Wc': RowTracker(self.word_count)}
+        self.unclipped['Wa'].add_all()
+        self.unclipped['Wc'].add_all()
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['Wa'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wa'] = zeros((self.word_count, self.word_dim))
         self.moms['Wa'] = zeros((self.word_count, self.word_dim)) + 1e-3
         self.params['Wc'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wc'] = zeros((self.word_count, self.word_dim))
         self.moms['Wc'] = zeros((self.word_count, self.word_dim)) + 1e-3
         self.params['b'] = zeros((self.word_count,))
-        self.grads['b'] = zeros((self.word_count,))
         self.moms['b'] = zeros((self.word_count,)) + 1e-3
+        self._init_grads()
+        self.decay['Wa'].reset()
+        self.decay['Wc'].reset()
+        self.unclipped['Wa'].add_all()
+        self.unclipped['Wc'].add_all()
+        return
+
+    def grow(self, max_word_key, w_scale=0.01, ada_init=1e-3):
+        """Add rows for words with keys up to max_word_key.
+
+        The new rows of Wa and Wc are initialized as in init_params(), and
+        the existing rows are kept. All arrays indexed by word key grow with
+        spare capacity (see grow_rows()), so adding a few words at a time
+        doesn't copy all of the existing rows each time.
+        """
+        new_count = max_word_key + 1
+        assert(new_count >= self.word_count)
+        add_count = new_count - self.word_count
+        for name in ['Wa', 'Wc']:
+            self.params[name] = grow_rows(self.params[name], new_count, \
+                    fill=(w_scale * randn((add_count, self.word_dim))))
+        self.params['b'] = grow_rows(self.params['b'], new_count)
+        for name in ['Wa', 'Wc', 'b']:
+            if self.sparse_grads:
+                self.grads[name].grow(new_count)
+            else:
+                self.grads[name] = grow_rows(self.grads[name], new_count)
+            self.moms[name] = grow_rows(self.moms[name], new_count, \
+                                        fill=ada_init)
+        if not (self.a_stamp is None):
+            self.a_stamp = grow_rows(self.a_stamp, new_count, fill=-1)
+            self.a_slot = grow_rows(self.a_slot, new_count)
+            self.c_stamp = grow_rows(self.c_stamp, new_count, fill=-1)
+            self.c_slot = grow_rows(self.c_slot, new_count)
+        self.decay['Wa'].grow(new_count)
+        self.decay['Wc'].grow(new_count)
+        for name in ['Wa', 'Wc']:
+            # the new rows haven't been clipped yet
+            self.unclipped[name].grow(new_count)
+            self.unclipped[name].add(np.arange(self.word_count, new_count))
+        self.word_count = new_count
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of Wa and Wc by max_norm."""
+        """Bound L2 (row-wise) norm of Wa and Wc by max_norm, for the rows
+        used since the last call (see clip_rows())."""
         for param in ['Wa', 'Wc']:
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+            rows = self.unclipped[param].rows()
+            self.decay[param].catch_up(rows, self.params[param])
+            clip_rows(self.params[param], rows, max_norm)
+            self.unclipped[param].clear()
         return
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
+        """Add l2 regularization, which is applied lazily to each row."""
+        self.decay['Wa'].decay(lam_l2)
+        self.decay['Wc'].decay(lam_l2)
         return 1
 
+    def finalize(self):
+        """Apply any pending l2 regularization to all rows."""
+        self.decay['Wa'].finalize(self.params['Wa'])
+        self.decay['Wc'].finalize(self.params['Wc'])
+        return
+
+    def _catch_up(self, anc_idx, pn_idx):
+        """Apply any pending l2 regularization to the rows for a batch."""
+        self.decay['Wa'].catch_up(anc_idx, self.params['Wa'])
+        self.decay['Wc'].catch_up(pn_idx, self.params['Wc'])
+        self.unclipped['Wa'].add(anc_idx)
+        self.unclipped['Wc'].add(pn_idx)
+        return
+
     def batch_train(self, anc_idx, pos_idx, neg_idx, learn_rate=1e-3):
         """Perform a batch update of all parameters based on the given sets
         of anchor, positive example, and negative example indices.
@@ -688,15 +1348,60 @@ class W2VLayer:
         pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
         pn_sign = -1.0 * ones(pn_idx.shape)
         pn_sign[:,0] = 1.0
-        L = zeros((1,))
-        # Do feedforward and backprop through the predictor/predictee tables
-        w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
-                  self.params['Wc'], self.params['b'], self.grads['Wa'], \
-                  self.grads['Wc'], self.grads['b'], L, 1)
-        L = L[0]
+        self._catch_up(anc_idx, pn_idx)
+        if (self.conc_mode == 'hogwild'):
+            # Do feedforward, backprop, and updates all in one go
+            L = zeros((anc_idx.shape[0],))
+            w2v_hogwild(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                        self.params['Wc'], self.params['b'], self.moms['Wa'], \
+                        self.moms['Wc'], self.moms['b'], L, learn_rate)
+            return np.sum(L)
+        if (self.conc_mode == 'sharded') or self.sparse_grads:
+            # Do feedforward and backprop into per-thread grad shards, and
+            # then merge the shards into the (touched only) grad rows
+            a_mod_idx, a_cidx = np.unique(anc_idx, return_inverse=True)
+            c_mod_idx, c_cidx = np.unique(pn_idx, return_inverse=True)
+            a_cidx = a_cidx.astype(np.int32)
+            c_cidx = c_cidx.reshape(pn_idx.shape).astype(np.int32)
+            pool = get_pool()
+            shard_idx, shard_count = shard_rows(anc_idx.shape[0], pool)
+            dWa_s = self.scratch.zeros('dWa_s', \
+                    (shard_count, a_mod_idx.size, self.word_dim))
+            dWc_s = self.scratch.zeros('dWc_s', \
+                    (shard_count, c_mod_idx.size, self.word_dim))
+            db_s = self.scratch.zeros('db_s', (shard_count, c_mod_idx.size))
+            L = zeros((anc_idx.shape[0],))
+            w2v_ff_bp_shard(shard_idx, anc_idx, a_cidx, pn_idx, c_cidx, \
+                            pn_sign, self.params['Wa'], self.params['Wc'], \
+                            self.params['b'], dWa_s, dWc_s, db_s, L, \
+                            pool=pool)
+            L = np.sum(L)
+            # Merge the shards, also into reusable buffers
+            dWa = np.sum(dWa_s, axis=0, out=self.scratch.get('dWa', dWa_s.shape[1:]))
+            dWc = np.sum(dWc_s, axis=0, out=self.scratch.get('dWc', dWc_s.shape[1:]))
+            db = np.sum(db_s, axis=0, out=self.scratch.get('db', db_s.shape[1:]))
+            if self.sparse_grads:
+                # Apply the merged grads straight from the compact buffers
+                self.grads['Wa'].add(a_mod_idx, dWa)
+                self.grads['Wc'].add(c_mod_idx, dWc)
+                self.grads['b'].add(c_mod_idx, db)
+                for name in ['Wa', 'Wc', 'b']:
+                    self.grads[name].apply(self.params[name], \
+                                           self.moms[name], learn_rate)
+                return L
+            self.grads['Wa'][a_mod_idx] += dWa
+            self.grads['Wc'][c_mod_idx] += dWc
+            self.grads['b'][c_mod_idx] += db
+        else:
+            L = zeros((1,))
+            # Do feedforward and backprop through the predictor/predictee tables
+            w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                      self.params['Wc'], self.params['b'], self.grads['Wa'], \
+                      self.grads['Wc'], self.grads['b'], L, 1)
+            L = L[0]
+            a_mod_idx = np.unique(anc_idx)
+            c_mod_idx = np.unique(pn_idx)
         # Apply gradients to (touched only) look-up-table parameters
-        a_mod_idx = np.unique(anc_idx)
-        c_mod_idx = np.unique(pn_idx)
         ag_update_2d(a_mod_idx, self.params['Wa'], self.grads['Wa'], \
                 self.moms['Wa'], learn_rate)
         ag_update_2d(c_mod_idx, self.params['Wc'], self.grads['Wc'], \
@@ -705,6 +1410,75 @@ class W2VLayer:
                 self.moms['b'], learn_rate)
         return L
 
+    def batch_train_fused(self, anc_idx, pos_idx, neg_idx, learn_rate=1e-3):
+        """Perform the same update as batch_train, using the fused kernels.
+
+        The fused kernels do the feedforward, backprop, and adagrad updates
+        for only the touched rows, using small reusable per-batch buffers
+        rather than the dense self.grads arrays. After one serial pass to
+        group the batch by touched row, the work is split across the worker
+        pool so that no two threads write to the same row, and the grads for
+        each row are summed in a fixed order. So, self.conc_mode doesn't
+        apply here.
+        """
+        # Force incoming LUT indices to the right type (i.e. np.uint32)
+        anc_idx = anc_idx.astype(np.uint32)
+        pos_idx = pos_idx[:,np.newaxis]
+        pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
+        pn_sign = -1.0 * ones(pn_idx.shape)
+        pn_sign[:,0] = 1.0
+        self._catch_up(anc_idx, pn_idx)
+        # Create the row stamps/slots, if this is the first fused update
+        if self.a_stamp is None:
+            self.a_stamp = -1 * np.ones((self.word_count,), dtype=np.int32)
+            self.a_slot = np.zeros((self.word_count,), dtype=np.int32)
+            self.c_stamp = -1 * np.ones((self.word_count,), dtype=np.int32)
+            self.c_slot = np.zeros((self.word_count,), dtype=np.int32)
+            self.fused_epoch = 0
+        # Grow the per-batch buffers if this batch might not fit
+        if (self.fused_bufs is None) or \
+                (self.fused_bufs['a_list'].shape[0] < anc_idx.size) or \
+                (self.fused_bufs['c_list'].shape[0] < pn_idx.size):
+            self.fused_bufs = {}
+            self.fused_bufs['a_rows'] = np.zeros((anc_idx.size,), dtype=np.uint32)
+            self.fused_bufs['a_ptr'] = np.zeros((anc_idx.size+1,), dtype=np.int32)
+            self.fused_bufs['a_list'] = np.zeros((anc_idx.size,), dtype=np.int32)
+            self.fused_bufs['c_rows'] = np.zeros((pn_idx.size,), dtype=np.uint32)
+            self.fused_bufs['c_ptr'] = np.zeros((pn_idx.size+1,), dtype=np.int32)
+            self.fused_bufs['c_list'] = np.zeros((pn_idx.size,), dtype=np.int32)
+            self.fused_bufs['dWa'] = zeros((anc_idx.size, self.word_dim))
+            self.fused_bufs['counts'] = np.zeros((2,), dtype=np.int32)
+        bufs = self.fused_bufs
+        # Use a fresh epoch, so that all row stamps from previous calls are
+        # treated as stale
+        self.fused_epoch += 1
+        if (self.fused_epoch >= np.iinfo(np.int32).max):
+            self.a_stamp[:] = -1
+            self.c_stamp[:] = -1
+            self.fused_epoch = 0
+        w2v_fused_slots(anc_idx, pn_idx, self.a_stamp, self.a_slot, \
+                        self.c_stamp, self.c_slot, bufs['a_rows'], \
+                        bufs['a_ptr'], bufs['a_list'], bufs['c_rows'], \
+                        bufs['c_ptr'], bufs['c_list'], bufs['counts'], \
+                        self.fused_epoch)
+        a_count, c_count = bufs['counts']
+        a_rows = bufs['a_rows'][0:a_count]
+        c_rows = bufs['c_rows'][0:c_count]
+        # Get the loss and output grads, using the params from before this
+        # update, then sum and apply the grads for each touched row
+        G = zeros(pn_idx.shape)
+        L = zeros((anc_idx.shape[0],))
+        w2v_fused_g(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                    self.params['Wc'], self.params['b'], G, L)
+        w2v_fused_anc(a_rows, bufs['a_ptr'], bufs['a_list'], pn_idx, G, \
+                      self.params['Wc'], bufs['dWa'])
+        w2v_fused_ctx(c_rows, bufs['c_ptr'], bufs['c_list'], anc_idx, G, \
+                      self.params['Wa'], self.params['Wc'], self.params['b'], \
+                      self.moms['Wc'], self.moms['b'], learn_rate)
+        w2v_fused_apply(a_rows, bufs['dWa'], self.params['Wa'], \
+                        self.moms['Wa'], learn_rate)
+        return np.sum(L)
+
     def batch_test(self, anc_idx, pos_idx, neg_idx):
         """Run a batch through the model, computing losses but not grads.
         """
@@ -713,38 +1487,47 @@ class W2VLayer:
         pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
         pn_sign = ones(pn_idx.shape)
         pn_sign[:,0] = -1.0
+        self._catch_up(anc_idx, pn_idx)
         L = zeros((1,))
+        if self.sparse_grads:
+            # No grads are written, so the kernel just needs some buffers
+            w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                   self.params['Wc'], self.params['b'], self.grads['Wa'].buf, \
+                   self.grads['Wc'].buf, self.grads['b'].buf, L, 0)
+            return L[0]
         # Do feedforward and backprop through the predictor/predictee tables
         w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
                self.params['Wc'], self.params['b'], self.grads['Wa'], \
                self.grads['Wc'], self.grads['b'], L, 0)
-        self.grads['Wa'] = 0.0 * self.grads['Wa']
-        self.grads['Wc'] = 0.0 * self.grads['Wc']
-        self.grads['b'] = 0.0 * self.grads['b']
         L = L[0]
         return L
 
-    def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
-        return
-
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        for name in ['Wa', 'Wc', 'b']:
+            self.moms[name].fill(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['Wa'] = (0.0 * self.grads['Wa']) + ada_init
-        self.grads['Wc'] = (0.0 * self.grads['Wc']) + ada_init
-        self.grads['b'] = (0.0 * self.grads['b']) + ada_init
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        for name in ['Wa', 'Wc', 'b']:
+            if self.sparse_grads:
+                self.grads[name].clear()
+            else:
+                self.grads[name].fill(0.0)
+            self.moms[name].fill(ada_init)
+        return
+
+    def _init_grads(self):
+        """Allocate (zeroed) gradient accumulators for this layer."""
+        if self.sparse_grads:
+            self.grads['Wa'] = SparseGrads(self.word_count, self.word_dim)
+            self.grads['Wc'] = SparseGrads(self.word_count, self.word_dim)
+            self.grads['b'] = SparseGrads(self.word_count)
+        else:
+            self.grads['Wa'] = zeros((self.word_count, self.word_dim))
+            self.grads['Wc'] = zeros((self.word_count, self.word_dim))
+            self.grads['b'] = zeros((self.word_count,))
         return
 
 ###################################
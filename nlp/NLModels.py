@@ -4,6 +4,9 @@ import NLMLayers as nlml
 import cPickle as pickle
 from HelperFuncs import zeros, ones, randn, rand_word_seqs
 import CorpusUtils as cu
+import BatchProducer as bp
+import NeighborSearch as ns
+from NumbaFuncs import pv_infer
 
 class PVModel:
     """
@@ -21,6 +24,10 @@ class PVModel:
       lam_wv: l2 regularization parameter for word vectors
       lam_cv: l2 regularization parameter for context vectors
       lam_cl: l2 regularization parameter for weights in classification layer
+      sparse_grads: if True, layers keep grads only for the rows touched by
+                    each batch (see NLMLayers.SparseGrads)
+      hsm_codes: HSM codes for all words, in the form produced by
+                 CorpusUtils.csr_codes() (see set_hsm_codes())
 
     Note: This implementation also passes the word/context vectors through
           an extra "noise layer" prior to the HSM layer. The noise layer adds
@@ -28,10 +35,12 @@ class PVModel:
           noise for stronger regularization.
     """
     def __init__(self, wv_dim, cv_dim, max_wv_key, max_cv_key, max_hs_key, \
-                 pre_words=5, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4):
+                 pre_words=5, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4, \
+                 sparse_grads=False):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.cv_dim = cv_dim
+        self.sparse_grads = sparse_grads
         # Add 1 to the requested max word key, to accommodate the "NULL" key
         # that will be assigned to parts of an n-gram that don't exist.
         self.max_wv_key = max_wv_key + 1
@@ -42,21 +51,24 @@ class PVModel:
         self.lam_cv = lam_cv
         self.lam_cl = lam_cl
         self.reg_freq = 20
+        self.hsm_codes = None
         # Set noise layer parameters (for better regularization, perhaps)
         self.drop_rate = 0.0
         self.fuzz_scale = 0.0
         # Create layers to use during training
         self.word_layer = nlml.LUTLayer(self.max_wv_key, wv_dim, \
-                                        n_gram=self.pre_words)
+                                        n_gram=self.pre_words, \
+                                        sparse_grads=sparse_grads)
         self.context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                           source_dim=wv_dim, \
                                           bias_dim=cv_dim, \
-                                          do_rescale=False)
+                                          do_rescale=False, \
+                                          sparse_grads=sparse_grads)
         self.noise_layer = nlml.NoiseLayer(drop_rate=self.drop_rate, \
                                            fuzz_scale=self.fuzz_scale)
         self.class_layer = nlml.HSMLayer(\
                 in_dim=(self.cv_dim + (self.pre_words * self.wv_dim)), \
-                max_hs_key=self.max_hs_key)
+                max_hs_key=self.max_hs_key, sparse_grads=sparse_grads)
         return
 
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
@@ -67,6 +79,15 @@ class PVModel:
         self.fuzz_scale = fuzz_scale
         return
 
+    def set_hsm_codes(self, hsm_codes):
+        """
+        Set the HSM codes used by train() and infer_context_vectors(), in the
+        form produced by CorpusUtils.csr_codes() (e.g. the 'csr_codes' in an
+        hs_tree from CorpusUtils.build_vocab()).
+        """
+        self.hsm_codes = hsm_codes
+        return
+
     def init_params(self, weight_scale=0.05):
         """Reset weights in the context LUT and softmax layers."""
         self.word_layer.init_params(weight_scale)
@@ -81,16 +102,23 @@ class PVModel:
         self.class_layer.reset_moms(ada_init)
         return
 
-    def batch_update(self, pre_keys, post_code_keys, post_code_signs, \
-            phrase_keys, train_ctx=True, train_lut=True, train_cls=True, \
-            learn_rate=1e-3):
+    def finalize(self):
+        """Apply any pending (lazy) l2 regularization in each layer."""
+        self.word_layer.finalize()
+        self.context_layer.finalize()
+        self.class_layer.finalize()
+        return
+
+    def batch_update(self, pre_keys, post_keys, hsm_codes, phrase_keys, \
+            train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3):
         """
         Perform a single "minibatch" update of the model parameters.
 
         Parameters:
             pre_keys: keys for the n-1 items in each n-gram to predict with
-            post_code_keys: hsm code keys for the words to-be-predicted
-            post_code_signs: hsm code signs for the words to-be-predicted
+            post_keys: LUT keys for the words to-be-predicted
+            hsm_codes: hsm codes for all words, in the form produced by
+                       CorpusUtils.csr_codes()
             phrase_keys: LUT keys for context/phrase vectors
             train_ctx: train the per context/phrase bias vectors
             train_lut: train the basic word LUT vectors
@@ -103,8 +131,8 @@ class PVModel:
         Xn = self.noise_layer.feedforward(Xc)
 
         # Turn the corner with feedforward and backprop at class layer
-        dLdXn, L = self.class_layer.ff_bp(Xn, post_code_keys, \
-                post_code_signs, do_grad=True)
+        dLdXn, L = self.class_layer.ff_bp(Xn, post_keys, hsm_codes, \
+                do_grad=True)
 
         # Backprop through remaining layers
         dLdXc = self.noise_layer.backprop(dLdXn)
@@ -120,38 +148,39 @@ class PVModel:
             self.class_layer.apply_grad(learn_rate=learn_rate)
         return L
 
-    def train(self, ngram_sampler, hsm_code_keys, hsm_code_signs, batch_size, \
-            batch_count, train_ctx=True, train_lut=True, train_cls=True, \
-            learn_rate=1e-3):
+    def train(self, ngram_sampler, batch_size, batch_count, train_ctx=True, \
+            train_lut=True, train_cls=True, learn_rate=1e-3, prefetch=2, \
+            seed=None):
         """
-        Train all parameters in the model using the given phrases.
+        Train all parameters in the model using the given phrases. The HSM
+        codes must have been given to set_hsm_codes().
 
         Parameters:
             ngram_sampler: a sampler that produces ngrams in LUT key form,
                            along with keys to their source context/phrase.
-            hsm_code_keys: table mapping word keys to their hsm code keys
-            hsm_code_signs: table mapping word keys to their hsm code signs
             batch_size: size of minibatches for each update
             batch_count: number of minibatch updates to perform
             train_ctx: train the per context/phrase bias vectors
             train_lut: train the basic word LUT vectors
             train_cls: train the hierarchical softmax parameters
             learn_rate: learning rate to use for updates
+            prefetch: number of minibatches to sample ahead of training, on a
+                      background thread (0 samples on the calling thread)
+            seed: seed for sampling minibatches (None draws one from npr)
         """
         L = 0.0
         self.word_layer.reset_moms(ada_init=1.0)
         self.context_layer.reset_moms(ada_init=1.0)
         self.class_layer.reset_moms(ada_init=1.0)
-        pad_key = np.asarray([0]).astype(np.uint32)
+        assert(not (self.hsm_codes is None))
+        source = bp.NGramSource(ngram_sampler, self.pre_words+1, \
+                self.max_wv_key)
+        producer = bp.BatchProducer(source, batch_size, batch_count, \
+                depth=prefetch, seed=seed)
         print("Training all parameters:")
-        for b in range(batch_count):
-            [seq_keys, phrase_keys] = ngram_sampler.sample_ngrams( \
-                batch_size, gram_n=self.pre_words+1, pad_key=self.max_wv_key)
-            pre_keys = seq_keys[:,0:-1]
-            post_keys = seq_keys[:,-1]
-            post_code_keys = hsm_code_keys.take(post_keys,axis=0)
-            post_code_signs = hsm_code_signs.take(post_keys,axis=0)
-            L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
+        for b, batch in enumerate(producer):
+            [pre_keys, post_keys, phrase_keys] = batch
+            L += self.batch_update(pre_keys, post_keys, self.hsm_codes, \
                     phrase_keys, train_ctx=train_ctx, train_lut=train_lut, \
                     train_cls=train_cls, learn_rate=learn_rate)
             # apply l2 regularization, but not every round (to save flops)
@@ -173,18 +202,18 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.finalize()
         return
 
-    def infer_context_vectors(self, ngram_sampler, hsm_code_keys, hsm_code_signs, \
-            batch_size, batch_count, learn_rate=1e-3):
+    def infer_context_vectors(self, ngram_sampler, batch_size, batch_count, \
+            learn_rate=1e-3):
         """
-        Train context/paragraph vectors for each of the given phrases.
+        Train context/paragraph vectors for each of the given phrases. The HSM
+        codes must have been given to set_hsm_codes().
 
         Parameters:
             ngram_sampler: a sampler that produces ngrams in LUT key form,
                            along with keys to their source phrases.
-            hsm_code_keys: table matching word keys to their hsm code keys
-            hsm_code_signs: table matching word keys to their hsm code signs
             batch_size: batch size for minibatch updates
             batch_count: number of minibatch updates to perform
             learn_rate: learning rate for parameter updates
@@ -195,12 +224,14 @@ class PVModel:
         new_context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                          source_dim=self.wv_dim, \
                                          bias_dim=self.cv_dim, \
-                                         do_rescale=False)
+                                         do_rescale=False, \
+                                         sparse_grads=self.sparse_grads)
         new_context_layer.init_params(0.02, param='Wb')
         prev_context_layer = self.context_layer
         self.context_layer = new_context_layer
         # Update the context vectors in the new context layer for some number
         # of minibatch update rounds
+        assert(not (self.hsm_codes is None))
         L = 0.0
         print("Training new context vectors:")
         for b in range(batch_count):
@@ -208,9 +239,7 @@ class PVModel:
                     gram_n=self.pre_words+1, pad_key=self.max_wv_key)
             pre_keys = seq_keys[:,0:-1]
             post_keys = seq_keys[:,-1]
-            post_code_keys = hsm_code_keys.take(post_keys,axis=0)
-            post_code_signs = hsm_code_signs.take(post_keys,axis=0)
-            L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
+            L += self.batch_update(pre_keys, post_keys, self.hsm_codes, \
                     phrase_keys, train_ctx=True, train_lut=False, \
                     train_cls=False, learn_rate=learn_rate)
             # apply l2 regularization, but not every round (to save flops)
@@ -227,6 +256,8 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        # Apply any l2 regularization still pending for the new vectors
+        new_context_layer.finalize()
         # Set self.context_layer back to what it was prior to retraining
         self.context_layer = prev_context_layer
         # reset gradient and adagrad momentum acccumulators, which get
@@ -237,6 +268,115 @@ class PVModel:
         self.class_layer.reset_grads_and_moms()
         return new_context_layer
 
+class PVInferenceEngine:
+    """
+    Infers context/paragraph vectors for new phrases, using a trained PVModel.
+
+    Unlike PVModel.infer_context_vectors(), this doesn't build a new CMLayer
+    sized for the whole collection of phrases or touch any state in the model.
+    The engine keeps its own snapshot of the word LUT and HSM params (with any
+    pending l2 regularization applied), taken when it's created, so training
+    of the model can continue independently. Each phrase in a request gets a
+    "slot" in a small pool of context vectors (and their adagrad moments),
+    which is reused across requests and grows as needed.
+    Each phrase is fit to all of its n-grams by the pv_infer kernel, with the
+    phrases split across the shared worker pool. So, the cost of a request is
+    proportional to the total length of its phrases. A phrase with fewer than
+    two words has no n-grams, so its context vector is left at its random
+    initial value (and adds nothing to the loss).
+
+    Important Parameters (accessible via self.*):
+      pv_model: the trained PVModel
+      Ww: snapshot of the word LUT vectors
+      Wc/bc: snapshot of the HSM weights and biases
+      code_offsets/code_keys/code_signs: HSM codes for all words, as produced
+                                         by CorpusUtils.csr_codes() (these
+                                         default to pv_model.hsm_codes)
+      slot_count: number of context vector slots currently allocated
+    """
+    def __init__(self, pv_model, hsm_codes=None, slot_count=64):
+        assert(not pv_model.context_layer.do_rescale)
+        self.pv_model = pv_model
+        # take copies of the frozen params, with any pending (lazy) l2
+        # regularization applied, without finalizing the model itself
+        word_layer = pv_model.word_layer
+        class_layer = pv_model.class_layer
+        self.Ww = word_layer.decay.decayed_copy(word_layer.params['W'])
+        self.Wc = class_layer.decay['W'].decayed_copy(class_layer.params['W'])
+        self.bc = class_layer.decay['b'].decayed_copy(class_layer.params['b'])
+        if hsm_codes is None:
+            hsm_codes = pv_model.hsm_codes
+        self.code_offsets = hsm_codes[0].astype(np.int64)
+        self.code_keys = hsm_codes[1].astype(np.uint32)
+        self.code_signs = hsm_codes[2].astype(np.float32)
+        self.slot_count = 0
+        self.C = None
+        self.mC = None
+        self._grow_slots(slot_count)
+        return
+
+    def _grow_slots(self, slot_count):
+        """Make sure there are at least slot_count context vector slots."""
+        if (slot_count > self.slot_count):
+            self.slot_count = max(slot_count, 2 * self.slot_count)
+            self.C = zeros((self.slot_count, self.pv_model.cv_dim))
+            self.mC = zeros((self.slot_count, self.pv_model.cv_dim))
+        return
+
+    def _make_targets(self, tokens, offsets):
+        """
+        Get the predictor word vectors and the predicted word keys for every
+        n-gram in the given phrases (i.e. one n-gram per word after the first
+        in each phrase), along with the offsets of each phrase's n-grams and
+        where each n-gram's codes start in a flat per-code buffer (and the
+        size of that buffer). Phrases with fewer than two words get no
+        n-grams.
+        """
+        pvm = self.pv_model
+        gram_counts = np.maximum(np.diff(offsets) - 1, 0)
+        # positions of the predicted words in tokens, and their phrases
+        t_phrases = np.repeat(np.arange(gram_counts.size), gram_counts)
+        t_offsets = np.zeros((gram_counts.size + 1,), dtype=np.int64)
+        t_offsets[1:] = np.cumsum(gram_counts)
+        t_pos = np.arange(t_offsets[-1]) - t_offsets[t_phrases] + \
+                offsets[t_phrases] + 1
+        # keys for the predictor words, using the padding key before the start
+        # of a phrase (as in PhraseSampler.sample_ngrams())
+        pre_pos = t_pos[:,np.newaxis] - np.arange(pvm.pre_words, 0, -1)
+        pre_keys = tokens[np.maximum(pre_pos, 0)]
+        pre_keys[pre_pos < offsets[t_phrases][:,np.newaxis]] = pvm.max_wv_key
+        Xw = self.Ww.take(pre_keys.ravel(), axis=0)
+        Xw = Xw.reshape((pre_keys.shape[0], pvm.pre_words * pvm.wv_dim))
+        post_keys = tokens[t_pos].astype(np.uint32)
+        code_lens = self.code_offsets[post_keys+1] - self.code_offsets[post_keys]
+        row_starts = np.cumsum(code_lens) - code_lens
+        return [t_offsets, Xw, post_keys, row_starts, int(np.sum(code_lens))]
+
+    def infer(self, phrase_list, epochs=20, learn_rate=1e-2, seed=None):
+        """
+        Infer a context vector for each phrase in phrase_list, which can be a
+        list of word key arrays or a FlatCorpus. Returns an array with one
+        row per phrase, and the mean per-word loss in the final epoch.
+        """
+        pvm = self.pv_model
+        tokens, offsets = cu.flatten_phrases(phrase_list)
+        phrase_count = offsets.size - 1
+        t_offsets, Xw, post_keys, row_starts, code_count = \
+                self._make_targets(tokens, offsets)
+        # initialize the context vector slots for this request
+        self._grow_slots(phrase_count)
+        rng = npr.RandomState(seed) if not (seed is None) else npr
+        C = self.C[0:phrase_count]
+        mC = self.mC[0:phrase_count]
+        C[:] = 0.02 * rng.randn(phrase_count, pvm.cv_dim)
+        mC[:] = 1.0
+        L = zeros((phrase_count,))
+        Yw = zeros((code_count,))
+        pv_infer(C, mC, L, t_offsets, Xw, post_keys, row_starts, \
+                 self.code_offsets, self.code_keys, self.code_signs, \
+                 self.Wc, self.bc, Yw, epochs, learn_rate, pvm.lam_cv)
+        return [C.copy(), np.sum(L) / max(1, Xw.shape[0])]
+
 ####################################
 # Context-adaptive Skip-gram Model #
 ####################################
@@ -254,6 +394,8 @@ class CAModel:
       lam_wv: l2 regularization parameter for word vectors
       lam_cv: l2 regularization parameter for context vectors
       lam_ns: l2 regularization parameter for negative sampling layer
+      sparse_grads: if True, layers keep grads only for the rows touched by
+                    each batch (see NLMLayers.SparseGrads)
 
     Note: This implementation also passes the word/context vectors through
           an extra "noise layer" prior to the negative sampling layer. The
@@ -261,10 +403,12 @@ class CAModel:
           Gaussian "weight fuzzing" noise for stronger regularization.
     """
     def __init__(self, wv_dim, cv_dim, max_wv_key, max_cv_key, use_ns=True, \
-                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4):
+                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4, \
+                 sparse_grads=False):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.cv_dim = cv_dim
+        self.sparse_grads = sparse_grads
         self.max_wv_key = max_wv_key
         self.max_cv_key = max_cv_key
         self.use_ns = use_ns
@@ -279,20 +423,24 @@ class CAModel:
         # Create layers to use during training
         self.use_tanh = True
         self.tanh_layer = nlml.TanhLayer()
-        self.word_layer = nlml.LUTLayer(max_wv_key, wv_dim)
+        self.word_layer = nlml.LUTLayer(max_wv_key, wv_dim, \
+                                        sparse_grads=sparse_grads)
         self.context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                           source_dim=wv_dim, \
                                           bias_dim=cv_dim, \
-                                          do_rescale=True)
+                                          do_rescale=True, \
+                                          sparse_grads=sparse_grads)
         self.noise_layer = nlml.NoiseLayer(drop_rate=self.drop_rate, \
                                            fuzz_scale=self.fuzz_scale)
         if self.use_ns:
             self.class_layer = nlml.NSLayer(in_dim=(self.cv_dim+self.wv_dim), \
-                                            max_out_key=self.max_wv_key)
+                                            max_out_key=self.max_wv_key, \
+                                            sparse_grads=sparse_grads)
         else:
             assert(self.max_hs_key > 0)
             self.class_layer = nlml.HSMLayer(in_dim=(self.cv_dim+self.wv_dim), \
-                                             max_hs_key=self.max_hs_key)
+                                             max_hs_key=self.max_hs_key, \
+                                             sparse_grads=sparse_grads)
         return
 
     def init_params(self, weight_scale=0.05):
@@ -309,6 +457,13 @@ class CAModel:
         self.class_layer.reset_moms(ada_init)
         return
 
+    def finalize(self):
+        """Apply any pending (lazy) l2 regularization in each layer."""
+        self.word_layer.finalize()
+        self.context_layer.finalize()
+        self.class_layer.finalize()
+        return
+
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
         """Set params for the noise injection (i.e. perturbation) layer."""
         self.noise_layer.set_noise_params(drop_rate=drop_rate, \
@@ -329,8 +484,8 @@ class CAModel:
                 param_1: LUT keys for positive prediction targets
                 param_2: LUT keys for negative prediction targets
             else:
-                param_1: LUT keys for HSM codes
-                param_2: Target classes (+1/-1) for HSM codes
+                param_1: LUT keys for the words whose HSM codes to predict
+                param_2: HSM codes for all words (see CorpusUtils.csr_codes)
             phrase_keys: phrase/context LUT keys for the phrases from which
                          the words to predict with (in anc_keys and param_1)
                          were sampled.
@@ -370,7 +525,8 @@ class CAModel:
         return L
 
     def train(self, pos_sampler, var_param, batch_size, batch_count, \
-              train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3):
+              train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3, \
+              prefetch=2, seed=None):
         """
         Train all parameters in the model using the given phrases.
 
@@ -379,27 +535,34 @@ class CAModel:
             if self.use_ns:
                 var_param: sampler for generating negative prediction pairs
             else:
-                var_param: dict containing HSM code keys and signs (in LUTs)
+                var_param: the 'hs_tree' dict from CorpusUtils.build_vocab()
             batch_size: size of minibatches for each update
             batch_count: number of minibatch updates to perform
             train_ctx: train the per context/phrase biases/modulators
             train_lut: train the basic word LUT vectors
             train_cls: train the classification layer parameters
             learn_rate: learning rate for adagrad updates
+            prefetch: number of minibatches to sample ahead of training, on a
+                      background thread (0 samples on the calling thread)
+            seed: seed for sampling minibatches (None draws one from npr)
         """
         print("Training all parameters:")
         L = 0.0
         self.word_layer.reset_moms(1.0)
         self.context_layer.reset_moms(1.0)
         self.class_layer.reset_moms(1.0)
-        for b in range(batch_count):
-            anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
+        if self.use_ns:
+            source = bp.PairSource(pos_sampler, neg_sampler=var_param)
+        else:
+            source = bp.PairSource(pos_sampler)
+        producer = bp.BatchProducer(source, batch_size, batch_count, \
+                depth=prefetch, seed=seed)
+        for b, batch in enumerate(producer):
             if self.use_ns:
-                param_1 = pos_keys
-                param_2 = var_param.sample(batch_size)
+                [anc_keys, param_1, phrase_keys, param_2] = batch
             else:
-                param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
-                param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+                [anc_keys, param_1, phrase_keys] = batch
+                param_2 = var_param['csr_codes']
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=train_ctx, train_lut=train_lut, \
                                    train_cls=train_cls, learn_rate=learn_rate)
@@ -422,6 +585,7 @@ class CAModel:
                 obs_count = 500.0 # * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.finalize()
         return
 
     def infer_context_vectors(self, pos_sampler, var_param, batch_size, \
@@ -434,7 +598,7 @@ class CAModel:
             if self.use_ns:
                 var_param: sampler for generating negative prediction pairs
             else:
-                var_param: dict containing HSM code keys and signs (in LUTs)
+                var_param: the 'hs_tree' dict from CorpusUtils.build_vocab()
             batch_size: size of minibatches for each update
             batch_count: number of minibatch updates to perform
         """
@@ -444,7 +608,8 @@ class CAModel:
         new_context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                          source_dim=self.wv_dim, \
                                          bias_dim=self.cv_dim, \
-                                         do_rescale=True)
+                                         do_rescale=True, \
+                                         sparse_grads=self.sparse_grads)
         new_context_layer.init_params(0.02)
         prev_context_layer = self.context_layer
         self.context_layer = new_context_layer
@@ -457,8 +622,8 @@ class CAModel:
                 param_1 = pos_keys
                 param_2 = var_param.sample(batch_size)
             else:
-                param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
-                param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+                param_1 = pos_keys
+                param_2 = var_param['csr_codes']
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=True, train_lut=False, \
                                    train_cls=False, learn_rate=learn_rate)
@@ -474,6 +639,8 @@ class CAModel:
                 obs_count = 500.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        # Apply any l2 regularization still pending for the new vectors
+        new_context_layer.finalize()
         # Set self.context_layer back to what it was previously
         self.context_layer = prev_context_layer
         # Reset gradients in all layers
@@ -494,17 +661,25 @@ class W2VModel:
       wv_dim: dimension of the word context/prediction vectors
       max_wv_key: max key of a valid word in the LUTs
       lam_l2: l2 regularization parameter for word vectors
+      conc_mode: concurrency mode for the W2VLayer (see NLMLayers.CONC_MODES)
+      use_fused: if True, train with the W2VLayer's fused kernels
+      sparse_grads: if True, the W2VLayer keeps grads only for the rows
+                    touched by each batch (see NLMLayers.SparseGrads)
     """
-    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4):
+    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4, conc_mode='shared', \
+                 use_fused=False, sparse_grads=False):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.max_wv_key = max_wv_key
         self.lam_l2 = lam_l2
+        self.use_fused = use_fused
         self.reg_freq = 20 # number of batches between regularization updates
         # Create the layer to use during training
         self.w2v_layer = nlml.W2VLayer(max_word_key=self.max_wv_key, \
                                        word_dim=self.wv_dim, \
-                                       lam_l2=self.lam_l2)
+                                       lam_l2=self.lam_l2, \
+                                       conc_mode=conc_mode, \
+                                       sparse_grads=sparse_grads)
         return
 
     def init_params(self, weight_scale=0.05):
@@ -517,6 +692,21 @@ class W2VModel:
         self.w2v_layer.reset_moms(ada_init)
         return
 
+    def finalize(self):
+        """Apply any pending (lazy) l2 regularization in each layer."""
+        self.w2v_layer.finalize()
+        return
+
+    def grow_vocab(self, max_wv_key, weight_scale=0.05):
+        """
+        Add word vectors for keys up to max_wv_key, keeping the trained
+        vectors for existing keys, so that training can continue with a
+        vocabulary extended by CorpusUtils.extend_vocab().
+        """
+        self.w2v_layer.grow(max_wv_key, w_scale=weight_scale)
+        self.max_wv_key = max_wv_key
+        return
+
     def batch_update(self, anc_keys, pos_keys, neg_keys, learn_rate=1e-3):
         """
         Perform a single "minibatch" update of the model parameters.
@@ -528,12 +718,16 @@ class W2VModel:
             learn_rate: learning rate for adagrad updates
         """
         # Update the W2VLayer using the given examples
-        L = self.w2v_layer.batch_train(anc_keys, pos_keys, neg_keys, \
-                                       learn_rate=learn_rate)
+        if self.use_fused:
+            L = self.w2v_layer.batch_train_fused(anc_keys, pos_keys, neg_keys, \
+                                                 learn_rate=learn_rate)
+        else:
+            L = self.w2v_layer.batch_train(anc_keys, pos_keys, neg_keys, \
+                                           learn_rate=learn_rate)
         return L
 
     def train(self, pos_sampler, neg_sampler, batch_size, batch_count, \
-              learn_rate=1e-3):
+              learn_rate=1e-3, prefetch=2, seed=None):
         """
         Train all parameters in the model using minibatches of samples drawn
         from the given pos_sampler and neg_sampler. pos_sampler should provide
@@ -546,12 +740,17 @@ class W2VModel:
             batch_size: size of minibatches for each update
             batch_count: number of minibatch updates to perform
             learn_rate: learning rate for adagrad updates
+            prefetch: number of minibatches to sample ahead of training, on a
+                      background thread (0 samples on the calling thread)
+            seed: seed for sampling minibatches (None draws one from npr)
         """
         L = 0.0
+        source = bp.PairSource(pos_sampler, neg_sampler=neg_sampler)
+        producer = bp.BatchProducer(source, batch_size, batch_count, \
+                depth=prefetch, seed=seed)
         print("Training all parameters:")
-        for b in range(batch_count):
-            anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
-            neg_keys = neg_sampler.sample(batch_size)
+        for b, batch in enumerate(producer):
+            [anc_keys, pos_keys, phrase_keys, neg_keys] = batch
             L += self.batch_update(anc_keys, pos_keys, neg_keys, learn_rate=learn_rate)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 lam_multi = self.reg_freq * learn_rate * self.lam_l2
@@ -560,6 +759,7 @@ class W2VModel:
                 obs_count = 1000.0# * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.finalize()
         return
 
     def test(self, pos_sampler, neg_sampler, test_samples):
@@ -586,26 +786,14 @@ def some_nearest_words(keys_to_words, sample_count, W1=None, W2=None):
         W = np.hstack((W1, W2))
     else:
         W = W1
-    norms = np.sqrt(np.sum(W**2.0,axis=1,keepdims=1))
-    W = W / (norms + 1e-5)
     max_valid_key = np.max(keys_to_words.keys())
-    W = W[0:(max_valid_key+1),:]
-    # 
-    source_keys = np.zeros((sample_count,)).astype(np.uint32)
-    neighbor_keys = np.zeros((sample_count, 10)).astype(np.uint32)
+    index = ns.ExactIndex(W[0:(max_valid_key+1),:])
+    # all source words are searched for in a single batch
     all_keys = np.asarray(keys_to_words.keys()).astype(np.uint32)
-    for s in range(sample_count):
-        i = npr.randint(0,all_keys.size)
-        source_k = all_keys[i]
-        neg_cos_sims = -1.0 * np.sum(W * W[source_k], axis=1)
-        sorted_k = np.argsort(neg_cos_sims)
-        source_keys[s] = source_k
-        neighbor_keys[s,:] = sorted_k[1:11]
-    source_words = []
-    neighbor_words = []
-    for s in range(sample_count):
-        source_words.append(keys_to_words[source_keys[s]])
-        neighbor_words.append([keys_to_words[k] for k in neighbor_keys[s]])
+    source_keys = all_keys[npr.randint(0, all_keys.size, size=(sample_count,))]
+    neighbor_keys, source_words, neighbor_words = \
+            ns.nearest_words(keys_to_words, source_keys, index, k=10)
+    neighbor_keys = neighbor_keys.astype(np.uint32)
     return [source_keys, neighbor_keys, source_words, neighbor_words]
 
 def test_cam_model():
@@ -671,8 +859,6 @@ def test_pv_model():
     sentences = cu.SentenceFileIterator(data_dir)
     tr_phrases = cu.sample_phrases(sentences, w2k, unk_word=unk_word, \
                                 max_phrases=100000)
-    hsm_code_keys = key_dicts['hs_tree']['keys_to_code_keys']
-    hsm_code_signs = key_dicts['hs_tree']['keys_to_code_signs']
     max_cv_key = len(tr_phrases) + 1
     max_wv_key = max(w2k.values()) + 1
     max_hs_key = key_dicts['hs_tree']['max_code_key']
@@ -689,22 +875,28 @@ def test_pv_model():
                  pre_words=5, lam_wv=lam_l2, lam_cv=lam_l2, lam_cl=lam_l2)
     pvm.init_params(0.02)
     pvm.set_noise(drop_rate=0.5, fuzz_scale=0.0)
+    pvm.set_hsm_codes(key_dicts['hs_tree']['csr_codes'])
 
     # Initialize samplers for training
     ngram_sampler = cu.PhraseSampler(tr_phrases, sg_window)
 
     # Train all parameters using the training set phrases
     for i in range(5):
-        pvm.train(ngram_sampler, hsm_code_keys, hsm_code_signs, 300, 10001, \
-                train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3)
+        pvm.train(ngram_sampler, 300, 10001, train_ctx=True, train_lut=True, \
+                train_cls=True, learn_rate=1e-3)
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                 W1=pvm.word_layer.params['W'], W2=None)
         for w in range(10):
             print("{0:s}: {1:s}".format(s_words[w],", ".join(n_words[w])))
 
-    context_vectors = pvm.infer_context_vectors( \
-            ngram_sampler, hsm_code_keys, hsm_code_signs, \
-            300, 20001, learn_rate=1e-3)
+    context_vectors = pvm.infer_context_vectors(ngram_sampler, 300, 20001, \
+                                                learn_rate=1e-3)
+
+    # Infer vectors for a few phrases without touching the trained model
+    engine = PVInferenceEngine(pvm)
+    new_phrases = tr_phrases[0:100]
+    C, L = engine.infer(new_phrases, epochs=20, learn_rate=1e-2)
+    print("Inferred {0:d} context vectors, loss {1:.4f}".format(C.shape[0], L))
     return
 
 def test_w2v_model():
@@ -0,0 +1,390 @@
+from __future__ import absolute_import
+
+import os
+import numpy as np
+import numpy.random as npr
+
+#
+# Nearest-neighbour search (by cosine similarity) over the rows of a matrix
+# of trained vectors, e.g. W2VLayer.params['Wa'], LUTLayer.params['W'] or
+# CMLayer.params['Wb'].
+#
+# ExactIndex scores a batch of queries against blocks of rows with one GEMM
+# per block and keeps a running top-k with argpartition, so no full sort of
+# the similarities is ever done. IVFIndex is an approximate "inverted file"
+# index: rows are clustered by spherical k-means, and each query is only
+# scored against the rows in the n_probe clusters whose centroids are most
+# similar to it. QuantizedIndex does exact search over rows stored as float16
+# or as int8 (with a scale per row), for compact serving of trained vectors.
+# All kinds of index can be saved to a directory of .npy files (like a
+# compiled corpus), which load_index() can memory-map.
+#
+
+def normalize_rows(W, eps=1e-5):
+    """Get a float32 copy of W with each row scaled to unit length."""
+    W = np.asarray(W, dtype=np.float32)
+    norms = np.sqrt(np.sum(W**2.0, axis=1, keepdims=True))
+    return W / (norms + eps)
+
+def _merge_top_k(best_idx, best_sims, idx, sims, k):
+    """Merge candidate (idx, sims) into the running top-k for each query."""
+    all_idx = np.hstack((best_idx, idx))
+    all_sims = np.hstack((best_sims, sims))
+    if (all_sims.shape[1] > k):
+        keep = np.argpartition(-all_sims, k-1, axis=1)[:,0:k]
+        rows = np.arange(all_sims.shape[0])[:,np.newaxis]
+        all_idx = all_idx[rows, keep]
+        all_sims = all_sims[rows, keep]
+    return [all_idx, all_sims]
+
+def _sort_top_k(best_idx, best_sims):
+    """Sort each row of a top-k result by decreasing similarity."""
+    order = np.argsort(-best_sims, axis=1)
+    rows = np.arange(best_sims.shape[0])[:,np.newaxis]
+    return [best_idx[rows, order], best_sims[rows, order]]
+
+def exact_top_k(Q, W, k, block_size=16384, query_block_size=1024, \
+                exclude=None):
+    """
+    Find the k rows of W with largest dot product with each row of Q.
+
+    Rows of Q are processed in blocks of query_block_size, and for each of
+    these the rows of W are processed in blocks of block_size, so memory use
+    is O(query_block_size * block_size) however many queries there are. If
+    exclude is given, row exclude[i] of W is never returned as a neighbour of
+    row i of Q (e.g. to skip the query word itself). Returns [idx, sims],
+    each of shape (Q.shape[0], k), sorted by decreasing similarity.
+    """
+    Q = np.asarray(Q, dtype=np.float32)
+    q_count = Q.shape[0]
+    k = min(k, W.shape[0])
+    top_idx = np.zeros((q_count, k), dtype=np.int64)
+    top_sims = np.zeros((q_count, k), dtype=np.float32)
+    for q_start in range(0, q_count, query_block_size):
+        q_end = min(q_start + query_block_size, q_count)
+        Q_block = Q[q_start:q_end]
+        q_rows = np.arange(q_end - q_start)[:,np.newaxis]
+        best_idx = np.zeros((q_end - q_start, 0), dtype=np.int64)
+        best_sims = np.zeros((q_end - q_start, 0), dtype=np.float32)
+        for b_start in range(0, W.shape[0], block_size):
+            b_end = min(b_start + block_size, W.shape[0])
+            sims = np.dot(Q_block, W[b_start:b_end].T)
+            if not (exclude is None):
+                q_exclude = exclude[q_start:q_end]
+                in_block = (q_exclude >= b_start) & (q_exclude < b_end)
+                sims[np.flatnonzero(in_block), \
+                     q_exclude[in_block] - b_start] = -np.inf
+            b_k = min(k, b_end - b_start)
+            b_idx = np.argpartition(-sims, b_k-1, axis=1)[:,0:b_k]
+            b_sims = sims[q_rows, b_idx]
+            best_idx, best_sims = _merge_top_k(best_idx, best_sims, \
+                                               b_idx + b_start, b_sims, k)
+        top_idx[q_start:q_end], top_sims[q_start:q_end] = \
+                _sort_top_k(best_idx, best_sims)
+    return [top_idx, top_sims]
+
+class ExactIndex(object):
+    """
+    Exact cosine-similarity search over the rows of W.
+    """
+    def __init__(self, W=None, block_size=16384):
+        self.block_size = block_size
+        self.W = None
+        if not (W is None):
+            self.W = normalize_rows(W)
+        return
+
+    def search(self, Q, k=10, exclude=None):
+        """Get [keys, sims] for the k nearest rows to each query vector."""
+        return exact_top_k(normalize_rows(Q), self.W, k, \
+                           block_size=self.block_size, exclude=exclude)
+
+    def search_keys(self, keys, k=10):
+        """Get [keys, sims] for the k nearest rows to each given row."""
+        keys = np.asarray(keys, dtype=np.int64)
+        return self.search(self.W[keys], k=k, exclude=keys)
+
+    def save(self, index_dir):
+        _save_arrays(index_dir, kind='exact', W=self.W, \
+                     block_size=self.block_size)
+        return
+
+def _spherical_kmeans(X, cluster_count, iters, rng):
+    """Cluster the (unit) rows of X, returning unit-length centroids."""
+    C = X[rng.choice(X.shape[0], size=cluster_count, replace=False)]
+    for i in range(iters):
+        assign = exact_top_k(X, C, 1)[0][:,0]
+        sums = np.zeros(C.shape, dtype=np.float64)
+        np.add.at(sums, assign, X)
+        sizes = np.bincount(assign, minlength=cluster_count)
+        # re-seed empty clusters with random rows
+        empty = np.flatnonzero(sizes == 0)
+        sums[empty] = X[rng.randint(0, X.shape[0], size=empty.size)]
+        C = normalize_rows(sums)
+    return C
+
+class IVFIndex(object):
+    """
+    Approximate cosine-similarity search over the rows of W, using an
+    inverted file over list_count spherical k-means clusters.
+
+    The rows are stored grouped by cluster: the rows in cluster c are
+    W_ivf[list_offsets[c]:list_offsets[c+1]], and their keys (i.e. row
+    indices in the original W) are list_keys[list_offsets[c]:...].
+    """
+    def __init__(self, W=None, list_count=None, train_size=100000, \
+                 kmeans_iters=10, seed=1):
+        self.centroids = None
+        self.list_offsets = None
+        self.list_keys = None
+        self.W_ivf = None
+        if not (W is None):
+            self.build(W, list_count=list_count, train_size=train_size, \
+                       kmeans_iters=kmeans_iters, seed=seed)
+        return
+
+    def build(self, W, list_count=None, train_size=100000, kmeans_iters=10, \
+              seed=1):
+        """Cluster the rows of W and build the inverted lists."""
+        W = normalize_rows(W)
+        row_count = W.shape[0]
+        if list_count is None:
+            # the usual rule of thumb is ~sqrt(row_count) lists
+            list_count = max(1, int(np.sqrt(row_count)))
+        rng = npr.RandomState(seed)
+        # run k-means on a random subset of the rows, then assign every row
+        train_idx = np.arange(row_count)
+        if (row_count > train_size):
+            train_idx = rng.choice(row_count, size=train_size, replace=False)
+        self.centroids = _spherical_kmeans(W[train_idx], list_count, \
+                                           kmeans_iters, rng)
+        assign = exact_top_k(W, self.centroids, 1)[0][:,0]
+        self.list_keys = np.argsort(assign, kind='mergesort').astype(np.int64)
+        list_sizes = np.bincount(assign, minlength=list_count)
+        self.list_offsets = np.zeros((list_count+1,), dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(list_sizes)
+        self.W_ivf = W[self.list_keys]
+        return
+
+    def search(self, Q, k=10, n_probe=8, exclude=None):
+        """
+        Get [keys, sims] for (approximately) the k nearest rows to each query
+        vector, by scoring only the rows in the n_probe nearest lists. Queries
+        with fewer than k candidates are padded with key -1 and sim -inf.
+        """
+        Q = normalize_rows(Q)
+        q_count = Q.shape[0]
+        n_probe = min(n_probe, self.centroids.shape[0])
+        probe_lists = exact_top_k(Q, self.centroids, n_probe)[0]
+        keys = -1 * np.ones((q_count, k), dtype=np.int64)
+        sims = -np.inf * np.ones((q_count, k), dtype=np.float32)
+        # group the (query, list) probes by list, so that each probed list
+        # is scored against all of the queries that probe it in one GEMM
+        probe_lists = probe_lists.ravel()
+        probe_order = np.argsort(probe_lists, kind='mergesort')
+        probe_queries = probe_order // n_probe
+        probe_bounds = np.searchsorted(probe_lists[probe_order], \
+                np.arange(self.centroids.shape[0] + 1))
+        for c in range(self.centroids.shape[0]):
+            l_start = self.list_offsets[c]
+            l_end = self.list_offsets[c+1]
+            q_idx = probe_queries[probe_bounds[c]:probe_bounds[c+1]]
+            if ((q_idx.size == 0) or (l_end == l_start)):
+                continue
+            c_sims = np.dot(Q[q_idx], self.W_ivf[l_start:l_end].T)
+            c_keys = self.list_keys[l_start:l_end]
+            if not (exclude is None):
+                c_sims[c_keys[np.newaxis,:] == \
+                       exclude[q_idx][:,np.newaxis]] = -np.inf
+            c_k = min(k, l_end - l_start)
+            top = np.argpartition(-c_sims, c_k-1, axis=1)[:,0:c_k]
+            top_sims = c_sims[np.arange(q_idx.size)[:,np.newaxis], top]
+            keys[q_idx], sims[q_idx] = _merge_top_k(keys[q_idx], \
+                    sims[q_idx], c_keys[top], top_sims, k)
+        return _sort_top_k(keys, sims)
+
+    def search_keys(self, keys, k=10, n_probe=8):
+        """Get [keys, sims] for (approx) the k nearest rows to each given row."""
+        keys = np.asarray(keys, dtype=np.int64)
+        # find each key's position in the list-ordered rows
+        pos = np.zeros((self.list_keys.size,), dtype=np.int64)
+        pos[self.list_keys] = np.arange(self.list_keys.size)
+        return self.search(self.W_ivf[pos[keys]], k=k, n_probe=n_probe, \
+                           exclude=keys)
+
+    def save(self, index_dir):
+        _save_arrays(index_dir, kind='ivf', centroids=self.centroids, \
+                     list_offsets=self.list_offsets, list_keys=self.list_keys, \
+                     W_ivf=self.W_ivf)
+        return
+
+QUANT_KINDS = ['float16', 'int8']
+
+def quantize_rows(W, kind='int8'):
+    """
+    Quantize the rows of W, returning [codes, scales]. For kind 'float16',
+    codes is just W as float16 and scales is all ones. For kind 'int8', each
+    row is scaled so that its largest magnitude entry maps to 127, and row i
+    of W is approximately scales[i] * codes[i].
+    """
+    assert(kind in QUANT_KINDS)
+    W = np.asarray(W, dtype=np.float32)
+    if (kind == 'float16'):
+        return [W.astype(np.float16), np.ones((W.shape[0],), dtype=np.float32)]
+    scales = np.max(np.abs(W), axis=1) / 127.0
+    scales[scales == 0.0] = 1.0
+    codes = np.round(W / scales[:,np.newaxis]).astype(np.int8)
+    return [codes, scales.astype(np.float32)]
+
+class QuantizedIndex(object):
+    """
+    Cosine-similarity search over the rows of W, stored as float16 or as
+    int8 with a scale per row (see quantize_rows()). This takes 1/2 or 1/4
+    of the memory of a float32 copy of W.
+
+    Unlike ExactIndex, the rows aren't normalized before storage, so lookup()
+    gives (approximately) the rows of W. For search, the per-row scales cancel
+    out of the cosine similarity, so only the norms of the quantized rows are
+    needed, and blocks of rows are converted to float32 as they're scored.
+    """
+    def __init__(self, W=None, kind='int8', block_size=16384):
+        self.kind = kind
+        self.block_size = block_size
+        self.codes = None
+        self.scales = None
+        self.inv_norms = None
+        if not (W is None):
+            self.codes, self.scales = quantize_rows(W, kind=kind)
+            norms = np.zeros((self.codes.shape[0],), dtype=np.float32)
+            for b_start in range(0, self.codes.shape[0], block_size):
+                block = self.codes[b_start:(b_start+block_size)]
+                block = block.astype(np.float32)
+                norms[b_start:(b_start+block.shape[0])] = \
+                        np.sqrt(np.sum(block**2.0, axis=1))
+            self.inv_norms = 1.0 / (norms + 1e-5)
+        return
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def lookup(self, keys):
+        """Get float32 (dequantized) copies of the rows given in keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        rows = self.codes[keys].astype(np.float32)
+        return rows * self.scales[keys][...,np.newaxis]
+
+    def search(self, Q, k=10, exclude=None):
+        """Get [keys, sims] for the k nearest rows to each query vector."""
+        Q = normalize_rows(Q)
+        q_count = Q.shape[0]
+        k = min(k, self.codes.shape[0])
+        best_idx = np.zeros((q_count, 0), dtype=np.int64)
+        best_sims = np.zeros((q_count, 0), dtype=np.float32)
+        for b_start in range(0, self.codes.shape[0], self.block_size):
+            b_end = min(b_start + self.block_size, self.codes.shape[0])
+            block = self.codes[b_start:b_end].astype(np.float32)
+            sims = np.dot(Q, block.T) * self.inv_norms[b_start:b_end]
+            if not (exclude is None):
+                in_block = (exclude >= b_start) & (exclude < b_end)
+                sims[np.flatnonzero(in_block), exclude[in_block] - b_start] = \
+                        -np.inf
+            b_k = min(k, b_end - b_start)
+            b_idx = np.argpartition(-sims, b_k-1, axis=1)[:,0:b_k]
+            b_sims = sims[np.arange(q_count)[:,np.newaxis], b_idx]
+            best_idx, best_sims = _merge_top_k(best_idx, best_sims, \
+                                               b_idx + b_start, b_sims, k)
+        return _sort_top_k(best_idx, best_sims)
+
+    def search_keys(self, keys, k=10):
+        """Get [keys, sims] for the k nearest rows to each given row."""
+        keys = np.asarray(keys, dtype=np.int64)
+        return self.search(self.lookup(keys), k=k, exclude=keys)
+
+    def save(self, index_dir):
+        _save_arrays(index_dir, kind=self.kind, codes=self.codes, \
+                     scales=self.scales, inv_norms=self.inv_norms, \
+                     block_size=self.block_size)
+        return
+
+def export_quantized(W, index_dir, kind='int8', eval_count=1000, k=10, \
+                     seed=1):
+    """
+    Quantize the rows of W (e.g. a trained W2VLayer.params['Wa']) and save
+    them as a QuantizedIndex in index_dir, which load_index() can memory-map.
+
+    To show the accuracy impact of quantization, the k nearest neighbours of
+    eval_count random rows are found in both W and the quantized rows, and
+    the recall@k of the latter is printed and returned.
+    """
+    index = QuantizedIndex(W, kind=kind)
+    index.save(index_dir)
+    rng = npr.RandomState(seed)
+    eval_keys = rng.randint(0, W.shape[0], size=(min(eval_count, W.shape[0]),))
+    exact_keys = ExactIndex(W).search_keys(eval_keys, k=k)[0]
+    quant_keys = index.search_keys(eval_keys, k=k)[0]
+    recall = recall_at_k(quant_keys, exact_keys)
+    print("exported {0:d}x{1:d} {2:s} table ({3:.1f} MB), recall@{4:d}: {5:.4f}" \
+            .format(W.shape[0], W.shape[1], kind, index.codes.nbytes / 1e6, \
+                    k, recall))
+    return recall
+
+def _save_arrays(index_dir, **arrays):
+    """Write each array to index_dir/<name>.npy."""
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for (name, value) in arrays.items():
+        np.save(os.path.join(index_dir, name + '.npy'), np.asarray(value))
+    return
+
+def load_index(index_dir, mmap=True):
+    """
+    Load an ExactIndex, IVFIndex or QuantizedIndex written by its save()
+    method. If mmap is True, the stored vectors are memory-mapped rather than
+    read into memory.
+    """
+    mmap_mode = 'r' if mmap else None
+    data = {}
+    for f_name in os.listdir(index_dir):
+        if f_name.endswith('.npy'):
+            data[f_name[0:-4]] = np.load(os.path.join(index_dir, f_name), \
+                                         mmap_mode=mmap_mode)
+    kind = str(data['kind'])
+    if (kind == 'exact'):
+        index = ExactIndex(block_size=int(data['block_size']))
+        index.W = data['W']
+    elif (kind in QUANT_KINDS):
+        index = QuantizedIndex(kind=kind, block_size=int(data['block_size']))
+        index.codes = data['codes']
+        index.scales = data['scales']
+        index.inv_norms = data['inv_norms']
+    else:
+        assert(kind == 'ivf')
+        index = IVFIndex()
+        index.centroids = data['centroids']
+        index.list_offsets = data['list_offsets']
+        index.list_keys = data['list_keys']
+        index.W_ivf = data['W_ivf']
+    return index
+
+def nearest_words(keys_to_words, source_keys, index, k=10):
+    """
+    Get the words for source_keys and for their k nearest neighbours in the
+    given index (excluding each source key itself).
+    """
+    neighbor_keys, sims = index.search_keys(source_keys, k=k)
+    source_words = [keys_to_words[sk] for sk in source_keys]
+    neighbor_words = [[keys_to_words[nk] for nk in nk_row if (nk >= 0)] \
+                      for nk_row in neighbor_keys]
+    return [neighbor_keys, source_words, neighbor_words]
+
+def recall_at_k(approx_keys, exact_keys):
+    """Fraction of the exact top-k keys found in the approximate top-k."""
+    hits = 0
+    for i in range(exact_keys.shape[0]):
+        hits += np.intersect1d(approx_keys[i], exact_keys[i]).size
+    return float(hits) / exact_keys.size
+
+
+##############
+# EYE BUFFER #
+##############
@@ -2,20 +2,21 @@ from __future__ import absolute_import
 
 import numpy as np
 import numpy.random as npr
-import threading
 import numba
 from math import exp, log, sqrt
-from numba import jit, void, i4, f4, u4
+from numba import jit, void, i4, i8, f4, u4
 from ctypes import pythonapi, c_void_p
 
 ADA_EPS = 0.001
+# ADA_RHO and MAX_HSM_KEY match the values in CythonFuncsPyx.pyx, which
+# provides the kernels that NLMLayers.py uses by default.
+ADA_RHO = 0.98
+MAX_HSM_KEY = 12345678
 
 ########################################
 # MULTITHREADING HELPER-FUNC AND DEFNS #
 ########################################
 
-THREAD_NUM = 4
-
 savethread = pythonapi.PyEval_SaveThread
 savethread.argtypes = []
 savethread.restype = c_void_p
@@ -24,33 +25,9 @@ restorethread = pythonapi.PyEval_RestoreThread
 restorethread.argtypes = [c_void_p]
 restorethread.restype = None
 
-def make_multithread(inner_func, numthreads):
-    def func_mt(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        chunklen = (length + (numthreads-1)) // numthreads
-        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
-        # Start a thread for all but the last chunk of work
-        threads = [threading.Thread(target=inner_func, args=cargs)
-                   for cargs in chunkargs[:-1]]
-        for thread in threads:
-            thread.start()
-        # Give the last chunk of work to the main thread
-        inner_func(*chunkargs[-1])
-        for thread in threads:
-            thread.join()
-        return 1
-    def func_st(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        sp_args = (sp_idx,) + args
-        inner_fun(*sp_args)
-    func = None
-    if numthreads == 1:
-        func = func_st
-    else:
-        func = func_mt
-    return func_mt
+# The jitted kernels below release the GIL and run on the WorkerPool.py pool.
+from WorkerPool import make_multithread, set_thread_num, get_thread_num, \
+                       get_pool
 
 ##############################
 # NUMBA FUNCTION DEFINITIONS #
@@ -82,7 +59,7 @@ def w2v_ff_bp_sp(sp_idx, anc_idx, pn_idx, pn_sign, Wa, Wc, b, dWa, dWc, db, L, d
     return
 fn_sig_1 = void(i4[:], i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:], i4)
 w2v_ff_bp_st = jit(fn_sig_1, nopython=True)(w2v_ff_bp_sp)
-w2v_ff_bp = make_multithread(w2v_ff_bp_st, THREAD_NUM)
+w2v_ff_bp = make_multithread(w2v_ff_bp_st)
 
 def nsl_bp_sp(sp_idx, table_idx, X, W, dLdY, dLdX, dW, db):
     """Backprop for NSLayer: main loop in Numba-friendly form."""
@@ -103,7 +80,7 @@ def nsl_bp_sp(sp_idx, table_idx, X, W, dLdY, dLdX, dW, db):
     return
 fn_sig_2 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:])
 nsl_bp_st = jit(fn_sig_2, nopython=True)(nsl_bp_sp)
-nsl_bp = make_multithread(nsl_bp_st, THREAD_NUM)
+nsl_bp = make_multithread(nsl_bp_st)
 
 def nsl_ff_sp(sp_idx, table_idx, X, W, b, Y):
     """Feedforward for NSLayer: main loop in Numba-friendly form."""
@@ -122,7 +99,7 @@ def nsl_ff_sp(sp_idx, table_idx, X, W, b, Y):
     return
 fn_sig_3 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:])
 nsl_ff_st = jit(fn_sig_3, nopython=True)(nsl_ff_sp)
-nsl_ff = make_multithread(nsl_ff_st, THREAD_NUM)
+nsl_ff = make_multithread(nsl_ff_st)
 
 def ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
     """Element-wise partial update ala adagrad.
@@ -144,7 +121,7 @@ def ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
     return
 fn_sig_4 = void(i4[:], i4[:], f4[:,:], f4[:,:], f4[:,:], f4)
 ag_update_2d_st = jit(fn_sig_4, nopython=True)(ag_update_2d_sp)
-ag_update_2d = make_multithread(ag_update_2d_st, THREAD_NUM)
+ag_update_2d = make_multithread(ag_update_2d_st)
 
 @numba.jit("void(i4[:], f4[:], f4[:], f4[:], f4)")
 def ag_update_1d(row_idx, W, dW, mW, learn_rate):
@@ -178,7 +155,7 @@ def lut_sp(sp_idx, row_idx, dLdY, dW):
     return
 fn_sig_5 = void(i4[:], i4[:], f4[:,:], f4[:,:])
 lut_st = jit(fn_sig_5, nopython=True)(lut_sp)
-lut_bp = make_multithread(lut_st, THREAD_NUM)
+lut_bp = make_multithread(lut_st)
 
 
 def hsm_ff_bp_sp(sp_idx, X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
@@ -208,7 +185,491 @@ def hsm_ff_bp_sp(sp_idx, X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
     return
 fn_sig_6 = void(i4[:], f4[:,:], u4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:,:])
 hsm_ff_bp_st = jit(fn_sig_6, nopython=True)(hsm_ff_bp_sp)
-hsm_ff_bp = make_multithread(hsm_ff_bp_st, THREAD_NUM)
+hsm_ff_bp = make_multithread(hsm_ff_bp_st)
+
+########################################
+# HOGWILD AND SHARDED GRADIENT KERNELS #
+########################################
+
+#
+# In "hogwild" mode the threads update parameters directly, without locks and
+# without using the dense grads arrays. For W2VLayer the updates are made
+# inside the feedforward/backprop kernel. For HSMLayer, hsm_ff_bp_g only
+# records the grad for each code, and hsm_hogwild applies them later.
+#
+# In "sharded" mode each thread adds its gradients into its own compact
+# shard, which is indexed by shard_idx[row] and by the compact row keys from
+# np.unique(..., return_inverse=True). The shards are summed in a fixed order
+# after the kernel returns, so the result does not depend on thread timing.
+#
+
+def w2v_hogwild_sp(sp_idx, anc_idx, pn_idx, pn_sign, Wa, Wc, b, mWa, mWc, mb, L, learn_rate):
+    """Feedforward, backprop and RMS-style adagrad for the word-2-vec layer.
+
+    Each anchor/context pair updates its rows of Wc and b immediately, and
+    the gradient for the anchor row of Wa is applied after all of the
+    anchor's contexts have been processed.
+    """
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    cols = pn_idx.shape[1]
+    vec_dim = Wa.shape[1]
+    dwa = np.zeros((vec_dim,), dtype=np.float32)
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        ai = anc_idx[i]
+        for k in range(vec_dim):
+            dwa[k] = 0.0
+        for j in range(cols):
+            ci = pn_idx[i,j]
+            y = b[ci]
+            for k in range(vec_dim):
+                y += (Wa[ai,k] * Wc[ci,k])
+            neg_label = -1.0 * pn_sign[i,j]
+            exp_pns_y = exp(neg_label * y)
+            L[i] += log(1.0 + exp_pns_y)
+            g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+            for k in range(vec_dim):
+                dwa[k] += g * Wc[ci,k]
+                dwc = g * Wa[ai,k]
+                mWc[ci,k] = (ADA_RHO * mWc[ci,k]) + ((1.0 - ADA_RHO) * dwc * dwc)
+                Wc[ci,k] -= learn_rate * (dwc / (sqrt(mWc[ci,k]) + ADA_EPS))
+            mb[ci] = (ADA_RHO * mb[ci]) + ((1.0 - ADA_RHO) * g * g)
+            b[ci] -= learn_rate * (g / (sqrt(mb[ci]) + ADA_EPS))
+        for k in range(vec_dim):
+            mWa[ai,k] = (ADA_RHO * mWa[ai,k]) + ((1.0 - ADA_RHO) * dwa[k] * dwa[k])
+            Wa[ai,k] -= learn_rate * (dwa[k] / (sqrt(mWa[ai,k]) + ADA_EPS))
+    restorethread(threadstate)
+    return
+fn_sig_7 = void(i4[:], u4[:], u4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:], f4)
+w2v_hogwild_st = jit(fn_sig_7, nopython=True)(w2v_hogwild_sp)
+w2v_hogwild = make_multithread(w2v_hogwild_st)
+
+def w2v_ff_bp_shard_sp(sp_idx, shard_idx, anc_idx, anc_cidx, pn_idx, pn_cidx, pn_sign, Wa, Wc, b, dWa_s, dWc_s, db_s, L):
+    """Feedforward and backprop for the word-2-vec layer, into grad shards."""
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    cols = pn_idx.shape[1]
+    vec_dim = Wa.shape[1]
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        s = shard_idx[i]
+        ai = anc_idx[i]
+        aci = anc_cidx[i]
+        for j in range(cols):
+            ci = pn_idx[i,j]
+            cci = pn_cidx[i,j]
+            y = b[ci]
+            for k in range(vec_dim):
+                y += (Wa[ai,k] * Wc[ci,k])
+            neg_label = -1.0 * pn_sign[i,j]
+            exp_pns_y = exp(neg_label * y)
+            L[i] += log(1.0 + exp_pns_y)
+            g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+            db_s[s,cci] += g
+            for k in range(vec_dim):
+                dWa_s[s,aci,k] += g * Wc[ci,k]
+                dWc_s[s,cci,k] += g * Wa[ai,k]
+    restorethread(threadstate)
+    return
+fn_sig_8 = void(i4[:], i4[:], u4[:], i4[:], u4[:,:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:,:], f4[:,:,:], f4[:,:], f4[:])
+w2v_ff_bp_shard_st = jit(fn_sig_8, nopython=True)(w2v_ff_bp_shard_sp)
+w2v_ff_bp_shard = make_multithread(w2v_ff_bp_shard_st)
+
+def hsm_ff_bp_g_sp(sp_idx, word_keys, row_starts, code_offsets, code_keys, code_signs, X, W, b, dLdX, G, L, do_grad):
+    """Feedforward and backprop for HSMLayer, without touching W's grads.
+
+    Codes are stored in CSR form, as for hsm_ff_bp. The gradient with respect
+    to the output for each code on row i's path is stored in G, starting at
+    G[row_starts[i]], so that the parameter updates can be applied later by
+    hsm_hogwild.
+    """
+    threadstate = savethread()
+    obs_count = sp_idx.shape[0]
+    vec_dim = X.shape[1]
+    for spi in range(obs_count):
+        i = sp_idx[spi]
+        word_key = word_keys[i]
+        c_start = code_offsets[word_key]
+        L[i] = 0.0
+        for j in range(c_start, code_offsets[word_key+1]):
+            code_key = code_keys[j]
+            y = b[code_key]
+            for k in range(vec_dim):
+                y += X[i,k] * W[code_key,k]
+            neg_label = -1.0 * code_signs[j]
+            exp_y = exp(neg_label * y)
+            L[i] += log(1.0 + exp_y)
+            if (do_grad == 1):
+                g = neg_label * (exp_y / (1.0 + exp_y))
+                G[row_starts[i] + (j - c_start)] = g
+                for k in range(vec_dim):
+                    dLdX[i,k] += g * W[code_key,k]
+    restorethread(threadstate)
+    return
+fn_sig_9 = void(i4[:], u4[:], i8[:], i8[:], u4[:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:], f4[:], i4)
+hsm_ff_bp_g_st = jit(fn_sig_9, nopython=True)(hsm_ff_bp_g_sp)
+hsm_ff_bp_g = make_multithread(hsm_ff_bp_g_st)
+
+def hsm_hogwild_sp(sp_idx, word_keys, row_starts, code_offsets, code_keys, G, X, W, b, mW, mb, learn_rate):
+    """RMS-style adagrad updates for HSMLayer, applied directly to W and b."""
+    threadstate = savethread()
+    obs_count = sp_idx.shape[0]
+    vec_dim = X.shape[1]
+    for spi in range(obs_count):
+        i = sp_idx[spi]
+        word_key = word_keys[i]
+        c_start = code_offsets[word_key]
+        for j in range(c_start, code_offsets[word_key+1]):
+            code_key = code_keys[j]
+            g = G[row_starts[i] + (j - c_start)]
+            for k in range(vec_dim):
+                dw = g * X[i,k]
+                mW[code_key,k] = (ADA_RHO * mW[code_key,k]) + ((1.0 - ADA_RHO) * dw * dw)
+                W[code_key,k] -= learn_rate * (dw / (sqrt(mW[code_key,k]) + ADA_EPS))
+            mb[code_key] = (ADA_RHO * mb[code_key]) + ((1.0 - ADA_RHO) * g * g)
+            b[code_key] -= learn_rate * (g / (sqrt(mb[code_key]) + ADA_EPS))
+    restorethread(threadstate)
+    return
+fn_sig_10 = void(i4[:], u4[:], i8[:], i8[:], u4[:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:], f4)
+hsm_hogwild_st = jit(fn_sig_10, nopython=True)(hsm_hogwild_sp)
+hsm_hogwild = make_multithread(hsm_hogwild_st)
+
+def hsm_ff_bp_shard_sp(sp_idx, shard_idx, code_keys, code_cidx, code_signs, X, W, b, dLdX, dW_s, db_s, L, do_grad):
+    """Feedforward and backprop for HSMLayer, into grad shards."""
+    threadstate = savethread()
+    obs_count = sp_idx.shape[0]
+    code_len = code_keys.shape[1]
+    vec_dim = X.shape[1]
+    for spi in range(obs_count):
+        i = sp_idx[spi]
+        s = shard_idx[i]
+        for j in range(code_len):
+            code_key = code_keys[i,j]
+            if code_key < MAX_HSM_KEY:
+                cci = code_cidx[i,j]
+                y = b[code_key]
+                for k in range(vec_dim):
+                    y += X[i,k] * W[code_key,k]
+                neg_label = -1.0 * code_signs[i,j]
+                exp_y = exp(neg_label * y)
+                L[i,j] = log(1.0 + exp_y)
+                if (do_grad == 1):
+                    g = neg_label * (exp_y / (1.0 + exp_y))
+                    db_s[s,cci] += g
+                    for k in range(vec_dim):
+                        dLdX[i,k] += g * W[code_key,k]
+                        dW_s[s,cci,k] += g * X[i,k]
+    restorethread(threadstate)
+    return
+fn_sig_11 = void(i4[:], i4[:], u4[:,:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:,:], f4[:,:], f4[:,:], i4)
+hsm_ff_bp_shard_st = jit(fn_sig_11, nopython=True)(hsm_ff_bp_shard_sp)
+hsm_ff_bp_shard = make_multithread(hsm_ff_bp_shard_st)
+
+def hsm_ff_bp_shard_csr_sp(sp_idx, shard_idx, word_keys, row_starts, code_offsets, code_keys, code_signs, code_cidx, X, W, b, dLdX, dW_s, db_s, L, do_grad):
+    """Feedforward and backprop for HSMLayer, with CSR codes, into grad shards.
+
+    The compact row for the code at position t on the path of row i is
+    code_cidx[row_starts[i] + t].
+    """
+    threadstate = savethread()
+    obs_count = sp_idx.shape[0]
+    vec_dim = X.shape[1]
+    for spi in range(obs_count):
+        i = sp_idx[spi]
+        s = shard_idx[i]
+        word_key = word_keys[i]
+        c_start = code_offsets[word_key]
+        L[i] = 0.0
+        for j in range(c_start, code_offsets[word_key+1]):
+            code_key = code_keys[j]
+            cci = code_cidx[row_starts[i] + (j - c_start)]
+            y = b[code_key]
+            for k in range(vec_dim):
+                y += X[i,k] * W[code_key,k]
+            neg_label = -1.0 * code_signs[j]
+            exp_y = exp(neg_label * y)
+            L[i] += log(1.0 + exp_y)
+            if (do_grad == 1):
+                g = neg_label * (exp_y / (1.0 + exp_y))
+                db_s[s,cci] += g
+                for k in range(vec_dim):
+                    dLdX[i,k] += g * W[code_key,k]
+                    dW_s[s,cci,k] += g * X[i,k]
+    restorethread(threadstate)
+    return
+fn_sig_12 = void(i4[:], i4[:], u4[:], i8[:], i8[:], u4[:], f4[:], i4[:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:,:], f4[:,:], f4[:], i4)
+hsm_ff_bp_shard_csr_st = jit(fn_sig_12, nopython=True)(hsm_ff_bp_shard_csr_sp)
+hsm_ff_bp_shard_csr = make_multithread(hsm_ff_bp_shard_csr_st)
+
+def shard_rows(row_count, pool):
+    """Get the grad shard for each row, for a kernel call run on pool.
+
+    Rows are assigned to shards in the same contiguous chunks that
+    make_multithread hands to each of pool's threads, so no two threads ever
+    write to the same shard. The kernel must be called with pool=pool, so
+    that the chunks and shards both come from the same thread count.
+    """
+    shard_count = pool.thread_num
+    chunklen = (row_count + (shard_count-1)) // shard_count
+    shard_idx = (np.arange(0,row_count) // max(chunklen, 1)).astype(np.int32)
+    return [shard_idx, shard_count]
+
+##############################
+# FUSED W2V TRAINING KERNELS #
+##############################
+
+#
+# These kernels compute the same minibatch update as w2v_ff_bp followed by
+# the ag_update_2d/ag_update_1d passes, but without the dense grads arrays or
+# calls to np.unique. w2v_fused_slots gives each touched row of Wa/Wc a slot
+# in small per-batch buffers, found via the stamp arrays: a row's slot is
+# valid iff its stamp equals epoch, which must differ from the epoch used in
+# any earlier call. It also groups the batch rows by anchor slot, and the
+# (row, column) pairs by context slot, with a counting sort.
+#
+# The remaining kernels are split across the worker pool. w2v_fused_g finds
+# the loss and the output grad for each pair, splitting the batch rows across
+# threads. w2v_fused_anc and w2v_fused_ctx then split the anchor and context
+# slots across threads, so each thread only writes to its own rows, and the
+# grads for each row are summed in the same order whatever the thread count.
+# The anchor grads are buffered until w2v_fused_apply, as w2v_fused_ctx has
+# to see the params from before this update.
+#
+
+def w2v_fused_slots(anc_idx, pn_idx, a_stamp, a_slot, c_stamp, c_slot, \
+                    a_rows, a_ptr, a_list, c_rows, c_ptr, c_list, counts, \
+                    epoch):
+    """Assign buffer slots to the touched rows, and group pairs by slot.
+
+    Slot s of the anchor rows is row a_rows[s] of Wa, and the batch rows
+    with that anchor are a_list[a_ptr[s]:a_ptr[s+1]]. Likewise, slot s of
+    the context rows is row c_rows[s] of Wc/b, and the pairs (as i*cols + j)
+    with that context are c_list[c_ptr[s]:c_ptr[s+1]]. The number of anchor
+    and context slots used is written to counts[0] and counts[1].
+    """
+    obs_count = anc_idx.shape[0]
+    cols = pn_idx.shape[1]
+    a_count = 0
+    c_count = 0
+    a_ptr[0] = 0
+    c_ptr[0] = 0
+    # assign the slots, and count the pairs in each slot
+    for i in range(obs_count):
+        ai = anc_idx[i]
+        if (a_stamp[ai] != epoch):
+            a_stamp[ai] = epoch
+            a_slot[ai] = a_count
+            a_rows[a_count] = ai
+            a_ptr[a_count+1] = 0
+            a_count += 1
+        a_ptr[a_slot[ai]+1] += 1
+        for j in range(cols):
+            ci = pn_idx[i,j]
+            if (c_stamp[ci] != epoch):
+                c_stamp[ci] = epoch
+                c_slot[ci] = c_count
+                c_rows[c_count] = ci
+                c_ptr[c_count+1] = 0
+                c_count += 1
+            c_ptr[c_slot[ci]+1] += 1
+    for s in range(a_count):
+        a_ptr[s+1] += a_ptr[s]
+    for s in range(c_count):
+        c_ptr[s+1] += c_ptr[s]
+    # fill in the slot lists, using the starts in a_ptr/c_ptr as cursors and
+    # then shifting them back down
+    for i in range(obs_count):
+        sa = a_slot[anc_idx[i]]
+        a_list[a_ptr[sa]] = i
+        a_ptr[sa] += 1
+        for j in range(cols):
+            sc = c_slot[pn_idx[i,j]]
+            c_list[c_ptr[sc]] = (i * cols) + j
+            c_ptr[sc] += 1
+    for s in range(a_count, 0, -1):
+        a_ptr[s] = a_ptr[s-1]
+    a_ptr[0] = 0
+    for s in range(c_count, 0, -1):
+        c_ptr[s] = c_ptr[s-1]
+    c_ptr[0] = 0
+    counts[0] = a_count
+    counts[1] = c_count
+    return
+fn_sig_13 = void(u4[:], u4[:,:], i4[:], i4[:], i4[:], i4[:], u4[:], i4[:], i4[:], u4[:], i4[:], i4[:], i4[:], i4)
+w2v_fused_slots = jit(fn_sig_13, nopython=True)(w2v_fused_slots)
+
+def w2v_fused_g_sp(sp_idx, anc_idx, pn_idx, pn_sign, Wa, Wc, b, G, L):
+    """Get the loss and output grad for each anchor/context pair."""
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    cols = pn_idx.shape[1]
+    vec_dim = Wa.shape[1]
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        ai = anc_idx[i]
+        L[i] = 0.0
+        for j in range(cols):
+            ci = pn_idx[i,j]
+            y = b[ci]
+            for k in range(vec_dim):
+                y += (Wa[ai,k] * Wc[ci,k])
+            neg_label = -1.0 * pn_sign[i,j]
+            exp_pns_y = exp(neg_label * y)
+            L[i] += log(1.0 + exp_pns_y)
+            G[i,j] = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+    restorethread(threadstate)
+    return
+fn_sig_14 = void(i4[:], u4[:], u4[:,:], f4[:,::1], f4[:,::1], f4[:,::1], f4[:], f4[:,::1], f4[:])
+w2v_fused_g_st = jit(fn_sig_14, nopython=True, fastmath=True)(w2v_fused_g_sp)
+w2v_fused_g = make_multithread(w2v_fused_g_st)
+
+def w2v_fused_anc_sp(sp_idx, a_rows, a_ptr, a_list, pn_idx, G, Wc, dWa_buf):
+    """Sum the grads for each anchor slot into dWa_buf."""
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    cols = pn_idx.shape[1]
+    vec_dim = Wc.shape[1]
+    for sp_i in range(sp_size):
+        s = sp_idx[sp_i]
+        for k in range(vec_dim):
+            dWa_buf[s,k] = 0.0
+        for t in range(a_ptr[s], a_ptr[s+1]):
+            i = a_list[t]
+            for j in range(cols):
+                ci = pn_idx[i,j]
+                g = G[i,j]
+                for k in range(vec_dim):
+                    dWa_buf[s,k] += g * Wc[ci,k]
+    restorethread(threadstate)
+    return
+fn_sig_15 = void(i4[:], u4[:], i4[:], i4[:], u4[:,:], f4[:,::1], f4[:,::1], f4[:,::1])
+w2v_fused_anc_st = jit(fn_sig_15, nopython=True, fastmath=True)(w2v_fused_anc_sp)
+w2v_fused_anc = make_multithread(w2v_fused_anc_st)
+
+def w2v_fused_ctx_sp(sp_idx, c_rows, c_ptr, c_list, anc_idx, G, Wa, Wc, b, mWc, mb, learn_rate):
+    """Sum the grads for each context slot, and apply them to Wc and b."""
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    cols = G.shape[1]
+    vec_dim = Wa.shape[1]
+    dwc = np.zeros((vec_dim,), dtype=np.float32)
+    # keep the adagrad step in float32, so that it vectorizes well
+    rho = np.float32(ADA_RHO)
+    rho_c = np.float32(1.0 - ADA_RHO)
+    eps = np.float32(ADA_EPS)
+    for sp_i in range(sp_size):
+        s = sp_idx[sp_i]
+        ci = c_rows[s]
+        for k in range(vec_dim):
+            dwc[k] = 0.0
+        db = 0.0
+        for t in range(c_ptr[s], c_ptr[s+1]):
+            i = c_list[t] // cols
+            j = c_list[t] - (i * cols)
+            ai = anc_idx[i]
+            g = G[i,j]
+            db += g
+            for k in range(vec_dim):
+                dwc[k] += g * Wa[ai,k]
+        for k in range(vec_dim):
+            m = (rho * mWc[ci,k]) + (rho_c * dwc[k] * dwc[k])
+            mWc[ci,k] = m
+            Wc[ci,k] -= learn_rate * (dwc[k] / (np.sqrt(m) + eps))
+        mb[ci] = (ADA_RHO * mb[ci]) + ((1.0 - ADA_RHO) * db * db)
+        b[ci] -= learn_rate * (db / (sqrt(mb[ci]) + ADA_EPS))
+    restorethread(threadstate)
+    return
+fn_sig_16 = void(i4[:], u4[:], i4[:], i4[:], u4[:], f4[:,::1], f4[:,::1], f4[:,::1], f4[:], f4[:,::1], f4[:], f4)
+w2v_fused_ctx_st = jit(fn_sig_16, nopython=True, fastmath=True)(w2v_fused_ctx_sp)
+w2v_fused_ctx = make_multithread(w2v_fused_ctx_st)
+
+def w2v_fused_apply_sp(sp_idx, a_rows, dWa_buf, Wa, mWa, learn_rate):
+    """Apply the buffered anchor grads to Wa."""
+    threadstate = savethread()
+    sp_size = sp_idx.shape[0]
+    vec_dim = Wa.shape[1]
+    rho = np.float32(ADA_RHO)
+    rho_c = np.float32(1.0 - ADA_RHO)
+    eps = np.float32(ADA_EPS)
+    for sp_i in range(sp_size):
+        s = sp_idx[sp_i]
+        ai = a_rows[s]
+        for k in range(vec_dim):
+            dw = dWa_buf[s,k]
+            m = (rho * mWa[ai,k]) + (rho_c * dw * dw)
+            mWa[ai,k] = m
+            Wa[ai,k] -= learn_rate * (dw / (np.sqrt(m) + eps))
+    restorethread(threadstate)
+    return
+fn_sig_17 = void(i4[:], u4[:], f4[:,::1], f4[:,::1], f4[:,::1], f4)
+w2v_fused_apply_st = jit(fn_sig_17, nopython=True, fastmath=True)(w2v_fused_apply_sp)
+w2v_fused_apply = make_multithread(w2v_fused_apply_st)
+
+#####################################
+# PARAGRAPH VECTOR INFERENCE KERNEL #
+#####################################
+
+def pv_infer_sp(sp_idx, C, mC, L, t_offsets, Xw, post_keys, row_starts, \
+                code_offsets, code_keys, code_signs, W, b, Yw, epochs, \
+                learn_rate, lam_l2):
+    """Fit context vectors for new phrases, with all other params frozen.
+
+    Phrase p's context vector is C[p], and its training targets are rows
+    t_offsets[p]...t_offsets[p+1]-1 of Xw (the predictor word vectors) and
+    post_keys (the predicted words). HSM codes are stored in CSR form, as for
+    hsm_ff_bp. The first C.shape[1] columns of the HSM weights W multiply the
+    context vector and the rest multiply Xw, so the word part of each code's
+    output is fixed and is computed once into Yw, starting at Yw[row_starts[t]]
+    for target t. Each epoch then makes one RMS-style adagrad step on C[p] per
+    target. Phrases are independent, so threads never touch the same rows of
+    C, mC or L, or the same entries of Yw.
+    """
+    threadstate = savethread()
+    phrase_count = sp_idx.shape[0]
+    cv_dim = C.shape[1]
+    wv_dim = Xw.shape[1]
+    dC = np.zeros((cv_dim,), dtype=np.float32)
+    for spi in range(phrase_count):
+        p = sp_idx[spi]
+        t_start = t_offsets[p]
+        t_end = t_offsets[p+1]
+        # compute the (fixed) bias and word part of each code's output
+        for t in range(t_start, t_end):
+            word_key = post_keys[t]
+            c_start = code_offsets[word_key]
+            for j in range(c_start, code_offsets[word_key+1]):
+                code_key = code_keys[j]
+                y = b[code_key]
+                for k in range(wv_dim):
+                    y += Xw[t,k] * W[code_key,cv_dim+k]
+                Yw[row_starts[t] + (j - c_start)] = y
+        for e in range(epochs):
+            L[p] = 0.0
+            for t in range(t_start, t_end):
+                for k in range(cv_dim):
+                    dC[k] = lam_l2 * C[p,k]
+                word_key = post_keys[t]
+                c_start = code_offsets[word_key]
+                for j in range(c_start, code_offsets[word_key+1]):
+                    code_key = code_keys[j]
+                    y = Yw[row_starts[t] + (j - c_start)]
+                    for k in range(cv_dim):
+                        y += C[p,k] * W[code_key,k]
+                    neg_label = -1.0 * code_signs[j]
+                    exp_y = exp(neg_label * y)
+                    L[p] += log(1.0 + exp_y)
+                    g = neg_label * (exp_y / (1.0 + exp_y))
+                    for k in range(cv_dim):
+                        dC[k] += g * W[code_key,k]
+                for k in range(cv_dim):
+                    mC[p,k] = (ADA_RHO * mC[p,k]) + ((1.0 - ADA_RHO) * dC[k] * dC[k])
+                    C[p,k] -= learn_rate * (dC[k] / (sqrt(mC[p,k]) + ADA_EPS))
+    restorethread(threadstate)
+    return
+fn_sig_18 = void(i4[:], f4[:,:], f4[:,:], f4[:], i8[:], f4[:,:], u4[:], i8[:], i8[:], u4[:], f4[:], f4[:,:], f4[:], f4[:], i4, f4, f4)
+pv_infer_st = jit(fn_sig_18, nopython=True)(pv_infer_sp)
+pv_infer = make_multithread(pv_infer_st)
 
 ##############
 # EYE BUFFER #
@@ -0,0 +1,77 @@
+'''
+Compare the alias-table sampler in CorpusUtils.py against the old approach,
+which filled a 20M-entry table with repeated keys and then drew uniformly
+from the table.
+
+For a Zipfian unigram^0.75 distribution over a range of vocabulary sizes,
+this reports build time, memory use, draw throughput, and the largest error
+between the sampled distribution and the target distribution.
+'''
+
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+import CorpusUtils as cu
+
+TABLE_SIZE = 20000000
+DRAW_COUNT = 10000000
+ZIPF_A = 1.2
+
+def make_repeat_table(weights, table_size=TABLE_SIZE):
+    '''
+    This is the table builder that was used before AliasTable existed.
+    '''
+    weights = weights.astype(np.float64)
+    w_sum = np.sum(weights)
+    table = np.zeros((table_size,), dtype=np.uint32)
+    widx = 0
+    d1 = weights[0] / w_sum
+    for tidx in range(table_size):
+        table[tidx] = widx
+        if ((float(tidx) / table_size) > d1) and (widx < (weights.size - 1)):
+            widx += 1
+            d1 += weights[widx] / w_sum
+    return table
+
+def repeat_table_sample(table, sample_count):
+    idx = npr.randint(0, high=table.size, size=(sample_count,))
+    return table[idx]
+
+def max_error(samples, target):
+    counts = np.bincount(samples, minlength=target.size)
+    return np.max(np.abs((counts / float(samples.size)) - target))
+
+def main():
+    npr.seed(1)
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>10s} {4:>12s} {5:>10s}".format( \
+            "vocab", "sampler", "build (s)", "mem (MB)", "draws/sec", "max err"))
+    for vocab_size in [10000, 100000, 1000000]:
+        counts = np.sort(npr.zipf(ZIPF_A, size=(vocab_size,)))[::-1]
+        weights = counts.astype(np.float64)**0.75
+        target = weights / np.sum(weights)
+        # old-style table of repeated keys
+        start = timer()
+        table = make_repeat_table(weights)
+        t_build = timer() - start
+        start = timer()
+        samples = repeat_table_sample(table, DRAW_COUNT)
+        t_draw = timer() - start
+        print("{0:8d} {1:>8s} {2:10.2f} {3:10.1f} {4:12.0f} {5:10.2e}".format( \
+                vocab_size, "repeat", t_build, table.nbytes / 1e6, \
+                DRAW_COUNT / t_draw, max_error(samples, target)))
+        # alias table (run a tiny one first, to trigger jit compilation)
+        cu.AliasTable(weights[0:10]).sample((10,))
+        start = timer()
+        alias_table = cu.AliasTable(weights)
+        t_build = timer() - start
+        start = timer()
+        samples = alias_table.sample((DRAW_COUNT,))
+        t_draw = timer() - start
+        a_bytes = alias_table.prob.nbytes + alias_table.alias.nbytes
+        print("{0:8d} {1:>8s} {2:10.2f} {3:10.1f} {4:12.0f} {5:10.2e}".format( \
+                vocab_size, "alias", t_build, a_bytes / 1e6, \
+                DRAW_COUNT / t_draw, max_error(samples, target)))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''
+Compare the 'shared', 'hogwild' and 'sharded' concurrency modes of W2VLayer
+and HSMLayer on a synthetic corpus with a Zipfian word distribution.
+
+For each mode this reports training throughput (in training pairs per
+second, not counting sampling) and the loss on a fixed held-out sample after
+training, which should be about the same for all three modes.
+'''
+
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+import CorpusUtils as cu
+import NLMLayers as nlml
+import NLModels as nlm
+from NumbaFuncs import get_thread_num
+
+SENTENCE_COUNT = 50000
+VOCAB_SIZE = 20000
+ZIPF_A = 1.2
+BATCH_SIZE = 500
+BATCH_COUNT = 2000
+WV_DIM = 100
+NS_COUNT = 10
+SG_WINDOW = 5
+
+def make_zipf_sentences(sentence_count, vocab_size, zipf_a):
+    """Make random sentences with Zipf-distributed word frequencies."""
+    sentences = []
+    for i in range(sentence_count):
+        s_len = npr.randint(5, 40)
+        words = np.minimum(npr.zipf(zipf_a, size=(s_len,)), vocab_size)
+        sentences.append(["w{0:d}".format(w) for w in words])
+    return sentences
+
+def logistic_loss(Y, signs):
+    """Loss for predictions Y with targets in {+1, -1}."""
+    return np.sum(np.log(1.0 + np.exp(-signs * Y)))
+
+def w2v_test_loss(layer, anc_keys, pos_keys, neg_keys):
+    Wa = layer.params['Wa']
+    Wc = layer.params['Wc']
+    b = layer.params['b']
+    pn_keys = np.hstack((pos_keys[:,np.newaxis], neg_keys))
+    pn_sign = -1.0 * np.ones(pn_keys.shape)
+    pn_sign[:,0] = 1.0
+    Y = np.sum(Wa[anc_keys][:,np.newaxis,:] * Wc[pn_keys], axis=2) + b[pn_keys]
+    return logistic_loss(Y, pn_sign) / anc_keys.size
+
+def hsm_test_loss(layer, X, code_keys, code_signs):
+    valid = (code_keys < layer.key_count)
+    safe_keys = np.where(valid, code_keys, 0)
+    W = layer.params['W']
+    b = layer.params['b']
+    Y = np.sum(X[:,np.newaxis,:] * W[safe_keys], axis=2) + b[safe_keys]
+    return logistic_loss(Y[valid], code_signs[valid]) / X.shape[0]
+
+def main():
+    npr.seed(1)
+    print("Building synthetic Zipf corpus...")
+    sentences = make_zipf_sentences(SENTENCE_COUNT, VOCAB_SIZE, ZIPF_A)
+    key_dicts = cu.build_vocab(sentences, min_count=1, compute_hs_tree=True, \
+                               compute_ns_table=True, down_sample=0.0)
+    w2k = key_dicts['words_to_keys']
+    hs_tree = key_dicts['hs_tree']
+    tr_phrases = cu.sample_phrases(sentences, w2k, max_phrases=SENTENCE_COUNT)
+    tr_phrases = [p for p in tr_phrases if (p.size > 1)]
+    max_wv_key = max(w2k.values())
+    pos_sampler = cu.PhraseSampler(tr_phrases, SG_WINDOW)
+    neg_sampler = cu.NegSampler(neg_table=key_dicts['ns_table'], \
+                                neg_count=NS_COUNT)
+    # Draw all training and test batches up front, so that every mode sees
+    # the same data and sampling time is not included in the throughput
+    batches = []
+    for b in range(BATCH_COUNT):
+        anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(BATCH_SIZE)
+        neg_keys = neg_sampler.sample(BATCH_SIZE)
+        batches.append((anc_keys, pos_keys, neg_keys))
+    te_anc, te_pos, te_phr = pos_sampler.sample_pairs(10000)
+    te_neg = neg_sampler.sample(10000)
+    X_lut = 0.1 * npr.randn(max_wv_key+1, WV_DIM).astype(np.float32)
+    code_keys = hs_tree['keys_to_code_keys']
+    code_signs = hs_tree['keys_to_code_signs']
+
+    print("W2VLayer with {0:d} threads".format(get_thread_num()).center(80, '='))
+    for mode in nlml.CONC_MODES:
+        npr.seed(2)
+        w2vm = nlm.W2VModel(WV_DIM, max_wv_key, lam_l2=0.0, conc_mode=mode)
+        w2vm.init_params(0.05)
+        start = timer()
+        for (anc_keys, pos_keys, neg_keys) in batches:
+            w2vm.batch_update(anc_keys, pos_keys, neg_keys, learn_rate=1e-3)
+        t = timer() - start
+        L = w2v_test_loss(w2vm.w2v_layer, te_anc, te_pos, te_neg)
+        print("{0:>8s}: {1:10.0f} pairs/sec, test loss {2:.4f}".format( \
+                mode, (BATCH_COUNT * BATCH_SIZE) / t, L))
+
+    print("HSMLayer with {0:d} threads".format(get_thread_num()).center(80, '='))
+    te_X = X_lut.take(te_anc, axis=0)
+    for mode in nlml.CONC_MODES:
+        npr.seed(2)
+        hsm = nlml.HSMLayer(in_dim=WV_DIM, max_hs_key=hs_tree['max_code_key'], \
+                            conc_mode=mode)
+        hsm.init_params(0.05)
+        hsm.reset_moms(1.0)
+        start = timer()
+        for (anc_keys, pos_keys, neg_keys) in batches:
+            X = X_lut.take(anc_keys, axis=0)
+            hsm.ff_bp(X, pos_keys, hs_tree['csr_codes'], do_grad=True)
+            hsm.apply_grad(learn_rate=1e-3)
+        t = timer() - start
+        L = hsm_test_loss(hsm, te_X, code_keys.take(te_pos, axis=0), \
+                          code_signs.take(te_pos, axis=0))
+        print("{0:>8s}: {1:10.0f} pairs/sec, test loss {2:.4f}".format( \
+                mode, (BATCH_COUNT * BATCH_SIZE) / t, L))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Benchmark the nearest-neighbour search in NeighborSearch.py.
+
+This compares the old per-query search (as previously used by
+some_nearest_words, i.e. a full similarity pass and argsort for each query)
+against the batched exact search, and measures the speed and recall@10 of
+the approximate IVF index for a range of n_probe values, and of exact search
+over rows quantized to float16 and int8. Vectors are drawn from a mixture of
+Gaussians, which gives them some cluster structure, as with trained word
+vectors.
+'''
+
+import shutil
+import tempfile
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+import NeighborSearch as ns
+
+ROW_COUNT = 500000
+VEC_DIM = 100
+MIX_COUNT = 2000
+QUERY_COUNT = 1000
+TOP_K = 10
+
+def make_clustered_vectors(row_count, vec_dim, mix_count):
+    """Draw rows from a mixture of isotropic Gaussians."""
+    means = npr.randn(mix_count, vec_dim).astype(np.float32)
+    mix_idx = npr.randint(0, mix_count, size=(row_count,))
+    W = means[mix_idx] + 0.7 * npr.randn(row_count, vec_dim).astype(np.float32)
+    return W
+
+def old_search(W_unit, query_keys, k):
+    neighbor_keys = np.zeros((query_keys.size, k), dtype=np.int64)
+    for (i, q) in enumerate(query_keys):
+        neg_cos_sims = -1.0 * np.sum(W_unit * W_unit[q], axis=1)
+        sorted_k = np.argsort(neg_cos_sims)
+        neighbor_keys[i,:] = sorted_k[1:(k+1)]
+    return neighbor_keys
+
+def main():
+    npr.seed(1)
+    W = make_clustered_vectors(ROW_COUNT, VEC_DIM, MIX_COUNT)
+    query_keys = npr.randint(0, ROW_COUNT, size=(QUERY_COUNT,))
+    print("{0:d} rows, {1:d} dims, {2:d} queries".format( \
+            ROW_COUNT, VEC_DIM, QUERY_COUNT).center(80, '='))
+
+    # old per-query search (on a subset of the queries, as it's slow)
+    W_unit = ns.normalize_rows(W)
+    old_count = 20
+    start = timer()
+    old_search(W_unit, query_keys[0:old_count], TOP_K)
+    t = (timer() - start) / old_count
+    print("{0:>24s}: {1:10.3f} ms/query".format("per-query argsort", 1e3*t))
+
+    # batched exact search
+    exact = ns.ExactIndex(W)
+    start = timer()
+    exact_keys, exact_sims = exact.search_keys(query_keys, k=TOP_K)
+    t = (timer() - start) / QUERY_COUNT
+    print("{0:>24s}: {1:10.3f} ms/query".format("batched exact", 1e3*t))
+
+    # approximate search
+    start = timer()
+    ivf = ns.IVFIndex(W)
+    t_build = timer() - start
+    print("IVF index with {0:d} lists, built in {1:.1f}s".format( \
+            ivf.centroids.shape[0], t_build))
+    for n_probe in [1, 4, 8, 16, 32, 64]:
+        start = timer()
+        ivf_keys, ivf_sims = ivf.search_keys(query_keys, k=TOP_K, \
+                                             n_probe=n_probe)
+        t = (timer() - start) / QUERY_COUNT
+        print("{0:>16s} {1:3d}: {2:10.3f} ms/query, recall@10 {3:.3f}".format( \
+                "ivf n_probe", n_probe, 1e3*t, \
+                ns.recall_at_k(ivf_keys, exact_keys)))
+
+    # exact search over quantized rows
+    for kind in ns.QUANT_KINDS:
+        quant = ns.QuantizedIndex(W, kind=kind)
+        start = timer()
+        quant_keys, quant_sims = quant.search_keys(query_keys, k=TOP_K)
+        t = (timer() - start) / QUERY_COUNT
+        print("{0:>16s} {1:>7s}: {2:10.3f} ms/query, recall@10 {3:.3f}, {4:.1f} MB".format( \
+                "quantized", kind, 1e3*t, \
+                ns.recall_at_k(quant_keys, exact_keys), quant.codes.nbytes / 1e6))
+
+    # check that a saved index gives the same results when reloaded
+    index_dir = tempfile.mkdtemp()
+    try:
+        ivf.save(index_dir)
+        ivf_mm = ns.load_index(index_dir, mmap=True)
+        mm_keys, mm_sims = ivf_mm.search_keys(query_keys, k=TOP_K, n_probe=8)
+        ivf_keys, ivf_sims = ivf.search_keys(query_keys, k=TOP_K, n_probe=8)
+        print("reloaded (memmapped) index matches: {0:s}".format( \
+                str(np.all(mm_keys == ivf_keys))))
+    finally:
+        shutil.rmtree(index_dir)
+    return
+
+if __name__ == '__main__':
+    main()
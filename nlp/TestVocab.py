@@ -0,0 +1,38 @@
+'''
+Check build_vocab() and extend_vocab() on a small corpus with min_count=1 and
+downsampling turned on. Nothing gets pruned and *UNK* isn't in the text, so
+*UNK* ends up in the vocab with a count of 0, which the downsampling probs
+have to handle.
+'''
+
+import numpy as np
+import CorpusUtils as cu
+
+SENTENCES = [['the', 'cat', 'sat', 'on', 'the', 'mat'], \
+             ['the', 'dog', 'sat', 'on', 'the', 'log']]
+NEW_SENTENCES = [['the', 'cat', 'ate', 'the', 'fish']]
+
+def check_sample_probs(key_dicts):
+    w2v = key_dicts['words_to_vocabs']
+    assert(w2v['*UNK*'].count == 0)
+    for (w, v) in w2v.items():
+        assert(np.isfinite(v.sample_prob))
+        assert((v.sample_prob > 0.0) and (v.sample_prob <= 1.0))
+    # frequent words should be downsampled more than rare ones
+    assert(w2v['the'].sample_prob < w2v['cat'].sample_prob)
+    return
+
+def main():
+    key_dicts = cu.build_vocab(SENTENCES, min_count=1, compute_hs_tree=True, \
+                               compute_ns_table=True, down_sample=1e-2)
+    check_sample_probs(key_dicts)
+    print("build_vocab with min_count=1, down_sample>0: OK")
+    key_dicts = cu.extend_vocab(key_dicts, NEW_SENTENCES, min_count=1, \
+                                down_sample=1e-2)
+    check_sample_probs(key_dicts)
+    assert('fish' in key_dicts['words_to_keys'])
+    print("extend_vocab with min_count=1, down_sample>0: OK")
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Compare training throughput for W2VModel using the three-stage update path
+(w2v_ff_bp into dense grads, then ag_update_2d/ag_update_1d) against the
+fused kernels, on a synthetic corpus with Zipfian word counts. Both paths
+split their work across the same worker pool.
+'''
+
+import numpy.random as npr
+from timeit import default_timer as timer
+import CorpusUtils as cu
+import NLModels as nlm
+from TestConcModes import make_zipf_sentences
+
+SENTENCE_COUNT = 50000
+VOCAB_SIZE = 50000
+ZIPF_A = 1.2
+BATCH_COUNT = 1000
+NS_COUNT = 10
+SG_WINDOW = 5
+
+def main():
+    npr.seed(1)
+    print("Building synthetic Zipf corpus...")
+    sentences = make_zipf_sentences(SENTENCE_COUNT, VOCAB_SIZE, ZIPF_A)
+    key_dicts = cu.build_vocab(sentences, min_count=1, compute_hs_tree=False, \
+                               compute_ns_table=True, down_sample=0.0)
+    w2k = key_dicts['words_to_keys']
+    tr_phrases = cu.sample_phrases(sentences, w2k, max_phrases=SENTENCE_COUNT)
+    tr_phrases = [p for p in tr_phrases if (p.size > 1)]
+    max_wv_key = max(w2k.values())
+    pos_sampler = cu.PhraseSampler(tr_phrases, SG_WINDOW)
+    neg_sampler = cu.NegSampler(neg_table=key_dicts['ns_table'], \
+                                neg_count=NS_COUNT)
+    print("{0:>6s} {1:>6s} {2:>14s} {3:>14s}".format( \
+            "dim", "batch", "staged w/sec", "fused w/sec"))
+    for wv_dim in [50, 100, 300]:
+        for batch_size in [100, 500, 2000]:
+            batches = []
+            for b in range(BATCH_COUNT):
+                anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
+                neg_keys = neg_sampler.sample(batch_size)
+                batches.append((anc_keys, pos_keys, neg_keys))
+            rates = []
+            for use_fused in [False, True]:
+                npr.seed(2)
+                w2vm = nlm.W2VModel(wv_dim, max_wv_key, lam_l2=0.0, \
+                                    use_fused=use_fused)
+                w2vm.init_params(0.05)
+                # run one batch first, to trigger any jit compilation
+                w2vm.batch_update(*batches[0], learn_rate=1e-3)
+                start = timer()
+                for (anc_keys, pos_keys, neg_keys) in batches:
+                    w2vm.batch_update(anc_keys, pos_keys, neg_keys, \
+                                      learn_rate=1e-3)
+                rates.append((BATCH_COUNT * batch_size) / (timer() - start))
+            print("{0:6d} {1:6d} {2:14.0f} {3:14.0f}".format( \
+                    wv_dim, batch_size, rates[0], rates[1]))
+    return
+
+if __name__ == '__main__':
+    main()
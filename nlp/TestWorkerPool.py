@@ -0,0 +1,110 @@
+'''
+Benchmark the per-call overhead of the multithreaded kernel wrappers.
+
+This compares the old approach, which spawned and joined a fresh set of
+threads on every kernel call, against the persistent pool in WorkerPool.py.
+Both wrappers run the same single-threaded Numba kernel (lut_st) for batch
+sizes ranging from 64 to 8192 rows.
+
+It also checks that calls to a multithreaded kernel still finish (and do all
+of their work) while another thread keeps resizing the pool.
+'''
+
+import threading
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+import WorkerPool as wp
+from NumbaFuncs import lut_st
+
+CALL_COUNT = 2000
+VEC_DIM = 50
+KEY_COUNT = 10000
+
+def make_spawning_multithread(inner_func, numthreads):
+    '''
+    This is the wrapper that was used before WorkerPool.py existed.
+    '''
+    def func_mt(*args):
+        length = len(args[0])
+        sp_idx = np.arange(0,length).astype(np.int32)
+        chunklen = (length + (numthreads-1)) // numthreads
+        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
+        threads = [threading.Thread(target=inner_func, args=cargs)
+                   for cargs in chunkargs[:-1]]
+        for thread in threads:
+            thread.start()
+        inner_func(*chunkargs[-1])
+        for thread in threads:
+            thread.join()
+        return 1
+    return func_mt
+
+def time_calls(func, row_idx, dLdY, dW):
+    # run once to make sure the pool is up and the kernel is compiled
+    func(row_idx, dLdY, dW)
+    start = timer()
+    for i in range(CALL_COUNT):
+        func(row_idx, dLdY, dW)
+    return (timer() - start) / CALL_COUNT
+
+def check_resize_during_calls(call_count=2000, timeout=60.0):
+    '''
+    Call a multithreaded kernel on one thread while another thread calls
+    set_thread_num(), which shuts down the pool the caller may be holding.
+    '''
+    def add_one(sp_idx, x):
+        x[sp_idx] += 1.0
+        return
+    add_one_mt = wp.make_multithread(add_one)
+    x = np.zeros((1000,))
+    old_thread_num = wp.get_thread_num()
+    stop = threading.Event()
+    def caller():
+        for i in range(call_count):
+            add_one_mt(x)
+        return
+    def resizer():
+        i = 0
+        while not stop.is_set():
+            wp.set_thread_num(1 + (i % 4))
+            i += 1
+        return
+    caller_thread = threading.Thread(target=caller)
+    resizer_thread = threading.Thread(target=resizer)
+    caller_thread.daemon = True
+    caller_thread.start()
+    resizer_thread.start()
+    caller_thread.join(timeout)
+    stop.set()
+    resizer_thread.join()
+    wp.set_thread_num(old_thread_num)
+    assert(not caller_thread.is_alive()), "kernel call deadlocked"
+    assert(np.all(x == call_count))
+    print("kernel calls during set_thread_num(): OK")
+    return
+
+def main():
+    check_resize_during_calls()
+    thread_num = wp.get_thread_num()
+    spawn_lut_bp = make_spawning_multithread(lut_st, thread_num)
+    pool_lut_bp = wp.make_multithread(lut_st)
+    serial_lut_bp = wp.make_multithread(lut_st, 1)
+    dW = np.zeros((KEY_COUNT, VEC_DIM), dtype=np.float32)
+    print("Per-call time with {0:d} threads (usec)".format(thread_num).center(80, '='))
+    print("{0:>8s} {1:>12s} {2:>12s} {3:>12s}".format( \
+            "batch", "serial", "spawn/join", "pool"))
+    batch_size = 64
+    while (batch_size <= 8192):
+        row_idx = npr.randint(0, KEY_COUNT, size=(batch_size,)).astype(np.int32)
+        dLdY = npr.randn(batch_size, VEC_DIM).astype(np.float32)
+        t_serial = time_calls(serial_lut_bp, row_idx, dLdY, dW)
+        t_spawn = time_calls(spawn_lut_bp, row_idx, dLdY, dW)
+        t_pool = time_calls(pool_lut_bp, row_idx, dLdY, dW)
+        print("{0:8d} {1:12.2f} {2:12.2f} {3:12.2f}".format(batch_size, \
+                1e6*t_serial, 1e6*t_spawn, 1e6*t_pool))
+        batch_size = batch_size * 2
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+
+#
+# The multithreaded kernels in NumbaFuncs.py and CythonFuncs.py each split a
+# minibatch into one chunk of rows per thread. Creating and joining a fresh
+# set of threading.Thread objects for every call costs more than the kernel
+# itself when minibatches are small, so all kernels instead share a single
+# pool of long-lived worker threads. Each call hands one chunk to each worker
+# through the worker's own task queue, runs the final chunk on the calling
+# thread, and then waits on a shared "done" queue until every worker has
+# reported back (i.e. the done queue acts as a barrier). The number of threads
+# can be changed at runtime via set_thread_num().
+#
+
+THREAD_NUM = 4
+
+class WorkerPool(object):
+    """
+    Pool of persistent worker threads for running chunked kernels.
+
+    The pool owns (thread_num - 1) worker threads, as the calling thread
+    always processes the last chunk of work itself.
+    """
+    def __init__(self, thread_num=THREAD_NUM):
+        assert(thread_num >= 1)
+        self.thread_num = thread_num
+        self.task_queues = []
+        self.done_queue = Queue()
+        self.workers = []
+        # set to False by shutdown(), after which run() works inline
+        self.alive = True
+        # only one caller at a time may hand out work to the pool
+        self.call_lock = threading.Lock()
+        for i in range(thread_num - 1):
+            task_queue = Queue()
+            worker = threading.Thread(target=self._worker_loop, \
+                                      args=(task_queue,))
+            worker.daemon = True
+            worker.start()
+            self.task_queues.append(task_queue)
+            self.workers.append(worker)
+        return
+
+    def _worker_loop(self, task_queue):
+        """Main loop for each worker: run tasks until told to stop."""
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            func, args = task
+            error = None
+            try:
+                func(*args)
+            except Exception as e:
+                error = e
+            self.done_queue.put(error)
+        return
+
+    def run(self, func, chunk_args):
+        """Run func once for each tuple of args in chunk_args, in parallel.
+
+        The final tuple in chunk_args is processed by the calling thread, and
+        all other tuples are given to the workers. At most thread_num tuples
+        can be processed in a single call.
+
+        If the pool was shut down after the caller got hold of it (e.g. by
+        set_thread_num() on another thread), all chunks run on the calling
+        thread instead.
+        """
+        assert(len(chunk_args) <= self.thread_num)
+        with self.call_lock:
+            if not self.alive:
+                for args in chunk_args:
+                    func(*args)
+                return
+            worker_args = chunk_args[:-1]
+            for (task_queue, args) in zip(self.task_queues, worker_args):
+                task_queue.put((func, args))
+            # Give the last chunk of work to the calling thread
+            error = None
+            try:
+                func(*chunk_args[-1])
+            except Exception as e:
+                error = e
+            # Wait for all of the workers to finish their chunks
+            for i in range(len(worker_args)):
+                w_error = self.done_queue.get()
+                if error is None:
+                    error = w_error
+        if not (error is None):
+            raise error
+        return
+
+    def shutdown(self):
+        """Stop all of the worker threads in this pool."""
+        with self.call_lock:
+            for task_queue in self.task_queues:
+                task_queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.task_queues = []
+            self.workers = []
+            self.alive = False
+        return
+
+# the pool shared by all of the multithreaded kernels
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """Get the shared worker pool, creating it if necessary."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = WorkerPool(THREAD_NUM)
+    return _POOL
+
+def set_thread_num(thread_num):
+    """Set the number of threads used by all multithreaded kernels."""
+    global _POOL, THREAD_NUM
+    assert(thread_num >= 1)
+    with _POOL_LOCK:
+        THREAD_NUM = thread_num
+        if not (_POOL is None):
+            _POOL.shutdown()
+        _POOL = WorkerPool(THREAD_NUM)
+    return
+
+def get_thread_num():
+    """Get the number of threads used by all multithreaded kernels."""
+    return THREAD_NUM
+
+def make_multithread(inner_func, numthreads=None, idx_dtype=np.int32):
+    """Wrap inner_func so that its first arg gets split across the pool.
+
+    inner_func should take an array of row indices (i.e. sp_idx) as its first
+    argument, followed by the arguments passed to the wrapped function. If
+    numthreads is None, the wrapped function will use all threads in the
+    shared pool, as set by set_thread_num().
+
+    The wrapped function also takes an optional keyword arg pool, giving the
+    WorkerPool to run on. Kernels whose per-thread state was laid out for a
+    particular pool (see NumbaFuncs.shard_rows) should pass that pool, so the
+    rows are chunked for the same thread count even if set_thread_num() is
+    called in the meantime.
+    """
+    def func_mt(*args, **kwargs):
+        pool = kwargs.get('pool', None)
+        if pool is None:
+            pool = get_pool()
+        thread_num = pool.thread_num
+        if not (numthreads is None):
+            thread_num = min(numthreads, thread_num)
+        length = len(args[0])
+        sp_idx = np.arange(0,length).astype(idx_dtype)
+        if (thread_num == 1) or (length < thread_num):
+            inner_func(*((sp_idx,) + args))
+            return 1
+        chunklen = (length + (thread_num-1)) // thread_num
+        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args \
+                     for i in range(thread_num)]
+        pool.run(inner_func, chunkargs)
+        return 1
+    def func_st(*args, **kwargs):
+        length = len(args[0])
+        sp_idx = np.arange(0,length).astype(idx_dtype)
+        sp_args = (sp_idx,) + args
+        inner_func(*sp_args)
+        return 1
+    func = None
+    if numthreads == 1:
+        func = func_st
+    else:
+        func = func_mt
+    return func
+
+
+##############
+# EYE BUFFER #
+##############
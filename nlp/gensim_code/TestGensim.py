@@ -13,24 +13,30 @@ class MySentences(object):
             for line in open(os.path.join(self.dirname, fname)):
                 yield line.split()
 
+def load_neighbor_search():
+    """
+    Load nlp/NeighborSearch.py from its path, as it lives outside this
+    directory (and doesn't import anything else from nlp/).
+    """
+    f_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                          '..', 'NeighborSearch.py')
+    try:
+        from importlib.machinery import SourceFileLoader
+        return SourceFileLoader('NeighborSearch', f_name).load_module()
+    except ImportError:
+        import imp
+        return imp.load_source('NeighborSearch', f_name)
+
+ns = load_neighbor_search()
+
 def some_nearest_words(keys_to_words, sample_count, W):
-    norms = np.sqrt(np.sum(W**2.0,axis=1,keepdims=1))
-    W = W / (norms + 1e-5)
-    source_keys = np.zeros((sample_count,)).astype(np.int32)
-    neighbor_keys = np.zeros((sample_count, 10)).astype(np.int32)
-    all_keys = np.asarray(keys_to_words.keys()).astype(np.int32)
-    for s in range(sample_count):
-        i = npr.randint(0,all_keys.size)
-        source_k = all_keys[i]
-        neg_cos_sims = -1.0 * np.sum(W * W[source_k], axis=1)
-        sorted_k = np.argsort(neg_cos_sims)
-        source_keys[s] = source_k
-        neighbor_keys[s,:] = sorted_k[1:11]
-    source_words = []
-    neighbor_words = []
-    for s in range(sample_count):
-        source_words.append(keys_to_words[source_keys[s]])
-        neighbor_words.append([keys_to_words[k] for k in neighbor_keys[s]])
+    all_keys = np.asarray(list(keys_to_words.keys())).astype(np.int32)
+    source_keys = all_keys[npr.randint(0, all_keys.size, size=(sample_count,))]
+    # all source words are searched for in a single batch
+    index = ns.ExactIndex(W)
+    neighbor_keys, source_words, neighbor_words = \
+            ns.nearest_words(keys_to_words, source_keys, index, k=10)
+    neighbor_keys = neighbor_keys.astype(np.int32)
     return [source_keys, neighbor_keys, source_words, neighbor_words]
 
 sentences = MySentences('./training_text')
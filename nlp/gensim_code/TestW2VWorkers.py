@@ -0,0 +1,59 @@
+'''
+Measure how W2VSimple's training throughput scales with the number of worker
+threads, for skip-gram and CBOW with hierarchical softmax and with negative
+sampling, on a synthetic corpus with Zipfian word counts.
+
+Each job is converted to vocab indexes in bulk and then trained on by
+train_batch() with the GIL released, so words/sec should grow close to
+linearly with the worker count, up to the number of cores.
+'''
+
+import logging
+import multiprocessing
+import numpy.random as npr
+from timeit import default_timer as timer
+import W2VSimple as w2vs
+
+SENTENCE_COUNT = 100000
+VOCAB_SIZE = 50000
+ZIPF_A = 1.2
+SENTENCE_LEN = 20
+
+def make_zipf_sentences(sentence_count, vocab_size, zipf_a, sentence_len):
+    """Make sentences of string tokens, with Zipfian token counts."""
+    keys = npr.zipf(zipf_a, size=(sentence_count, sentence_len)) - 1
+    keys = keys[keys < vocab_size]
+    words = ["w{0:d}".format(k) for k in keys]
+    sentences = [words[i:(i+sentence_len)] for i in range(0, len(words), sentence_len)]
+    return sentences
+
+def main():
+    npr.seed(1)
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    print("Building synthetic Zipf corpus...")
+    sentences = make_zipf_sentences(SENTENCE_COUNT, VOCAB_SIZE, ZIPF_A, SENTENCE_LEN)
+    cpu_count = multiprocessing.cpu_count()
+    worker_counts = [w for w in [1, 2, 4, 8, 16, 32] if (w <= cpu_count)]
+    print("{0:>6s} {1:>4s} {2:>4s} {3:>8s} {4:>14s} {5:>8s}".format( \
+            "algo", "hs", "neg", "workers", "words/sec", "speedup"))
+    for (sg, algo) in [(1, 'sg'), (0, 'cbow')]:
+        for (hs, negative) in [(1, 0), (0, 10)]:
+            model = w2vs.W2VSimple(size=100, window=5, min_count=1, sg=sg, \
+                                   hs=hs, negative=negative, sample=1e-4)
+            model.build_vocab(sentences)
+            # run a short pass first, so the timings don't include any warmup
+            model.train(sentences[0:1000])
+            base_rate = None
+            for workers in worker_counts:
+                model.workers = workers
+                start = timer()
+                word_count = model.train(sentences, chunksize=200)
+                rate = word_count / (timer() - start)
+                if base_rate is None:
+                    base_rate = rate
+                print("{0:>6s} {1:4d} {2:4d} {3:8d} {4:14.0f} {5:8.2f}".format( \
+                        algo, hs, negative, workers, rate, rate / base_rate))
+    return
+
+if __name__ == '__main__':
+    main()
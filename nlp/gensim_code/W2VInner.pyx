@@ -37,7 +37,7 @@ ctypedef void (*fast_sentence_sg_hs_ptr) (
     const np.uint32_t word2_index, const REAL_t alpha, REAL_t *work) nogil
 
 ctypedef unsigned long long (*fast_sentence_sg_neg_ptr) (
-    const int negative, np.uint32_t *table, unsigned long long table_len,
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len,
     REAL_t *syn0, REAL_t *syn1neg, const int size, const np.uint32_t word_index,
     const np.uint32_t word2_index, const REAL_t alpha, REAL_t *work,
     unsigned long long next_random) nogil
@@ -49,7 +49,7 @@ ctypedef void (*fast_sentence_cbow_hs_ptr) (
     int i, int j, int k, int cbow_mean) nogil
 
 ctypedef unsigned long long (*fast_sentence_cbow_neg_ptr) (
-    const int negative, np.uint32_t *table, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
     REAL_t *neu1,  REAL_t *syn0, REAL_t *syn1neg, const int size,
     np.uint32_t indexes[MAX_SENTENCE_LEN], const REAL_t alpha, REAL_t *work,
     int i, int j, int k, int cbow_mean, unsigned long long next_random) nogil
@@ -72,6 +72,8 @@ cdef REAL_t[EXP_TABLE_SIZE] EXP_TABLE
 
 cdef int ONE = 1
 cdef REAL_t ONEF = <REAL_t>1.0
+# scales the top 32 bits of next_random into [0, 1), for alias table draws
+cdef REAL_t RAND_SCALE = <REAL_t>(1.0 / 4294967296.0)
 
 cdef void fast_sentence0_sg_hs(
     const np.uint32_t *word_point, const np.uint8_t *word_code, const int codelen,
@@ -148,7 +150,7 @@ cdef void fast_sentence2_sg_hs(
 
 
 cdef unsigned long long fast_sentence0_sg_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len,
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len,
     REAL_t *syn0, REAL_t *syn1neg, const int size, const np.uint32_t word_index,
     const np.uint32_t word2_index, const REAL_t alpha, REAL_t *work,
     unsigned long long next_random) nogil:
@@ -167,7 +169,10 @@ cdef unsigned long long fast_sentence0_sg_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -187,7 +192,7 @@ cdef unsigned long long fast_sentence0_sg_neg(
     return next_random
 
 cdef unsigned long long fast_sentence1_sg_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len,
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len,
     REAL_t *syn0, REAL_t *syn1neg, const int size, const np.uint32_t word_index,
     const np.uint32_t word2_index, const REAL_t alpha, REAL_t *work,
     unsigned long long next_random) nogil:
@@ -206,7 +211,10 @@ cdef unsigned long long fast_sentence1_sg_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -226,7 +234,7 @@ cdef unsigned long long fast_sentence1_sg_neg(
     return next_random
 
 cdef unsigned long long fast_sentence2_sg_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len,
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len,
     REAL_t *syn0, REAL_t *syn1neg, const int size, const np.uint32_t word_index,
     const np.uint32_t word2_index, const REAL_t alpha, REAL_t *work,
     unsigned long long next_random) nogil:
@@ -247,7 +255,10 @@ cdef unsigned long long fast_sentence2_sg_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -400,7 +411,7 @@ cdef void fast_sentence2_cbow_hs(
                 syn0[indexes[m] * size + a] += work[a]
 
 cdef unsigned long long fast_sentence0_cbow_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
     REAL_t *neu1,  REAL_t *syn0, REAL_t *syn1neg, const int size,
     np.uint32_t indexes[MAX_SENTENCE_LEN], const REAL_t alpha, REAL_t *work,
     int i, int j, int k, int cbow_mean, unsigned long long next_random) nogil:
@@ -433,7 +444,10 @@ cdef unsigned long long fast_sentence0_cbow_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -457,7 +471,7 @@ cdef unsigned long long fast_sentence0_cbow_neg(
     return next_random
 
 cdef unsigned long long fast_sentence1_cbow_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
     REAL_t *neu1,  REAL_t *syn0, REAL_t *syn1neg, const int size,
     np.uint32_t indexes[MAX_SENTENCE_LEN], const REAL_t alpha, REAL_t *work,
     int i, int j, int k, int cbow_mean, unsigned long long next_random) nogil:
@@ -490,7 +504,10 @@ cdef unsigned long long fast_sentence1_cbow_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -514,7 +531,7 @@ cdef unsigned long long fast_sentence1_cbow_neg(
     return next_random
 
 cdef unsigned long long fast_sentence2_cbow_neg(
-    const int negative, np.uint32_t *table, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
+    const int negative, np.uint32_t *table, REAL_t *table_prob, unsigned long long table_len, int codelens[MAX_SENTENCE_LEN],
     REAL_t *neu1,  REAL_t *syn0, REAL_t *syn1neg, const int size,
     np.uint32_t indexes[MAX_SENTENCE_LEN], const REAL_t alpha, REAL_t *work,
     int i, int j, int k, int cbow_mean, unsigned long long next_random) nogil:
@@ -550,7 +567,10 @@ cdef unsigned long long fast_sentence2_cbow_neg(
             target_index = word_index
             label = ONEF
         else:
-            target_index = table[(next_random >> 16) % table_len]
+            target_index = <np.uint32_t>((next_random >> 16) % table_len)
+            next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+            if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= table_prob[target_index]:
+                target_index = table[target_index]
             next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
             if target_index == word_index:
                 continue
@@ -604,6 +624,7 @@ def train_sentence_sg(model, sentence, alpha, _work):
     # For negative sampling
     cdef REAL_t *syn1neg
     cdef np.uint32_t *table
+    cdef REAL_t *table_prob
     cdef unsigned long long table_len
     cdef unsigned long long next_random
 
@@ -613,6 +634,7 @@ def train_sentence_sg(model, sentence, alpha, _work):
     if negative:
         syn1neg = <REAL_t *>(np.PyArray_DATA(model.syn1neg))
         table = <np.uint32_t *>(np.PyArray_DATA(model.table))
+        table_prob = <REAL_t *>(np.PyArray_DATA(model.table_prob))
         table_len = len(model.table)
         next_random = (2**24)*np.random.randint(0,2**24) + np.random.randint(0,2**24)
 
@@ -656,7 +678,7 @@ def train_sentence_sg(model, sentence, alpha, _work):
                 if hs:
                     fast_sentence_sg_hs(points[i], codes[i], codelens[i], syn0, syn1, size, indexes[j], _alpha, work)
                 if negative:
-                    next_random = fast_sentence_sg_neg(negative, table, table_len, syn0, syn1neg, size, indexes[i], indexes[j], _alpha, work, next_random)
+                    next_random = fast_sentence_sg_neg(negative, table, table_prob, table_len, syn0, syn1neg, size, indexes[i], indexes[j], _alpha, work, next_random)
 
     return result
 
@@ -689,6 +711,7 @@ def train_sentence_cbow(model, sentence, alpha, _work, _neu1):
     # For negative sampling
     cdef REAL_t *syn1neg
     cdef np.uint32_t *table
+    cdef REAL_t *table_prob
     cdef unsigned long long table_len
     cdef unsigned long long next_random
 
@@ -698,6 +721,7 @@ def train_sentence_cbow(model, sentence, alpha, _work, _neu1):
     if negative:
         syn1neg = <REAL_t *>(np.PyArray_DATA(model.syn1neg))
         table = <np.uint32_t *>(np.PyArray_DATA(model.table))
+        table_prob = <REAL_t *>(np.PyArray_DATA(model.table_prob))
         table_len = len(model.table)
         next_random = (2**24)*np.random.randint(0,2**24) + np.random.randint(0,2**24)
 
@@ -735,11 +759,179 @@ def train_sentence_cbow(model, sentence, alpha, _work, _neu1):
             if hs:
                 fast_sentence_cbow_hs(points[i], codes[i], codelens, neu1, syn0, syn1, size, indexes, _alpha, work, i, j, k, cbow_mean)
             if negative:
-                next_random = fast_sentence_cbow_neg(negative, table, table_len, codelens, neu1, syn0, syn1neg, size, indexes, _alpha, work, i, j, k, cbow_mean, next_random)
+                next_random = fast_sentence_cbow_neg(negative, table, table_prob, table_len, codelens, neu1, syn0, syn1neg, size, indexes, _alpha, work, i, j, k, cbow_mean, next_random)
+
+    return result
+
+
+def train_batch(model, _indexes, _offsets, alpha, _work, _neu1, seed):
+    """
+    Train on a whole job of sentences, given as flat vocab indexes. Sentence s
+    is _indexes[_offsets[s]:_offsets[s+1]], and negative indexes mark words
+    that aren't in the vocab. Downsampling of frequent words (using the
+    model's sample_probs) and the random window reductions are done here,
+    with the GIL released for the whole job, so worker threads only contend
+    for the GIL once per job. Returns the number of words trained on.
+
+    """
+    cdef int hs = model.hs
+    cdef int negative = model.negative
+    cdef int sg = model.sg
+    cdef int cbow_mean = model.cbow_mean
+
+    cdef REAL_t *syn0 = <REAL_t *>(np.PyArray_DATA(model.syn0))
+    cdef REAL_t *sample_probs = <REAL_t *>(np.PyArray_DATA(model.sample_probs))
+    cdef REAL_t *work
+    cdef REAL_t *neu1
+    cdef REAL_t _alpha = alpha
+    cdef int size = model.layer1_size
+
+    cdef np.int32_t *sent_indexes
+    cdef np.int64_t *sent_offsets
+    cdef long long sentence_count = len(_offsets) - 1
+
+    cdef int codelens[MAX_SENTENCE_LEN]
+    cdef np.uint32_t indexes[MAX_SENTENCE_LEN]
+    cdef np.uint32_t reduced_windows[MAX_SENTENCE_LEN]
+    cdef int sentence_len
+    cdef int window = model.window
+
+    cdef int i, j, k
+    cdef long long s, t
+    cdef np.int32_t w
+    cdef long result = 0
+    cdef unsigned long long modulo = 281474976710655ULL
+    cdef unsigned long long next_random = <unsigned long long>seed
+
+    # For hierarchical softmax
+    cdef REAL_t *syn1
+    cdef np.int64_t *code_offsets
+    cdef np.uint8_t *codes_flat
+    cdef np.uint32_t *points_flat
+    cdef np.uint32_t *points[MAX_SENTENCE_LEN]
+    cdef np.uint8_t *codes[MAX_SENTENCE_LEN]
+
+    # For negative sampling
+    cdef REAL_t *syn1neg
+    cdef np.uint32_t *table
+    cdef REAL_t *table_prob
+    cdef unsigned long long table_len
+
+    if hs:
+        syn1 = <REAL_t *>(np.PyArray_DATA(model.syn1))
+        code_offsets = <np.int64_t *>(np.PyArray_DATA(model.code_offsets))
+        codes_flat = <np.uint8_t *>(np.PyArray_DATA(model.codes_flat))
+        points_flat = <np.uint32_t *>(np.PyArray_DATA(model.points_flat))
+
+    if negative:
+        syn1neg = <REAL_t *>(np.PyArray_DATA(model.syn1neg))
+        table = <np.uint32_t *>(np.PyArray_DATA(model.table))
+        table_prob = <REAL_t *>(np.PyArray_DATA(model.table_prob))
+        table_len = len(model.table)
+
+    # convert Python structures to primitive types, so we can release the GIL
+    work = <REAL_t *>np.PyArray_DATA(_work)
+    neu1 = <REAL_t *>np.PyArray_DATA(_neu1)
+    sent_indexes = <np.int32_t *>np.PyArray_DATA(_indexes)
+    sent_offsets = <np.int64_t *>np.PyArray_DATA(_offsets)
+
+    # release GIL & train on all sentences in the job
+    with nogil:
+        for s in range(sentence_count):
+            # gather the in-vocab words that survive downsampling
+            sentence_len = 0
+            for t in range(sent_offsets[s], sent_offsets[s+1]):
+                w = sent_indexes[t]
+                if w < 0:
+                    continue
+                if sample_probs[w] < ONEF:
+                    next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+                    if (<REAL_t>(next_random >> 16) * RAND_SCALE) >= sample_probs[w]:
+                        continue
+                indexes[sentence_len] = <np.uint32_t>w
+                if hs:
+                    codelens[sentence_len] = <int>(code_offsets[w+1] - code_offsets[w])
+                    codes[sentence_len] = &codes_flat[code_offsets[w]]
+                    points[sentence_len] = &points_flat[code_offsets[w]]
+                else:
+                    codelens[sentence_len] = 1
+                next_random = (next_random * <unsigned long long>25214903917ULL + 11) & modulo
+                reduced_windows[sentence_len] = <np.uint32_t>((next_random >> 16) % window)
+                sentence_len += 1
+                if sentence_len == MAX_SENTENCE_LEN:
+                    break
+            result += sentence_len
+
+            for i in range(sentence_len):
+                if codelens[i] == 0:
+                    continue
+                j = i - window + reduced_windows[i]
+                if j < 0:
+                    j = 0
+                k = i + window + 1 - reduced_windows[i]
+                if k > sentence_len:
+                    k = sentence_len
+                if sg:
+                    for j in range(j, k):
+                        if j == i or codelens[j] == 0:
+                            continue
+                        if hs:
+                            fast_sentence_sg_hs(points[i], codes[i], codelens[i], syn0, syn1, size, indexes[j], _alpha, work)
+                        if negative:
+                            next_random = fast_sentence_sg_neg(negative, table, table_prob, table_len, syn0, syn1neg, size, indexes[i], indexes[j], _alpha, work, next_random)
+                else:
+                    if hs:
+                        fast_sentence_cbow_hs(points[i], codes[i], codelens, neu1, syn0, syn1, size, indexes, _alpha, work, i, j, k, cbow_mean)
+                    if negative:
+                        next_random = fast_sentence_cbow_neg(negative, table, table_prob, table_len, codelens, neu1, syn0, syn1neg, size, indexes, _alpha, work, i, j, k, cbow_mean, next_random)
 
     return result
 
 
+def make_alias_table(weights):
+    """
+    Build a Walker/Vose alias table for drawing index i with probability
+    proportional to weights[i]. Returns (table, table_prob), where a draw
+    picks a uniform bucket i and then keeps i if a uniform float is less than
+    table_prob[i], and otherwise takes table[i].
+
+    """
+    cdef long long n = len(weights)
+    cdef long long s_count = 0, l_count = 0, i, s, l
+    scaled = np.asarray(weights, dtype=np.float64)
+    scaled = scaled * (n / np.sum(scaled))
+    _table = np.arange(n, dtype=np.uint32)
+    _table_prob = np.ones(n, dtype=REAL)
+    _small = np.flatnonzero(scaled < 1.0).astype(np.int64)
+    _large = np.flatnonzero(scaled >= 1.0).astype(np.int64)
+    # small/large are used as stacks, with room for every bucket in each
+    s_count = _small.size
+    l_count = _large.size
+    _small.resize(n, refcheck=False)
+    _large.resize(n, refcheck=False)
+    cdef np.float64_t[:] sc = scaled
+    cdef np.uint32_t[:] table = _table
+    cdef REAL_t[:] table_prob = _table_prob
+    cdef np.int64_t[:] small = _small
+    cdef np.int64_t[:] large = _large
+    with nogil:
+        while (s_count > 0) and (l_count > 0):
+            s_count -= 1
+            s = small[s_count]
+            l = large[l_count - 1]
+            table_prob[s] = <REAL_t>sc[s]
+            table[s] = <np.uint32_t>l
+            # the large bucket gives up the mass needed to fill bucket s
+            sc[l] = (sc[l] + sc[s]) - 1.0
+            if sc[l] < 1.0:
+                l_count -= 1
+                small[s_count] = l
+                s_count += 1
+    # anything left over is (up to rounding error) a full bucket, and keeps
+    # its default table_prob of 1
+    return _table, _table_prob
+
+
 def init():
     """
     Precompute function `sigmoid(x) = 1 / (1 + exp(-x))`, for x values discretized
@@ -20,20 +20,21 @@ except ImportError:
     from Queue import Queue
 
 from numpy import exp, dot, zeros, outer, random, get_include, float32 as REAL, int64, prod, dtype as np_dtype, \
-    uint32, seterr, array, uint8, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum
+    uint32, seterr, array, uint8, float64, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum, \
+    int32, fromiter, cumsum, concatenate
 
 logger = logging.getLogger("W2VSimple")
 
 import GensimUtils as gs_utils
 from six import iteritems, itervalues, string_types
-from six.moves import xrange
+from six.moves import xrange, map
 
 try:
     # try to compile and use the faster cython version
     import pyximport
     models_dir = os.path.dirname(__file__) or os.getcwd()
     pyximport.install(setup_args={"include_dirs": [models_dir, get_include()]})
-    from W2VInner import train_sentence_sg, train_sentence_cbow, FAST_VERSION
+    from W2VInner import train_sentence_sg, train_sentence_cbow, train_batch, make_alias_table, FAST_VERSION
 except:
     # give up and die
     print("Training in plain Python is futile :(")
@@ -124,7 +125,8 @@ class W2VSimple():
         self.vocab = {}  # mapping from a word (string) to a Vocab object
         self.index2word = []  # map from a word's matrix index (int) to word (string)
         self.sg = int(sg)
-        self.table = None # for negative sampling --> this needs a lot of RAM! consider setting back to None before saving
+        self.table = None # alias table for negative sampling, one bucket per word
+        self.table_prob = None
         self.layer1_size = int(size)
         if size % 4 != 0:
             logger.warning("consider setting layer size to a multiple of 4 for greater performance")
@@ -143,36 +145,27 @@ class W2VSimple():
             self.train(sentences)
         return
 
-    def make_table(self, table_size=100000000, power=0.75):
+    def make_table(self, power=0.75):
         """
-        Create a table using stored vocabulary word counts for drawing random words in the negative
-        sampling training routines.
+        Create an alias table using stored vocabulary word counts for drawing random words in
+        the negative sampling training routines. The table has one bucket per vocabulary word,
+        so drawing a word takes O(1) time and the table needs O(vocab) memory.
 
         Called internally from `build_vocab()`.
 
         """
-        logger.info("constructing a table with noise distribution from %i words" % len(self.vocab))
-        # table (= list of words) of noise distribution for negative sampling
+        logger.info("constructing an alias table with noise distribution from %i words" % len(self.vocab))
         vocab_size = len(self.index2word)
-        self.table = zeros(table_size, dtype=uint32)
+        self.table = zeros(0, dtype=uint32)
+        self.table_prob = zeros(0, dtype=REAL)
 
         if not vocab_size:
             logger.warning("empty vocabulary in word2vec, is this intended?")
             return
 
-        # compute sum of all power (Z in paper)
-        train_words_pow = float(sum([self.vocab[word].count**power for word in self.vocab]))
-        # go through the whole table and fill it up with the word indexes proportional to a word's count**power
-        widx = 0
-        # normalize count^0.75 by Z
-        d1 = self.vocab[self.index2word[widx]].count**power / train_words_pow
-        for tidx in xrange(table_size):
-            self.table[tidx] = widx
-            if 1.0 * tidx / table_size > d1:
-                widx += 1
-                d1 += self.vocab[self.index2word[widx]].count**power / train_words_pow
-            if widx >= vocab_size:
-                widx = vocab_size - 1
+        # word weights are count**power, in index order (normalization happens in the builder)
+        counts = array([self.vocab[word].count for word in self.index2word], dtype=float64)
+        self.table, self.table_prob = make_alias_table(counts**power)
         return
 
     def create_binary_tree(self):
@@ -217,6 +210,38 @@ class W2VSimple():
             prob = (sqrt(v.count / threshold_count) + 1) * (threshold_count / v.count) if self.sample else 1.0
             v.sample_probability = min(prob, 1.0)
 
+    def make_index_arrays(self):
+        """
+        Collect the per-word info used by `train_batch()` into flat arrays, in index order: a
+        word -> index dict, each word's downsampling keep probability, and (when using hierarchical
+        softmax) all Huffman codes/points, with word i's at code_offsets[i]:code_offsets[i+1].
+
+        Called internally from `build_vocab()`.
+
+        """
+        self.word2index = dict((word, i) for (i, word) in enumerate(self.index2word))
+        self.sample_probs = array([self.vocab[word].sample_probability for word in self.index2word], dtype=REAL)
+        if self.hs:
+            code_lens = array([len(self.vocab[word].code) for word in self.index2word], dtype=int64)
+            self.code_offsets = zeros(len(self.index2word) + 1, dtype=int64)
+            self.code_offsets[1:] = cumsum(code_lens)
+            self.codes_flat = concatenate([self.vocab[word].code for word in self.index2word] + [zeros(0, dtype=uint8)]).astype(uint8)
+            self.points_flat = concatenate([self.vocab[word].point for word in self.index2word] + [zeros(0, dtype=uint32)]).astype(uint32)
+        return
+
+    def sentences_to_indexes(self, sentences):
+        """
+        Convert a list of sentences to flat vocab indexes in one pass, with -1 for out-of-vocab
+        words. Sentence s gets indexes[offsets[s]:offsets[s+1]].
+
+        """
+        lens = [len(sentence) for sentence in sentences]
+        offsets = zeros(len(sentences) + 1, dtype=int64)
+        offsets[1:] = cumsum(lens)
+        words = itertools.chain.from_iterable(sentences)
+        indexes = fromiter(map(self.word2index.get, words, itertools.repeat(-1)), dtype=int32, count=int(offsets[-1]))
+        return indexes, offsets
+
     def build_vocab(self, sentences):
         """
         Build vocabulary from a sequence of sentences (can be a once-only generator stream).
@@ -256,6 +281,7 @@ class W2VSimple():
             self.make_table()
         # precalculate downsampling thresholds
         self.precalc_sampling()
+        self.make_index_arrays()
         self.reset_weights()
         return
 
@@ -265,6 +291,10 @@ class W2VSimple():
         Update the model's neural weights from a sequence of sentences (can be a once-only generator stream).
         Each sentence must be a list of unicode strings.
 
+        Sentences are grouped into jobs of `chunksize` sentences, and each job is converted to flat vocab
+        indexes in bulk, on the calling thread. Downsampling and training then happen in `train_batch()`,
+        which holds the GIL only while setting up each job.
+
         """
         if FAST_VERSION < 0:
             import warnings
@@ -291,14 +321,12 @@ class W2VSimple():
                 job = jobs.get()
                 if job is None:  # data finished, exit
                     break
+                indexes, offsets, seed = job
                 # update the learning rate before every job
                 alpha = self.alpha
                 #alpha = max(self.min_alpha, self.alpha * (1 - 1.0 * word_count[0] / total_words))
-                # how many words did we train on? out-of-vocabulary (unknown) words do not count
-                if self.sg:
-                    job_words = sum(train_sentence_sg(self, sentence, alpha, work) for sentence in job)
-                else:
-                    job_words = sum(train_sentence_cbow(self, sentence, alpha, work, neu1) for sentence in job)
+                # how many words did we train on? out-of-vocabulary (unknown) and downsampled words do not count
+                job_words = train_batch(self, indexes, offsets, alpha, work, neu1, seed)
                 with lock:
                     word_count[0] += job_words
                     elapsed = time.time() - start
@@ -312,17 +340,13 @@ class W2VSimple():
             thread.daemon = True  # make interrupting the process with ctrl+c easier
             thread.start()
 
-        def prepare_sentences():
-            for sentence in sentences:
-                # avoid calling random_sample() where prob >= 1, to speed things up a little:
-                sampled = [self.vocab[word] for word in sentence
-                    if word in self.vocab and (self.vocab[word].sample_probability >= 1.0 or self.vocab[word].sample_probability >= random.random_sample())]
-                yield sampled
-
-        # convert input strings to Vocab objects (eliding OOV/downsampled words), and start filling the jobs queue
-        for job_no, job in enumerate(grouper(prepare_sentences(), chunksize)):
+        # convert input strings to vocab indexes, and start filling the jobs queue. each job carries its own
+        # seed for the downsampling/window/negative draws made by train_batch()
+        for job_no, job in enumerate(grouper(sentences, chunksize)):
+            indexes, offsets = self.sentences_to_indexes(job)
+            seed = random.randint(0, 2**24) * (2**24) + random.randint(0, 2**24)
             logger.debug("putting job #%i in the queue, qsize=%i" % (job_no, jobs.qsize()))
-            jobs.put(job)
+            jobs.put((indexes, offsets, seed))
         #logger.info("reached the end of input; waiting to finish %i outstanding jobs" % jobs.qsize())
         for _ in xrange(self.workers):
             jobs.put(None)  # give the workers heads up that they can finish -- no more work!
@@ -1,17 +1,123 @@
 from time import clock
 import numpy as np
 import numpy.random as npr
+from numpy.lib.stride_tricks import as_strided
 from scipy import signal as signal
 
 #
 # Each LNLayer class provides several methods that are intended for use by
 # an external controller.
 #
+# The layers that work on sequences (LUT, C1D, KMax, Relu, Drop, ML2VM) take
+# a batch of sequences either as a list of matrices, with one matrix per
+# sequence, or as a SeqBatch, which holds the whole batch in one padded 3d
+# array. With a SeqBatch, each layer processes the batch with a fixed number
+# of numpy calls, rather than with a Python loop over the sequences.
+#
+
+class SeqBatch:
+    """A batch of vector sequences, as a padded array plus sequence lengths.
+
+    Row j of sequence i is X[i,j,:], for j < seq_lens[i]. The rows of X past
+    the end of each sequence are kept at zero. Padding is cheapest when the
+    sequences in a batch have similar lengths (see LayerNets.length_buckets).
+    """
+    def __init__(self, X, seq_lens):
+        self.X = X
+        self.seq_lens = np.asarray(seq_lens)
+        self.shape = X.shape
+        return
+
+    def mask(self):
+        """Get a (seq_count, max_len) boolean mask of the unpadded rows."""
+        max_len = self.X.shape[1]
+        return np.arange(max_len)[np.newaxis,:] < self.seq_lens[:,np.newaxis]
+
+    def to_list(self):
+        """Get the sequences as a list of matrices."""
+        return [x[0:l] for (x, l) in zip(self.X, self.seq_lens)]
+
+    def __len__(self):
+        return self.X.shape[0]
+
+def seq_batch(seq_list):
+    """Make a SeqBatch from a list of matrices."""
+    X_pad, seq_lens = pad_seqs(seq_list)
+    return SeqBatch(X_pad, seq_lens)
 
 #######################
 # K-MAX POOLING LAYER #
 #######################
 
+def pad_seqs(seq_list, fill=0.0):
+    """Stack a list of matrices with equal column counts into an array of
+    shape (len(seq_list), max_len, col_count), with the rows past the end of
+    each matrix set to fill. Returns [X_pad, seq_lens].
+    """
+    seq_lens = np.array([s.shape[0] for s in seq_list])
+    max_len = max(1, int(np.max(seq_lens)))
+    X_pad = np.zeros((len(seq_list), max_len, seq_list[0].shape[1])) + fill
+    in_seq = np.arange(max_len)[np.newaxis,:] < seq_lens[:,np.newaxis]
+    X_pad[in_seq] = np.concatenate(seq_list, axis=0)
+    return [X_pad, seq_lens]
+
+def kmax_idx(S, seq_lens, kmax):
+    """Find the ordered indices of the k max rows for each column of each
+    sequence in S, which should be padded as by pad_seqs().
+
+    Row j of sequence i is S[i,j,:], and the rows of sequence i past
+    seq_lens[i] are ignored. The k for sequence i is kmax[i] (or seq_lens[i]
+    if that's smaller). The result km_idx has shape (seq_count, k_top,
+    col_count), where k_top is the largest k. km_idx[i,0:k,c] holds the
+    k max rows of column c of sequence i, in increasing order, and the rest
+    of km_idx[i,:,c] is set to S.shape[1] (i.e. one past the last row).
+
+    Rather than fully sorting each column, this uses argpartition to find
+    the k_top max rows, and then only sorts those.
+    """
+    seq_count, max_len, col_count = S.shape
+    k_lens = np.minimum(np.asarray(kmax), seq_lens)
+    k_top = max(1, int(np.max(k_lens)))
+    in_seq = np.arange(max_len)[np.newaxis,:] < seq_lens[:,np.newaxis]
+    S = np.where(in_seq[:,:,np.newaxis], S, -np.inf)
+    rows = np.arange(seq_count)[:,np.newaxis,np.newaxis]
+    cols = np.arange(col_count)[np.newaxis,np.newaxis,:]
+    if (k_top < max_len):
+        km_idx = np.argpartition(-S, k_top-1, axis=1)[:,0:k_top,:]
+    else:
+        km_idx = np.zeros(S.shape, dtype=np.int64) + \
+                np.arange(max_len)[np.newaxis,:,np.newaxis]
+    # Rank the k_top max rows by value, and then keep the top k for each
+    # sequence, in their original order
+    rank_idx = np.argsort(-S[rows, km_idx, cols], axis=1)
+    km_idx = km_idx[rows, rank_idx, cols]
+    k_mask = np.arange(k_top)[np.newaxis,:] < k_lens[:,np.newaxis]
+    km_idx = np.where(k_mask[:,:,np.newaxis], km_idx, max_len)
+    km_idx.sort(axis=1)
+    return km_idx
+
+def kmax_apply(X, km_idx):
+    """Apply kmax to the padded sequences in X, using the kmax indices in
+    km_idx (from kmax_idx()). If km_idx has one column, it selects whole
+    rows of X. Unused entries of the result are set to 0.
+    """
+    seq_count, max_len, col_count = X.shape
+    Xz = np.concatenate([X, np.zeros((seq_count, 1, col_count))], axis=1)
+    rows = np.arange(seq_count)[:,np.newaxis,np.newaxis]
+    cols = np.arange(col_count)[np.newaxis,np.newaxis,:]
+    return Xz[rows, km_idx, cols]
+
+def kmax_unapply(dLdY, km_idx, max_len):
+    """Unapply kmax using the kmax indices in km_idx, i.e. scatter dLdY back
+    onto padded sequences with max_len rows.
+    """
+    seq_count, k_top, col_count = dLdY.shape
+    dLdX = np.zeros((seq_count, (max_len + 1), col_count))
+    rows = np.arange(seq_count)[:,np.newaxis,np.newaxis]
+    cols = np.arange(col_count)[np.newaxis,np.newaxis,:]
+    dLdX[rows, km_idx, cols] = dLdY
+    return dLdX[:,0:max_len,:]
+
 class KMaxLayer:
     def __init__(self, in_layer=False):
         # self.kmax contains the desired k for each incoming sequence. Note
@@ -22,6 +128,7 @@ class KMaxLayer:
         # self.kmax_idx will hold a reverse lookup table, for inverting the
         # kmax operation
         self.kmax_idx = []
+        self.seq_lens = []
         self.comp_time = 0.0
         # Set stuff common to all layer types
         self.has_params = False
@@ -39,26 +146,9 @@ class KMaxLayer:
         self.output_layer = []
         return
 
-    def _find_kmax_idx(self, x, k):
-        """Find the ordered indices of the k max rows for each column of x."""
-        km_idx = np.argsort(x, axis=0)
-        km_idx = km_idx[-k:,:]
-        km_idx.sort(axis=0)
-        return km_idx
-
-    def _apply_kmax(self, x, km_idx):
-        """Apply kmax using the kmax indices in km_idx."""
-        y = np.zeros(km_idx.shape)
-        for c in range(km_idx.shape[1]):
-            y[:,c] = x[km_idx[:,c],c]
-        return y
-
-    def _unapply_kmax(self, x, dldy, km_idx):
-        """Unapply kmax using the kmax indices in km_idx."""
-        dldx = np.zeros(x.shape)
-        for c in range(km_idx.shape[1]):
-            dldx[km_idx[:,c],c] = dldy[:,c]
-        return dldx
+    def _find_kmax_idx(self, X_pad):
+        """Find the kmax indices for each column of each padded sequence."""
+        return kmax_idx(X_pad, self.seq_lens, self.kmax)
 
     def feedforward(self, input, auto_prop=False):
         """Perform feedforward through this layer.
@@ -71,12 +161,20 @@ class KMaxLayer:
         self.cleanup()
         # Do feedforward
         self.X = input
-        # Compute the indices of kmax elements for each input sequence
-        self.kmax_idx = [self._find_kmax_idx(x, k) for (x, k) \
-                in zip(self.X, self.kmax)]
+        # Compute the indices of kmax elements for all input sequences at
+        # once, after stacking them into a padded array (if needed)
+        if isinstance(self.X, SeqBatch):
+            X_pad, self.seq_lens = self.X.X, self.X.seq_lens
+        else:
+            X_pad, self.seq_lens = pad_seqs(self.X)
+        self.kmax_idx = self._find_kmax_idx(X_pad)
         # Use the indices to construct the kmaxed output sequences
-        self.Y = [self._apply_kmax(x, km_idx) for (x, km_idx) \
-                in zip(self.X, self.kmax_idx)]
+        Y_pad = kmax_apply(X_pad, self.kmax_idx)
+        k_lens = np.minimum(np.asarray(self.kmax), self.seq_lens)
+        if isinstance(self.X, SeqBatch):
+            self.Y = SeqBatch(Y_pad, k_lens)
+        else:
+            self.Y = [y[0:k] for (y, k) in zip(Y_pad, k_lens)]
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it forward
@@ -91,15 +189,24 @@ class KMaxLayer:
         by backpropping through ReLU via self.dYdX, and then pushes self.dLdX
         onto self.input_layer for further backpropping.
         """
-        assert (len(dLdY_bp) == len(self.Y))
-        for (y, dldy) in zip(self.Y, dLdY_bp):
-            assert (y.shape == dldy.shape)
+        assert (type(dLdY_bp) is type(self.Y))
 
         # Backprop through the k-max activation for each sequence
         t1 = clock()
         self.dLdY = dLdY_bp
-        self.dLdX = [self._unapply_kmax(x, dldy, km_idx) for (x, dldy, km_idx) \
-                in zip(self.X, self.dLdY, self.kmax_idx)]
+        max_len = max(1, int(np.max(self.seq_lens)))
+        if isinstance(self.dLdY, SeqBatch):
+            assert (self.dLdY.shape == self.Y.shape)
+            dLdX_pad = kmax_unapply(self.dLdY.X, self.kmax_idx, max_len)
+            self.dLdX = SeqBatch(dLdX_pad, self.seq_lens)
+        else:
+            assert (len(self.dLdY) == len(self.Y))
+            for (y, dldy) in zip(self.Y, self.dLdY):
+                assert (y.shape == dldy.shape)
+            dLdY_pad = pad_seqs(self.dLdY)[0]
+            dLdX_pad = kmax_unapply(dLdY_pad, self.kmax_idx, max_len)
+            self.dLdX = [dldx[0:l] for (dldx, l) in \
+                         zip(dLdX_pad, self.seq_lens)]
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
@@ -112,6 +219,7 @@ class KMaxLayer:
         self.X = []
         self.Y = []
         self.kmax_idx = []
+        self.seq_lens = []
         self.dLdY = []
         self.dLdX = []
         if auto_prop:
@@ -128,6 +236,7 @@ class KMaxNormLayer:
         # self.kmax_idx will hold a reverse lookup table, for inverting the
         # kmax operation
         self.kmax_idx = []
+        self.seq_lens = []
         self.comp_time = 0.0
         # Set stuff common to all layer types
         self.has_params = False
@@ -145,26 +254,13 @@ class KMaxNormLayer:
         self.output_layer = []
         return
 
-    def _find_kmax_idx(self, x, k):
-        """Find the ordered indices of the k max rows for each column of x."""
-        x_norms = np.sqrt(np.sum(x**2.0,axis=1))
-        x_norms = x_norms.reshape((x.shape[0], 1))
-        km_idx = x_norms.argsort(axis=0)
-        km_idx = km_idx[-k:,0]
-        km_idx.sort(axis=0)
-        return km_idx
-
-    def _apply_kmax(self, x, km_idx):
-        """Apply kmax using the kmax indices in km_idx."""
-        y = x[km_idx,:]
-        return y
-
-    def _unapply_kmax(self, x, dldy, km_idx):
-        """Unapply kmax using the kmax indices in km_idx."""
-        dldx = np.zeros(x.shape)
-        for i in range(km_idx.shape[0]):
-            dldx[km_idx[i],:] = dldy[i,:]
-        return dldx
+    def _find_kmax_idx(self, X_pad):
+        """Find the kmax indices for the rows of each padded sequence, by
+        their L2 norms. The indices have one column, so kmax_apply() will
+        select whole rows.
+        """
+        x_norms = np.sqrt(np.sum(X_pad**2.0, axis=2, keepdims=True))
+        return kmax_idx(x_norms, self.seq_lens, self.kmax)
 
     def feedforward(self, input, auto_prop=False):
         """Perform feedforward through this layer.
@@ -177,12 +273,20 @@ class KMaxNormLayer:
         self.cleanup()
         # Do feedforward
         self.X = input
-        # Compute the indices of kmax elements for each input sequence
-        self.kmax_idx = [self._find_kmax_idx(x, k) for (x, k) \
-                in zip(self.X, self.kmax)]
+        # Compute the indices of kmax elements for all input sequences at
+        # once, after stacking them into a padded array (if needed)
+        if isinstance(self.X, SeqBatch):
+            X_pad, self.seq_lens = self.X.X, self.X.seq_lens
+        else:
+            X_pad, self.seq_lens = pad_seqs(self.X)
+        self.kmax_idx = self._find_kmax_idx(X_pad)
         # Use the indices to construct the kmaxed output sequences
-        self.Y = [self._apply_kmax(x, km_idx) for (x, km_idx) \
-                in zip(self.X, self.kmax_idx)]
+        Y_pad = kmax_apply(X_pad, self.kmax_idx)
+        k_lens = np.minimum(np.asarray(self.kmax), self.seq_lens)
+        if isinstance(self.X, SeqBatch):
+            self.Y = SeqBatch(Y_pad, k_lens)
+        else:
+            self.Y = [y[0:k] for (y, k) in zip(Y_pad, k_lens)]
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it forward
@@ -197,15 +301,24 @@ class KMaxNormLayer:
         by backpropping through ReLU via self.dYdX, and then pushes self.dLdX
         onto self.input_layer for further backpropping.
         """
-        assert (len(dLdY_bp) == len(self.Y))
-        for (y, dldy) in zip(self.Y, dLdY_bp):
-            assert (y.shape == dldy.shape)
+        assert (type(dLdY_bp) is type(self.Y))
 
         # Backprop through the k-max activation for each sequence
         t1 = clock()
         self.dLdY = dLdY_bp
-        self.dLdX = [self._unapply_kmax(x, dldy, km_idx) for (x, dldy, km_idx) \
-                in zip(self.X, self.dLdY, self.kmax_idx)]
+        max_len = max(1, int(np.max(self.seq_lens)))
+        if isinstance(self.dLdY, SeqBatch):
+            assert (self.dLdY.shape == self.Y.shape)
+            dLdX_pad = kmax_unapply(self.dLdY.X, self.kmax_idx, max_len)
+            self.dLdX = SeqBatch(dLdX_pad, self.seq_lens)
+        else:
+            assert (len(self.dLdY) == len(self.Y))
+            for (y, dldy) in zip(self.Y, self.dLdY):
+                assert (y.shape == dldy.shape)
+            dLdY_pad = pad_seqs(self.dLdY)[0]
+            dLdX_pad = kmax_unapply(dLdY_pad, self.kmax_idx, max_len)
+            self.dLdX = [dldx[0:l] for (dldx, l) in \
+                         zip(dLdX_pad, self.seq_lens)]
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
@@ -218,6 +331,7 @@ class KMaxNormLayer:
         self.X = []
         self.Y = []
         self.kmax_idx = []
+        self.seq_lens = []
         self.dLdY = []
         self.dLdX = []
         if auto_prop:
@@ -272,6 +386,12 @@ class ReluLayer:
                 self.dYdX.append(relu_mask)
                 self.Y.append(y)
                 self.dLdY.append(np.zeros(y.shape))
+        elif isinstance(self.X, SeqBatch):
+            # Respond to a padded batch of sequences (padding stays at 0)
+            self.dYdX = (self.X.X > 0.0)
+            self.Y = SeqBatch(self.X.X * self.dYdX, self.X.seq_lens)
+            self.dLdX = []
+            self.dLdY = np.zeros(self.Y.shape)
         else:
             # Respond to a single gparray
             self.dYdX = (self.X > 0.0)
@@ -296,6 +416,10 @@ class ReluLayer:
             for (i, dldy_bp) in enumerate(dLdY_bp):
                 self.dLdY[i] = self.dLdY[i] + dldy_bp
                 self.dLdX.append(self.dLdY[i] * self.dYdX[i])
+        elif isinstance(dLdY_bp, SeqBatch):
+            # Respond to a padded batch of sequences
+            self.dLdY = self.dLdY + dLdY_bp.X
+            self.dLdX = SeqBatch(self.dLdY * self.dYdX, dLdY_bp.seq_lens)
         else:
             # Respond to a single gparray
             self.dLdY = self.dLdY + dLdY_bp
@@ -364,6 +488,12 @@ class DropLayer:
                         (npr.rand(x.shape[0], x.shape[1]) > self.drop_rate)
                 self.dYdX.append(drop_mask)
                 self.Y.append(drop_mask * x)
+        elif isinstance(self.X, SeqBatch):
+            # Respond to a padded batch of sequences (padding stays at 0)
+            drop_mask = self.drop_scale * \
+                    (npr.rand(*self.X.shape) > self.drop_rate)
+            self.dYdX = drop_mask
+            self.Y = SeqBatch(drop_mask * self.X.X, self.X.seq_lens)
         else:
             # Respond to a single gparray
             drop_mask = self.drop_scale * \
@@ -383,6 +513,9 @@ class DropLayer:
             self.dLdX = []
             for (i, dldy_bp) in enumerate(dLdY_bp):
                 self.dLdX.append(dldy_bp * self.dYdX[i])
+        elif isinstance(dLdY_bp, SeqBatch):
+            # Respond to a padded batch of sequences
+            self.dLdX = SeqBatch(dLdY_bp.X * self.dYdX, dLdY_bp.seq_lens)
         else:
             # Respond to a single gparray
             self.dLdX = dLdY_bp * self.dYdX
@@ -432,12 +565,18 @@ class ML2VMLayer:
         # Cleanup detritus from any previous feedforward
         self.cleanup()
         # Reshape...
-        assert (type(input) is list)
         self.X = input
-        self.Y = np.zeros((len(self.X), self.out_shape[1]))
-        for (i, x) in enumerate(self.X):
-            assert (x.shape == self.in_shape)
-            self.Y[i,:] = x.reshape(self.out_shape)
+        if isinstance(self.X, SeqBatch):
+            # Every sequence should fill the padded array
+            assert (self.X.shape[1:] == self.in_shape)
+            assert (np.all(self.X.seq_lens == self.in_shape[0]))
+            self.Y = self.X.X.reshape((self.X.shape[0], self.out_shape[1]))
+        else:
+            assert (type(input) is list)
+            self.Y = np.zeros((len(self.X), self.out_shape[1]))
+            for (i, x) in enumerate(self.X):
+                assert (x.shape == self.in_shape)
+                self.Y[i,:] = x.reshape(self.out_shape)
         if auto_prop and self.output_layer:
             self.output_layer.feedforward(self.Y, True)
         return self.Y
@@ -447,9 +586,13 @@ class ML2VMLayer:
         """
         # Reshape...
         self.dLdY = dLdY_bp
-        self.dLdX = []
-        for i in range(self.dLdY.shape[0]):
-            self.dLdX.append(self.dLdY[i,:].reshape(self.in_shape))
+        if isinstance(self.X, SeqBatch):
+            dLdX = self.dLdY.reshape(((self.dLdY.shape[0],) + self.in_shape))
+            self.dLdX = SeqBatch(dLdX, self.X.seq_lens)
+        else:
+            self.dLdX = []
+            for i in range(self.dLdY.shape[0]):
+                self.dLdX.append(self.dLdY[i,:].reshape(self.in_shape))
         if auto_prop and self.input_layer:
             self.input_layer.backprop(self.dLdX, True)
         return self.dLdX
@@ -587,14 +730,24 @@ class C1DLayer:
     sequence in each input matrix. Each filter has the same number of columns
     as the input matrices, and their row count is set when the object is first
     created.
+
+    If batch_conv is True, all sequences in the input list are stacked into a
+    single padded sequence, with (filt_len - 1) zero rows around each one, and
+    the whole batch is convolved with one matrix product. As the padding
+    between neighboring sequences is shared, the conv-chunk rows for the
+    stacked sequence are exactly the conv-chunk rows for each sequence, one
+    sequence after another, so this gives the same results as convolving the
+    sequences separately.
     """
 
-    def __init__(self, num_filt, filt_len, filt_dim, in_layer=False):
+    def __init__(self, num_filt, filt_len, filt_dim, in_layer=False, \
+                 batch_conv=True):
         # Set stuff for managing this type of layer
         self.num_filt = num_filt
         self.filt_len = filt_len
         self.filt_dim = filt_dim
         self.filt_size = filt_len * filt_dim
+        self.batch_conv = batch_conv
         self.params = {}
         self.param_grads = {}
         self.params['W'] = npr.randn(self.filt_size, self.num_filt)
@@ -605,6 +758,8 @@ class C1DLayer:
         self.conv_pad = np.zeros((self.filt_len-1, self.filt_dim))
         self.comp_time = 0.0
         self.Xc = []
+        self.Xs = []
+        self.seq_ends = []
         # Set common stuff for all types layers
         self.has_params = True
         self.X = []
@@ -653,14 +808,59 @@ class C1DLayer:
         return conv_len
 
     def _conv_mat(self, S):
-        """Get the convolution-friendly chunked matrix for sequence x."""
+        """Get the convolution-friendly chunked matrix for sequence x.
+
+        Row i of the chunked matrix holds rows i:(i+filt_len) of the padded
+        sequence, laid end to end. As the padded sequence is contiguous, each
+        such row is also contiguous, so the chunked matrix is just a strided
+        view of the padded sequence (i.e. nothing is copied).
+        """
         conv_len = self._conv_len(S)
         Sp = np.concatenate([self.conv_pad, S, self.conv_pad], axis=0)
-        Sc = np.zeros((conv_len, self.filt_size))
-        for i in range(conv_len):
-            Sc[i,:] = Sp[i:(i+self.filt_len),:].reshape((1, self.filt_size))
+        row_stride = Sp.strides[0]
+        Sc = as_strided(Sp, shape=(conv_len, self.filt_size), \
+                        strides=(row_stride, Sp.strides[1]))
         return Sc
 
+    def _unconv_mat(self, dLdSc, seq_len):
+        """Accumulate the gradients on a chunked matrix (as produced by
+        _conv_mat) onto the rows of the padded sequence they came from.
+        """
+        conv_len = dLdSc.shape[0]
+        dLdSc = dLdSc.reshape((conv_len, self.filt_len, self.filt_dim))
+        dLdSp = np.zeros(((seq_len + 2*(self.filt_len-1)), self.filt_dim))
+        # Row j of chunk i came from row i+j of the padded sequence
+        for j in range(self.filt_len):
+            dLdSp[j:(j+conv_len),:] += dLdSc[:,j,:]
+        return dLdSp
+
+    def _conv_mat_3d(self, X):
+        """Get the conv-chunk matrix for a padded batch of sequences X, with
+        shape (seq_count, max_len, filt_dim). The chunks for each sequence
+        are in consecutive rows, (max_len + filt_len - 1) per sequence.
+        """
+        seq_count, max_len, filt_dim = X.shape
+        pad = np.zeros((seq_count, (self.filt_len - 1), filt_dim))
+        Xp = np.concatenate([pad, X, pad], axis=1)
+        conv_len = max_len + self.filt_len - 1
+        Sc = as_strided(Xp, shape=(seq_count, conv_len, self.filt_size), \
+                        strides=Xp.strides)
+        return Sc.reshape((seq_count * conv_len, self.filt_size))
+
+    def _unconv_mat_3d(self, dLdSc, seq_count, max_len):
+        """Accumulate the gradients on a chunked matrix (as produced by
+        _conv_mat_3d) onto the rows of the padded sequences they came from.
+        """
+        conv_len = max_len + self.filt_len - 1
+        dLdSc = dLdSc.reshape((seq_count, conv_len, self.filt_len, \
+                               self.filt_dim))
+        dLdXp = np.zeros((seq_count, (conv_len + self.filt_len - 1), \
+                          self.filt_dim))
+        # Row j of chunk i came from row i+j of the padded sequence
+        for j in range(self.filt_len):
+            dLdXp[:,j:(j+conv_len),:] += dLdSc[:,:,j,:]
+        return dLdXp[:,(self.filt_len - 1):((self.filt_len - 1) + max_len),:]
+
     def _conv_1d(self, Sc):
         """Compute the 1d-conv of current filters with vector sequence S."""
         # Simple matrix product, cuz we're using conv-chunk matrix format
@@ -671,7 +871,6 @@ class C1DLayer:
 
     def _deconv_1d(self, S, Sc, dLdY):
         """Backprop gradients dLdY through 1d-conv with sequence S."""
-        conv_len = Sc.shape[0]
         seq_len = S.shape[0]
         # Compute gradients with respect to filter weights and biases
         self.param_grads['W'] += np.dot(Sc.T, dLdY)
@@ -679,9 +878,7 @@ class C1DLayer:
         # Compute gradients with respect to conv-chunk matrix
         dLdSc = np.dot(dLdY, self.params['W'].T)
         # Unroll and accumulate gradients over the padded version of S
-        dLdSp = np.zeros(((seq_len + 2*(self.filt_len-1)), self.filt_dim))
-        for i in range(conv_len):
-            dLdSp[i:(i+self.filt_len),:] += dLdSc[i,:].reshape((self.filt_len, self.filt_dim))
+        dLdSp = self._unconv_mat(dLdSc, seq_len)
         # Extract portion of sequence gradient derived from unpadded S
         dLdS = dLdSp[(self.filt_len - 1):((self.filt_len - 1) + seq_len),:]
         return dLdS
@@ -696,10 +893,32 @@ class C1DLayer:
         # Cleanup detritus from any previous feedforward
         self.cleanup()
         self.X = input
-        # Generate the conv-chunk matrix for each sequence
-        self.Xc = [self._conv_mat(x) for x in self.X]
-        # Convolve filters with each vector sequence in the input list
-        self.Y = [self._conv_1d(xc) for xc in self.Xc]
+        if isinstance(self.X, SeqBatch):
+            # Convolve all of the padded sequences with one matrix product
+            seq_count, max_len = self.X.shape[0:2]
+            self.Xc = [self._conv_mat_3d(self.X.X)]
+            Y_pad = self._conv_1d(self.Xc[0]).reshape((seq_count, \
+                    (max_len + self.filt_len - 1), self.num_filt))
+            self.Y = SeqBatch(Y_pad, self.X.seq_lens + (self.filt_len - 1))
+            # Keep the padding at 0 (i.e. drop the biases added there)
+            self.Y.X *= self.Y.mask()[:,:,np.newaxis]
+        elif self.batch_conv:
+            # Stack the sequences, with shared padding between them, and
+            # then convolve the stacked sequence all in one go
+            seq_list = []
+            for x in self.X:
+                seq_list.extend([x, self.conv_pad])
+            self.Xs = np.concatenate(seq_list[:-1], axis=0)
+            self.Xc = [self._conv_mat(self.Xs)]
+            Y_all = self._conv_1d(self.Xc[0])
+            # Split the result into a chunk for each input sequence
+            self.seq_ends = np.cumsum([self._conv_len(x) for x in self.X])
+            self.Y = np.split(Y_all, self.seq_ends[:-1], axis=0)
+        else:
+            # Generate the conv-chunk matrix for each sequence
+            self.Xc = [self._conv_mat(x) for x in self.X]
+            # Convolve filters with each vector sequence in the input list
+            self.Y = [self._conv_1d(xc) for xc in self.Xc]
         # Stop timer
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
@@ -713,15 +932,39 @@ class C1DLayer:
         """
         # Check that the shape of the incoming gradients is valid
         assert (len(dLdY_bp) == len(self.Y))
-        for (y, dldy) in zip(self.Y, dLdY_bp):
-            assert (y.shape == dldy.shape)
+        if isinstance(self.Y, SeqBatch):
+            assert (dLdY_bp.shape == self.Y.shape)
+        else:
+            for (y, dldy) in zip(self.Y, dLdY_bp):
+                assert (y.shape == dldy.shape)
         t1 = clock()
         self.dLdY = dLdY_bp
         # Compute gradients w.r.t. input sequences, note that this also
         # performs updates to self.param_grads['W'] and self.param_grads['b']
         # while computing gradients w.r.t. input sequences.
-        self.dLdX = [self._deconv_1d(x, xc, dldy) for (x, xc, dldy) \
-                in zip(self.X, self.Xc, self.dLdY)]
+        if isinstance(self.Y, SeqBatch):
+            # Backprop through all of the padded sequences in one go
+            seq_count, max_len = self.X.shape[0:2]
+            dLdY = self.dLdY.X * self.Y.mask()[:,:,np.newaxis]
+            dLdY = dLdY.reshape((-1, self.num_filt))
+            self.param_grads['W'] += np.dot(self.Xc[0].T, dLdY)
+            self.param_grads['b'] += np.sum(dLdY, axis=0, keepdims=True)
+            dLdSc = np.dot(dLdY, self.params['W'].T)
+            dLdX = self._unconv_mat_3d(dLdSc, seq_count, max_len)
+            dLdX = dLdX * self.X.mask()[:,:,np.newaxis]
+            self.dLdX = SeqBatch(dLdX, self.X.seq_lens)
+        elif self.batch_conv:
+            # Backprop through the stacked sequence all in one go, and then
+            # extract the gradients for each input sequence
+            dLdXs = self._deconv_1d(self.Xs, self.Xc[0], \
+                                    np.concatenate(self.dLdY, axis=0))
+            seq_starts = [(e - y.shape[0]) for (e, y) in \
+                          zip(self.seq_ends, self.Y)]
+            self.dLdX = [dLdXs[s:(s+x.shape[0])] for (s, x) in \
+                         zip(seq_starts, self.X)]
+        else:
+            self.dLdX = [self._deconv_1d(x, xc, dldy) for (x, xc, dldy) \
+                    in zip(self.X, self.Xc, self.dLdY)]
         t2 = clock()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
@@ -738,6 +981,8 @@ class C1DLayer:
     def cleanup(self, auto_prop=False):
         """Cleanup temporary feedforward/backprop stuff."""
         self.Xc = []
+        self.Xs = []
+        self.seq_ends = []
         self.X = []
         self.Y = []
         self.dLdX = []
@@ -751,8 +996,10 @@ class C1DLayer:
 #######################
 
 class LUTLayer:
-    def __init__(self, key_count, embed_dim):
+    def __init__(self, key_count, embed_dim, seq_batch=False):
         # Set stuff for managing this type of layer
+        self.seq_batch = seq_batch # if True, output a SeqBatch
+        self.X_pad = []
         self.comp_time = 0.0
         self.params = {}
         self.params['W'] = npr.randn(key_count, embed_dim)
@@ -811,6 +1058,14 @@ class LUTLayer:
             self.X = [input]
         else:
             self.X = input
+        if self.seq_batch:
+            # Look up all sequences at once, as a padded batch
+            self.Y = self._feedforward_batch()
+            t2 = clock()
+            self.comp_time = self.comp_time + (t2 - t1)
+            if auto_prop and self.output_layer:
+                self.output_layer.feedforward(self.Y, True)
+            return self.Y
         # Verify input type and lut index range
         for idx_seq in self.X:
             for lut_idx in idx_seq:
@@ -828,19 +1083,41 @@ class LUTLayer:
             self.output_layer.feedforward(self.Y, True)
         return self.Y
 
+    def _feedforward_batch(self):
+        """Look up the sequences in self.X, producing a SeqBatch."""
+        seq_lens = np.array([len(idx_seq) for idx_seq in self.X])
+        lut_idx = np.concatenate([np.asarray(idx_seq) for idx_seq in self.X])
+        # Verify input type and lut index range
+        assert (lut_idx.dtype.kind in 'iu')
+        assert ((np.min(lut_idx) >= 0) and (np.max(lut_idx) < self.key_count))
+        Y = SeqBatch(np.zeros((len(self.X), max(1, int(np.max(seq_lens))), \
+                     self.embed_dim)), seq_lens)
+        self.X_pad = np.zeros(Y.shape[0:2], dtype=np.int64)
+        self.X_pad[Y.mask()] = lut_idx
+        Y.X[:] = self.params['W'][self.X_pad] * Y.mask()[:,:,np.newaxis]
+        return Y
+
     def backprop(self, dLdY_bp, auto_prop=False):
         """Backprop through this layer.
         """
         # Check that the shape of the incoming gradients is valid
         t1 = clock()
         assert (len(dLdY_bp) == len(self.Y))
-        for (out_seq, bp_seq) in zip(self.Y, dLdY_bp):
-            assert (out_seq.shape == bp_seq.shape)
+        if isinstance(self.Y, SeqBatch):
+            assert (dLdY_bp.shape == self.Y.shape)
+        else:
+            for (out_seq, bp_seq) in zip(self.Y, dLdY_bp):
+                assert (out_seq.shape == bp_seq.shape)
         self.dLdY = dLdY_bp
         dLdW = np.zeros(self.param_grads['W'].shape)
-        for (dldy, idx_seq) in zip(self.dLdY, self.X):
-            for (seq_idx, lut_idx) in enumerate(idx_seq):
-                dLdW[lut_idx,:] = dLdW[lut_idx,:] + dldy[seq_idx,:]
+        if isinstance(self.dLdY, SeqBatch):
+            # Scatter the grads for all (unpadded) rows at once
+            in_seq = self.Y.mask()
+            np.add.at(dLdW, self.X_pad[in_seq], self.dLdY.X[in_seq])
+        else:
+            for (dldy, idx_seq) in zip(self.dLdY, self.X):
+                for (seq_idx, lut_idx) in enumerate(idx_seq):
+                    dLdW[lut_idx,:] = dLdW[lut_idx,:] + dldy[seq_idx,:]
         # Add the gradients to the gradient accumulator
         self.param_grads['W'] = self.param_grads['W'] + dLdW
         t2 = clock()
@@ -855,6 +1132,7 @@ class LUTLayer:
     def cleanup(self, auto_prop=False):
         """Cleanup temporary feedforward/backprop stuff."""
         self.X = []
+        self.X_pad = []
         self.Y = []
         self.dLdX = []
         self.dLdY = []
@@ -17,8 +17,12 @@ class KMaxNet:
 
     The network is implemented as a series of layers. The first network layer
     is always a LUTLayer, which converts lists of index lists into lists of
-    matrices, where the rows of each matrix represent a sequence of word
-    embeddings. TODO: more docs.
+    sequences, where the rows of each sequence are word embeddings. If the
+    'seq_batch' option is True, the LUTLayer instead outputs a padded batch
+    of sequences (i.e. an LNLayers.SeqBatch), which the conv/k-max layers
+    process all at once. That's only faster when the phrases in each batch
+    have similar lengths (see length_buckets), so it's off by default.
+    TODO: more docs.
     """
     def __init__(self, opts={}):
         # Validate the given options
@@ -35,7 +39,8 @@ class KMaxNet:
         self.full_moms = []
         # Prepare the LUTLayer
         lut_opts = self.net_opts['lut_layer']
-        self.lut_layer = lnl.LUTLayer(lut_opts['max_key'], lut_opts['embed_dim'])
+        self.lut_layer = lnl.LUTLayer(lut_opts['max_key'], lut_opts['embed_dim'], \
+                                      seq_batch=self.net_opts['seq_batch'])
         self.lut_moms = {}
         self.lut_moms['W'] = np.zeros(self.lut_layer.params['W'].shape)
         self.lut_layer.max_norm = lut_opts['max_norm']
@@ -110,6 +115,8 @@ class KMaxNet:
         assert ('class_count' in options)
         if not 'k_max' in options:
             options['k_max'] = 5
+        if not 'seq_batch' in options:
+            options['seq_batch'] = False
         # Check configuration options for LUTLayer (i.e. embedding layer)
         if not 'lut_layer' in options:
             options['lut_layer'] = self.default_lut_opts()
@@ -224,14 +231,12 @@ class KMaxNet:
         """
         # Set kmaxes dynamically
         km_steps = len(self.kmax_layers)
+        x_lens = np.array([len(x) for x in X])
         for i in range(km_steps):
             km_layer = self.kmax_layers[i]
-            km_layer.kmax = []
             a = float(i+1) / float(km_steps)
-            for x in X:
-                k = int(((1.0 - a) * len(x)) + (a * self.k_max))
-                k = max(k, self.k_max)
-                km_layer.kmax.append(k)
+            k = (((1.0 - a) * x_lens) + (a * self.k_max)).astype(np.int64)
+            km_layer.kmax = np.maximum(k, self.k_max)
         # Setup dropout parameters
         if use_dropout:
             self.set_drop_rate(0.5)
@@ -358,6 +363,23 @@ def rand_idx_list(max_idx, samples):
     idx_list = [npr.randint(0, high=max_idx) for i in range(samples)]
     return idx_list
 
+def length_buckets(X, Y, batch_size):
+    """Split phrases X with labels Y into batches of similar-length phrases.
+
+    Phrases are sorted by length (in random order among phrases with the
+    same length), cut into consecutive batches of batch_size, and the order
+    of the batches is shuffled. This keeps the padding in each batch small
+    when it's fed through a KMaxNet. Returns a list of (Xb, Yb) pairs.
+    """
+    x_lens = np.array([len(x) for x in X])
+    order = np.lexsort((npr.rand(x_lens.size), x_lens))
+    batches = []
+    for b_start in range(0, order.size, batch_size):
+        b_idx = order[b_start:(b_start + batch_size)]
+        batches.append(([X[i] for i in b_idx], [Y[i] for i in b_idx]))
+    npr.shuffle(batches)
+    return batches
+
 if __name__ == '__main__':
     from time import clock as clock
     print("Bonjour, monde!")
@@ -3,7 +3,6 @@ import numpy.random as npr
 import StanfordTrees as st
 import LNLayers as lnl
 import LayerNets as ln
-import random as random
 from time import clock
 from sys import stdout as stdout
 
@@ -13,10 +12,12 @@ def simple_stb_test(tree_dir='./trees'):
 
 if __name__ == '__main__':
     tree_dir = './trees'
-    stb_data = st.SimpleLoad(tree_dir)
+    stb_data = st.SimpleLoad(tree_dir, cache_dir='./stb_cache')
     max_lut_idx = max(stb_data['lut_keys'].values())
     basic_opts = {}
     basic_opts['class_count'] = 5
+    # the training batches come from length_buckets, so pad them
+    basic_opts['seq_batch'] = True
     lut_opts = {}
     lut_opts['max_key'] = max_lut_idx
     lut_opts['embed_dim'] = 30
@@ -37,36 +38,25 @@ if __name__ == '__main__':
     batch_size = 50
     epoch_batches = 2500
     learn_rate = 0.01
-    train_pairs = [(phrase, label) for (phrase, label) in zip(train_phrases, train_labels)]
-    train_phrases = []
-    train_labels = []
     for e in range(500):
-        print("Starting epoch {0:d}, {1:d} batches".format(e, len(train_pairs)/batch_size))
+        # Group the training phrases into batches of similar-length phrases
+        train_batches = ln.length_buckets(train_phrases, train_labels, batch_size)
+        print("Starting epoch {0:d}, {1:d} batches".format(e, len(train_batches)))
         stdout.flush()
-        # Reset batch extraction indices and completed batch counter
-        batch_start = 0
-        batch_end = batch_start + batch_size
+        # Reset completed batch counter
         completed_batches = 0
         # Perform batch updates for the current epoch
         L = 0.0
         acc = 0.0
         t1 = clock()
-        random.shuffle(train_pairs)
         if ((e % 5) == 0):
             KMN.reset_moms(ada_init=0.0, clear_moms=False)
-        while ((batch_end < len(train_pairs)) and (completed_batches < epoch_batches)):
-            # Extract the current training phrase/label batch
-            batch_pairs = train_pairs[batch_start:batch_end]
+        for (Xb, Yb) in train_batches[0:epoch_batches]:
             # Train on this batch, and count its completion
-            Xb = [pair[0] for pair in batch_pairs]
-            Yb = [pair[1] for pair in batch_pairs]
             res = KMN.process_training_batch(Xb, Yb, learn_rate, use_dropout=True)
             L += res[0]
             acc += res[1]
             completed_batches += 1
-            # Advance batch extraction indices
-            batch_start = batch_start + batch_size
-            batch_end = batch_start + batch_size
             # Print diagnostic info from time-to-time
             if ((completed_batches % 50) == 0):
                 print("completed {0:d} updates, with loss {1:.4f} and acc {2:.4f}".format( \
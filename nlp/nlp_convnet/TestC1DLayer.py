@@ -0,0 +1,111 @@
+'''
+Compare the speed of feedforward and backprop through C1DLayer using the old
+row-by-row construction of the conv-chunk matrix (and the matching row-by-row
+gradient scatter), against the strided-view im2col with one matrix product
+per sentence, and against the batched mode in which a whole minibatch is
+stacked into one padded sequence and convolved with one matrix product. The
+last mode feeds each minibatch in as a SeqBatch (i.e. a padded 3d array),
+with the minibatches grouped by length via LayerNets.length_buckets, as in
+STBTests.py. All modes must give the same outputs and gradients.
+
+Inputs are minibatches of random "sentences" with lengths drawn to roughly
+match the Stanford Sentiment Treebank (mean ~19 words, max 56), fed through
+a layer like the first conv layer in STBTests.py.
+'''
+
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+import LNLayers as lnl
+import LayerNets as ln
+
+BATCH_SIZE = 50
+BATCH_COUNT = 40
+EMBED_DIM = 30
+NUM_FILT = 32
+FILT_LEN = 5
+TOL = 1e-5
+
+def make_sentences(sent_count, embed_dim):
+    lens = np.clip(npr.gamma(4.0, 4.75, size=(sent_count,)), 2, 56)
+    return [npr.randn(int(l), embed_dim) for l in lens]
+
+class OldC1DLayer(lnl.C1DLayer):
+    '''
+    This is the conv-chunk matrix construction and gradient scatter that
+    were used before the strided-view im2col existed.
+    '''
+    def _conv_mat(self, S):
+        conv_len = self._conv_len(S)
+        Sp = np.concatenate([self.conv_pad, S, self.conv_pad], axis=0)
+        Sc = np.zeros((conv_len, self.filt_size))
+        for i in range(conv_len):
+            Sc[i,:] = Sp[i:(i+self.filt_len),:].reshape((1, self.filt_size))
+        return Sc
+
+    def _unconv_mat(self, dLdSc, seq_len):
+        dLdSp = np.zeros(((seq_len + 2*(self.filt_len-1)), self.filt_dim))
+        for i in range(dLdSc.shape[0]):
+            dLdSp[i:(i+self.filt_len),:] += \
+                    dLdSc[i,:].reshape((self.filt_len, self.filt_dim))
+        return dLdSp
+
+def run_layer(layer, batches, sent_count):
+    """Feedforward and backprop each (X, sentence indices) batch, returning
+    the outputs and input grads for each sentence, and the param grads."""
+    Ys = [None for i in range(sent_count)]
+    dLdXs = [None for i in range(sent_count)]
+    for (X, idx) in batches:
+        Y = layer.feedforward(X)
+        if isinstance(Y, lnl.SeqBatch):
+            layer.backprop(lnl.SeqBatch(np.ones(Y.shape), Y.seq_lens))
+            Y = Y.to_list()
+            dLdX = layer.dLdX.to_list()
+        else:
+            layer.backprop([np.ones(y.shape) for y in Y])
+            dLdX = layer.dLdX
+        for (i, y, d) in zip(idx, Y, dLdX):
+            Ys[i] = y.copy()
+            dLdXs[i] = d.copy()
+    return [Ys, dLdXs, layer.param_grads['W'].copy()]
+
+def max_diff(A, B):
+    return max([np.max(np.abs(a - b)) for (a, b) in zip(A, B)])
+
+def main():
+    npr.seed(1)
+    sent_count = BATCH_COUNT * BATCH_SIZE
+    sents = make_sentences(sent_count, EMBED_DIM)
+    batches = []
+    for b_start in range(0, sent_count, BATCH_SIZE):
+        idx = list(range(b_start, b_start + BATCH_SIZE))
+        batches.append(([sents[i] for i in idx], idx))
+    padded_batches = [(lnl.seq_batch(X), idx) for (X, idx) in \
+                      ln.length_buckets(sents, range(sent_count), BATCH_SIZE)]
+    print("{0:>12s} {1:>14s}".format("layer", "sentences/sec"))
+    results = []
+    for (name, layer, layer_batches) in \
+            [("old", OldC1DLayer(NUM_FILT, FILT_LEN, EMBED_DIM, \
+                                 batch_conv=False), batches), \
+             ("im2col", lnl.C1DLayer(NUM_FILT, FILT_LEN, EMBED_DIM, \
+                                     batch_conv=False), batches), \
+             ("batched", lnl.C1DLayer(NUM_FILT, FILT_LEN, EMBED_DIM, \
+                                      batch_conv=True), batches), \
+             ("padded", lnl.C1DLayer(NUM_FILT, FILT_LEN, EMBED_DIM), \
+              padded_batches)]:
+        npr.seed(2)
+        layer.init_params(w_scale=0.05)
+        start = timer()
+        res = run_layer(layer, layer_batches, sent_count)
+        t = timer() - start
+        if (len(results) == 0):
+            results = res
+        # check that all layers compute the same outputs and gradients
+        assert (max_diff(res[0], results[0]) < TOL)
+        assert (max_diff(res[1], results[1]) < TOL)
+        assert (max_diff([res[2]], [results[2]]) < TOL)
+        print("{0:>12s} {1:14.0f}".format(name, sent_count / t))
+    return
+
+if __name__ == '__main__':
+    main()